@@ -25,7 +25,11 @@ import base64
 import bz2
 import configparser
 import codecs
+import ctypes
+import ctypes.util
 import datetime
+import email.parser
+import email.utils
 import fnmatch
 import gzip
 import hashlib
@@ -35,11 +39,18 @@ import itertools
 import json
 import logging
 import argparse
+import asyncio
+import multiprocessing
 import os
 import os.path
+import pickle
 import queue
+import random
 import re
+import select
+import signal
 import ssl
+import struct
 import sys
 import threading
 import time
@@ -47,6 +58,7 @@ import urllib.request, urllib.parse, urllib.error
 import urllib.request, urllib.error, urllib.parse
 import urllib.parse
 import subprocess
+import zlib
 import traceback
 import socket
 import textwrap
@@ -115,6 +127,7 @@ EXCLUDED_USER_AGENTS = (
 
 MATOMO_DEFAULT_MAX_ATTEMPTS = 3
 MATOMO_DEFAULT_DELAY_AFTER_FAILURE = 10
+MATOMO_DEFAULT_MAX_DELAY_AFTER_FAILURE = 300
 DEFAULT_SOCKET_TIMEOUT = 300
 
 MATOMO_EXPECTED_IMAGE = base64.b64decode(
@@ -713,8 +726,11 @@ class Configuration:
             "output of a large log file."
         )
         parser.add_argument(
-            '--url', dest='matomo_url', required=True,
-            help="REQUIRED Your Matomo server URL, eg. https://example.com/matomo/ or https://analytics.example.net",
+            '--url', dest='matomo_url', required=True, action='append',
+            help="REQUIRED Your Matomo server URL, eg. https://example.com/matomo/ or https://analytics.example.net. "
+            "Give it several times to spread the tracking requests over several Matomo servers sharing the same "
+            "database: the hits of a visitor go to the same server, and a server which fails is left out until it "
+            "answers again. API requests are sent to the first one, or to --api-url.",
         )
         parser.add_argument(
             '--api-url', dest='matomo_api_url',
@@ -883,15 +899,145 @@ class Configuration:
             help="Skip the n first lines to start parsing/importing data at a given line for the specified log file",
         )
         parser.add_argument(
-            '--recorders', dest='recorders', default=1, type=int,
+            '--checkpoint', dest='checkpoint', default=None,
+            help="Save the import progress of each log file in this file: the position of the last line whose hit, "
+            "and all hits before it, were recorded by Matomo. An interrupted import can then be restarted from there "
+            "with --resume. Splitting files with --parse-chunk-size is disabled when this option is used."
+        )
+        parser.add_argument(
+            '--resume', dest='resume', action='store_true', default=False,
+            help="Resume the import of each log file from the position saved in the --checkpoint file instead of "
+            "parsing it from the beginning. Compressed files are still decompressed up to that position, but the "
+            "lines before it are not parsed again."
+        )
+        parser.add_argument(
+            '--ledger', dest='ledger', default=None,
+            help="Remember the content of imported log files in this file, so that importing the same content again "
+            "under another name (eg, after the log file was rotated and compressed) is skipped, and only the new lines "
+            "of a log file that grew since the last import are imported. Useful when a cron job imports all the "
+            "rotated log files matching a pattern every day."
+        )
+        parser.add_argument(
+            '--routes', dest='routes', default=None, metavar='FILE',
+            help="Send the hits of some hosts or sites to other Matomo servers than --url, each with its own token "
+            "and recorders, as set in this INI file. Each section is a route with a url, a token_auth, and either "
+            "hosts (comma separated patterns like *.example.com, the site of the hits being found in the Matomo of "
+            "the route, or set with idsite) or idsites (site IDs found with --idsite or in the Matomo of --url). "
+            "A route can also set its number of recorders. Other hits are sent to --url."
+        )
+        parser.add_argument(
+            '--mirror-url', dest='mirror_urls', action='append', default=[], metavar='URL',
+            help="Also send all the hits to this Matomo server, eg. while migrating to a new server. Can be given "
+            "several times. Each mirror has its own recorders (as many as --recorders), retries and statistics, and "
+            "the same site IDs as --url. A slow mirror doesn't slow down the import: with --spool, the hits of each "
+            "mirror are spooled to their own directory; otherwise the hits parsed while --recorder-queue-size bytes "
+            "of hits are waiting for a mirror are not sent to it, and counted as dropped in the summary."
+        )
+        parser.add_argument(
+            '--mirror-token-auth', dest='mirror_token_auths', action='append', default=[], metavar='TOKEN',
+            help="The token_auth of each --mirror-url, in the same order. Mirrors without one use --token-auth."
+        )
+        parser.add_argument(
+            '--spool', dest='spool', default=None, metavar='DIR',
+            help="Write the parsed hits to compressed files in this directory, from which they are sent to Matomo "
+            "in order. Parsing then goes on at full speed while Matomo is slow or down, and hits not recorded yet "
+            "are sent first when an interrupted import is run again with the same --spool. Use --checkpoint, and "
+            "--resume when running it again, otherwise the log files are parsed again from the beginning and the hits "
+            "left in the spool are sent twice. The directory is emptied once all the hits are recorded, and must not "
+            "be used by several imports at once."
+        )
+        parser.add_argument(
+            '--follow', dest='follow', action='store_true', default=False,
+            help="Once the last log file is parsed, keep reading it as it grows, like tail -F, until the import is "
+            "interrupted with Ctrl+C (SIGINT): the hits parsed so far are then recorded, and the position in the log "
+            "file is saved with --ledger or --checkpoint. Press Ctrl+C again to stop right away. Rotation (the log file being renamed or removed, then created again) and truncation of the "
+            "log file are detected. Hits are recorded at least every --flush-interval seconds."
+        )
+        parser.add_argument(
+            '--flush-interval', dest='flush_interval', default=None, type=float,
+            help="Maximum number of seconds a parsed hit waits before being sent to the recorders, even if a full "
+            "batch of hits was not parsed yet (default: 5 with --follow, otherwise hits are only sent by full batches). "
+            "Useful when reading a low traffic log stream from stdin, eg. with Apache's CustomLog \"|import_logs.py -\"."
+        )
+        parser.add_argument(
+            '--recorders', dest='recorders', default=1, type=self._valid_recorders,
             help="Number of simultaneous recorders (default: %(default)s). "
             "It should be set to the number of CPU cores in your server. "
-            "You can also experiment with higher values which may increase performance until a certain point",
+            "You can also experiment with higher values which may increase performance until a certain point. "
+            "With 'auto', recorders are added while the log parser has to wait for them, as long as it makes the "
+            "import faster without slowing down Matomo, and removed when Matomo slows down. Requires bulk tracking.",
         )
         parser.add_argument(
             '--recorder-max-payload-size', dest='recorder_max_payload_size', default=200, type=int,
             help="Maximum number of log entries to record in one tracking request (default: %(default)s). "
         )
+        parser.add_argument(
+            '--partition-key', dest='partition_key', default='ip', choices=('ip', 'ip-ua'),
+            help="How hits are assigned to recorders: the hits of a visitor must be recorded by the same recorder, "
+            "in order. 'ip' (default) identifies visitors by IP address, 'ip-ua' by IP address and user agent, like "
+            "Matomo does when no visitor ID is known, which spreads the traffic of a shared IP address (NAT, proxy, "
+            "crawler) between several recorders. With --replay-tracking, the uid or cid parameter is used if present."
+        )
+        parser.add_argument(
+            '--recorder-queue-size', dest='recorder_queue_size', default='16M', type=self._valid_size,
+            help="Maximum size of the parsed hits waiting to be recorded (default: %(default)s), measured roughly as "
+            "the size of their tracking requests. Parsing waits for the recorders when it is reached. K, M and G "
+            "suffixes are accepted."
+        )
+        parser.add_argument(
+            '--serializer-queue-size', dest='serializer_queue_size', default=0, type=int,
+            help="With bulk tracking, build and encode (and compress, see --compress-requests) the tracking requests "
+            "ahead of time in a separate thread, while the recorders send the previous ones, keeping at most this "
+            "number of batches of hits encoded ahead of time, eg. 4. By default (0), each recorder encodes its "
+            "requests before sending them. Useful when Matomo answers fast and the recorders are busy encoding."
+        )
+        parser.add_argument(
+            '--recorder-target-response-time', dest='recorder_target_response_time', default=None, type=float,
+            help="Adjust the number of log entries recorded in one tracking request (up to "
+            "--recorder-max-payload-size) so that Matomo answers within this number of seconds. The size grows "
+            "gradually while Matomo answers faster, and shrinks quickly when it is slower. Requests that time out "
+            "or are rejected as too large (HTTP 413) are split in two instead of being sent again as is."
+        )
+        parser.add_argument(
+            '--recorder-max-payload-bytes', dest='recorder_max_payload_bytes', default='0', type=self._valid_size,
+            help="Maximum size of the body of one tracking request, before compression (default: no limit). "
+            "K, M and G suffixes are accepted."
+        )
+        parser.add_argument(
+            '--recorder-engine', dest='recorder_engine', default='threads', choices=('threads', 'async'),
+            help="How recorders send tracking requests: 'threads' runs each recorder in its own thread, 'async' runs "
+            "all recorders in a single thread using asyncio (default: %(default)s). The async engine makes it "
+            "possible to use many more --recorders, to keep many requests in flight to a distant Matomo server. "
+            "Requires bulk tracking, and is not used when a proxy is configured."
+        )
+        parser.add_argument(
+            '--max-hits-per-second', dest='max_hits_per_second', default=None, type=float,
+            help="Maximum number of log entries recorded per second, by all the recorders together. Useful to keep "
+            "a big import from slowing down the tracking of live visits on the same Matomo server."
+        )
+        parser.add_argument(
+            '--max-requests-per-second', dest='max_requests_per_second', default=None, type=float,
+            help="Maximum number of tracking requests sent per second, by all the recorders together."
+        )
+        parser.add_argument(
+            '--rate-limit-hours', dest='rate_limit_hours', default=None, type=self._valid_hours,
+            help="Only apply --max-hits-per-second and --max-requests-per-second during these hours (local time), "
+            "and import at full speed the rest of the time. Comma separated ranges of hours, eg. '8-19' from 8:00 "
+            "to 19:00, or '0-7,22-24'."
+        )
+        parser.add_argument(
+            '--parse-workers', dest='parse_workers', default=0, type=int,
+            help="Number of worker processes used to parse log files (default: %(default)s, parse in the main process). "
+            "Each worker parses whole log files and hands the hits back to the recorders, so several files can be parsed "
+            "at once. Hits from different log files may then be recorded in a different order than the files were given. "
+            "Cannot be used with --skip."
+        )
+        parser.add_argument(
+            '--parse-chunk-size', dest='parse_chunk_size', default='256M', type=self._valid_size,
+            help="When using --parse-workers, uncompressed log files bigger than this size are split into chunks of "
+            "about this size, which are parsed at the same time (default: %(default)s). K, M and G suffixes are "
+            "accepted, 0 disables splitting. Hits of a visitor spanning two chunks may be recorded out of order."
+        )
         parser.add_argument(
             '--replay-tracking', dest='replay_tracking',
             action='store_true', default=False,
@@ -902,6 +1048,28 @@ class Configuration:
             help="The expected suffix for tracking request paths. Only logs whose paths end with this will be imported. By default "
             "requests to the piwik.php file or the matomo.php file will be imported."
         )
+        parser.add_argument(
+            '--export-requests', dest='export_requests', default=None, metavar='DIR',
+            help="Do not send anything to Matomo, but write the tracking requests of the hits to gzipped JSON lines "
+            "files in this directory, to be sent later with --replay-requests. Requires --idsite and "
+            "--export-main-url, as Matomo cannot be asked for them. The token_auth is not written to the files."
+        )
+        parser.add_argument(
+            '--export-main-url', dest='export_main_url', default=None,
+            help="With --export-requests, the main URL of the --idsite website, eg. https://example.com"
+        )
+        parser.add_argument(
+            '--export-shards', dest='export_shards', default=16, type=int,
+            help="With --export-requests, the number of files the requests are written to. The hits of a visitor "
+            "always go to the same file, and --replay-requests sends each file in order with one recorder at a "
+            "time, so there should be more files than recorders (default: %(default)s)."
+        )
+        parser.add_argument(
+            '--replay-requests', dest='replay_requests', action='store_true', default=False,
+            help="Send the tracking requests written by --export-requests: the files given on the command line, or "
+            "the exported files of the given directories, are sent by --recorders recorders. Several machines can "
+            "each replay a part of the files."
+        )
         parser.add_argument(
             '--output', dest='output',
             help="Redirect output (stdout and stderr) to the specified file"
@@ -1013,12 +1181,48 @@ class Configuration:
         )
         parser.add_argument(
             '--retry-delay', dest='delay_after_failure', default=MATOMO_DEFAULT_DELAY_AFTER_FAILURE, type=int,
-            help="The number of seconds to wait before retrying a failed tracking request."
+            help="The number of seconds to wait before retrying a failed tracking request. The delay doubles after "
+            "each failed attempt, with some randomness so that recorders don't all retry at the same time. "
+            "When Matomo answers 429 or 503 with a Retry-After header, the delay it asks for is used instead."
+        )
+        parser.add_argument(
+            '--retry-max-delay', dest='max_delay_after_failure', default=MATOMO_DEFAULT_MAX_DELAY_AFTER_FAILURE,
+            type=int, help="The maximum number of seconds to wait before retrying a failed tracking request "
+            "(default: %(default)s)."
+        )
+        parser.add_argument(
+            '--circuit-breaker-timeout', dest='circuit_breaker_timeout', default=600, type=int,
+            help="When a tracking request still fails after --retry-max-attempts because Matomo is unreachable, "
+            "times out or returns a 429 or 5xx error, all recorders pause while one of them keeps trying, and resume "
+            "once Matomo answers again. The import stops if Matomo is unavailable for more than this number of "
+            "seconds (default: %(default)s, 0 stops at the first request failing all its attempts)."
+        )
+        parser.add_argument(
+            '--reject-file', dest='reject_file', default=None,
+            help="When the Matomo tracker fails to track some hits of a tracking request because they are invalid "
+            "(HTTP 400 error with a JSON response), find these hits by sending the request again right away in "
+            "smaller requests, and append them to this "
+            "file instead of stopping the import: one JSON object per line, with the log file name, line number, "
+            "error and tracking request of the hit, and the URL of the Matomo it was sent to (see --routes and "
+            "--mirror-url)."
         )
         parser.add_argument(
             '--request-timeout', dest='request_timeout', default=DEFAULT_SOCKET_TIMEOUT, type=int,
             help="The maximum number of seconds to wait before terminating an HTTP request to Matomo."
         )
+        parser.add_argument(
+            '--compress-requests', dest='compress_requests', default=None, choices=('gzip', 'deflate'),
+            help="Compress the body of tracking requests with this method (gzip or deflate), which saves bandwidth "
+            "to remote Matomo servers. If Matomo rejects compressed requests, they are sent uncompressed instead."
+        )
+        parser.add_argument(
+            '--chunked-requests', dest='chunked_requests', action='store_true', default=False,
+            help="Encode (and compress) the body of tracking requests while sending it, with chunked transfer "
+            "encoding, rather than building the whole body in memory first. Only a small buffer of each request "
+            "is then kept, which matters with a big --recorder-max-payload-size. The web server running Matomo must "
+            "accept chunked request bodies: if it answers HTTP 411 (Length Required), requests are sent with a "
+            "Content-Length instead."
+        )
         parser.add_argument(
             '--include-host', action='append', type=str,
             help="Only import logs from the specified host(s)."
@@ -1068,6 +1272,37 @@ class Configuration:
 
         return date
 
+    def _valid_recorders(self, value):
+        if value == 'auto':
+            return value
+        try:
+            return int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError("Invalid number of recorders '%s': expected a number or 'auto'." % value)
+
+    def _valid_hours(self, value):
+        hours = set()
+        for hour_range in value.split(','):
+            match = re.match(r'^\s*(\d+)\s*-\s*(\d+)\s*$', hour_range)
+            if not match or int(match.group(1)) > 24 or int(match.group(2)) > 24:
+                raise argparse.ArgumentTypeError("Invalid hours '%s': expected ranges of hours like '8-19'." % value)
+
+            start, end = int(match.group(1)) % 24, int(match.group(2)) % 24
+            if start < end:
+                hours.update(range(start, end))
+            else:
+                # The range goes past midnight.
+                hours.update(range(start, 24))
+                hours.update(range(0, end))
+        return hours
+
+    def _valid_size(self, value):
+        match = re.match(r'^\s*(\d+)\s*([kmg]?)b?\s*$', value, re.IGNORECASE)
+        if not match:
+            raise argparse.ArgumentTypeError("Invalid size value '%s': expected a number of bytes, optionally followed by K, M or G." % value)
+
+        return int(match.group(1)) * 1024 ** ' kmg'.index(match.group(2).lower() or ' ')
+
     def _parse_args(self, option_parser, argv = None):
         """
         Parse the command line args and create self.options and self.filenames.
@@ -1095,6 +1330,28 @@ class Configuration:
             level=logging.DEBUG if self.options.debug >= 1 else logging.INFO,
         )
 
+        if self.options.follow:
+            if not self.filenames or self.filenames[-1] == '-':
+                fatal_error('--follow requires the name of the log file to follow')
+            if self.filenames[-1].endswith('.bz2') or self.filenames[-1].endswith('.gz'):
+                fatal_error('--follow cannot be used with a compressed log file')
+            if not LogFile.supports_encoding(self.options.encoding):
+                fatal_error('--follow cannot be used with the %s encoding' % self.options.encoding)
+            if self.options.flush_interval is None:
+                self.options.flush_interval = 5
+        if self.options.flush_interval is not None and self.options.flush_interval <= 0:
+            fatal_error('--flush-interval must be a positive number of seconds')
+
+        self.ledger = None
+        if self.options.ledger:
+            self.ledger = Ledger(self.options.ledger)
+            self.ledger.load()
+            followed_filename = self.filenames[-1] if self.options.follow else None
+            self.filenames = [
+                filename for filename in self.filenames
+                if filename == '-' or self.ledger.check(filename) or filename == followed_filename
+            ]
+
         self.options.excluded_useragents = set([s.lower() for s in self.options.excluded_useragents])
 
         if self.options.exclude_path_from:
@@ -1143,9 +1400,12 @@ class Configuration:
                     return
 
 
-        if not (self.options.matomo_url.startswith('http://') or self.options.matomo_url.startswith('https://')):
-            self.options.matomo_url = 'http://' + self.options.matomo_url
-        logging.debug('Matomo Tracker API URL is: %s', self.options.matomo_url)
+        self.options.matomo_tracker_urls = [
+            url if url.startswith('http://') or url.startswith('https://') else 'http://' + url
+            for url in self.options.matomo_url
+        ]
+        self.options.matomo_url = self.options.matomo_tracker_urls[0]
+        logging.debug('Matomo Tracker API URL is: %s', ', '.join(self.options.matomo_tracker_urls))
 
         if not self.options.matomo_api_url:
             self.options.matomo_api_url = self.options.matomo_url
@@ -1154,9 +1414,62 @@ class Configuration:
             self.options.matomo_api_url = 'http://' + self.options.matomo_api_url
         logging.debug('Matomo Analytics API URL is: %s', self.options.matomo_api_url)
 
-        if self.options.recorders < 1:
+        self.options.recorders_auto = self.options.recorders == 'auto'
+        if self.options.recorders_auto:
+            self.options.recorders = RecorderTuner.START_RECORDERS
+        elif self.options.recorders < 1:
             self.options.recorders = 1
 
+        if self.options.resume and not self.options.checkpoint:
+            fatal_error('--resume requires the --checkpoint option')
+
+        self.routes = None
+        if self.options.routes:
+            if self.options.export_requests or self.options.replay_requests:
+                fatal_error('--routes cannot be used with --export-requests or --replay-requests')
+            self.routes = Routes(self.options.routes, self.options.recorders)
+
+        self.mirrors = []
+        if self.options.mirror_urls:
+            if self.options.export_requests or self.options.replay_requests:
+                fatal_error('--mirror-url cannot be used with --export-requests or --replay-requests')
+            if len(self.options.mirror_token_auths) > len(self.options.mirror_urls):
+                fatal_error('--mirror-token-auth is given more times than --mirror-url')
+            for i, url in enumerate(self.options.mirror_urls):
+                if not url.startswith('http://') and not url.startswith('https://'):
+                    url = 'http://' + url
+                token_auth = self.options.mirror_token_auths[i] if i < len(self.options.mirror_token_auths) else None
+                self.mirrors.append(Mirror('mirror-%d' % (i + 1), url, token_auth, self.options.recorders))
+
+        if self.options.export_requests:
+            if self.options.replay_requests:
+                fatal_error('--export-requests cannot be used with --replay-requests')
+            if not self.options.site_id or not self.options.export_main_url:
+                fatal_error('--export-requests requires the --idsite and --export-main-url options')
+            if self.options.export_shards < 1:
+                self.options.export_shards = 1
+
+        if self.options.replay_requests:
+            for option in ('checkpoint', 'ledger', 'spool', 'follow'):
+                if getattr(self.options, option):
+                    fatal_error('--replay-requests cannot be used with --%s' % option)
+            self.filenames = RequestExporter.get_files(self.filenames)
+            if not self.filenames:
+                fatal_error('no exported requests found in %s' % ', '.join(self.options.file))
+
+        if self.options.rate_limit_hours and not (self.options.max_hits_per_second or self.options.max_requests_per_second):
+            fatal_error('--rate-limit-hours requires the --max-hits-per-second or --max-requests-per-second option')
+
+        if self.options.checkpoint:
+            # Byte ranges of a file would be recorded concurrently, while the
+            # checkpoint can only store one position per file.
+            self.options.parse_chunk_size = 0
+
+        if self.options.parse_workers < 0:
+            self.options.parse_workers = 0
+        if self.options.parse_workers and self.options.skip:
+            fatal_error('--skip cannot be used with --parse-workers')
+
         download_extensions = DOWNLOAD_EXTENSIONS
         if self.options.download_extensions:
             download_extensions = set(self.options.download_extensions.split(','))
@@ -1261,14 +1574,32 @@ class Configuration:
             return credentials[1]
 
     def get_resolver(self):
-        if self.options.site_id:
+        if self.options.replay_requests:
+            # The tracking requests have their site ID already.
+            return None
+        elif self.options.export_requests:
+            logging.debug('Resolver: static')
+            return StaticResolver(self.options.site_id, self.options.export_main_url)
+        elif self.options.site_id:
             logging.debug('Resolver: static')
             return StaticResolver(self.options.site_id)
         else:
             logging.debug('Resolver: dynamic')
             return DynamicResolver()
 
+    def get_checkpoint(self):
+        if not self.options.checkpoint:
+            return None
+
+        result = Checkpoint(self.options.checkpoint)
+        if self.options.resume:
+            result.load()
+        return result
+
     def init_token_auth(self):
+        if self.options.export_requests:
+            # The token_auth is added by --replay-requests.
+            return
         if not self.options.matomo_token_auth:
             try:
                 self.options.matomo_token_auth = self._get_token_auth()
@@ -1292,18 +1623,56 @@ class Statistics:
             # itertools.count's implementation in C does not release the GIL and
             # therefore is thread-safe.
             self.counter = itertools.count(1)
-            self.value = 0
+            self.count = 0
+            # Added by advance() in one step, eg. the counts of a parse worker.
+            self.lock = threading.Lock()
+            self.advanced = 0
+
+        @property
+        def value(self):
+            return self.count + self.advanced
 
         def increment(self):
-            self.value = next(self.counter)
+            self.count = next(self.counter)
 
         def advance(self, n):
-            for i in range(n):
-                self.increment()
+            with self.lock:
+                self.advanced += n
+
+        def __str__(self):
+            return str(int(self.value))
+
+    class Total:
+        """
+        Thread-safe sum of values too big to be counted with a Counter, like
+        a number of bytes.
+        """
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.value = 0
+
+        def add(self, n):
+            with self.lock:
+                self.value += n
 
         def __str__(self):
             return str(int(self.value))
 
+    # Counters updated while parsing log lines (as opposed to while recording
+    # hits). Parse workers send these back to the main process.
+    PARSER_COUNTERS = (
+        'count_lines_parsed',
+        'count_lines_invalid',
+        'count_lines_filtered',
+        'count_lines_hostname_skipped',
+        'count_lines_static',
+        'count_lines_skipped_user_agent',
+        'count_lines_skipped_http_errors',
+        'count_lines_skipped_http_redirects',
+        'count_lines_downloads',
+        'count_lines_skipped_downloads',
+    )
+
     def __init__(self):
         self.time_start = None
         self.time_stop = None
@@ -1336,13 +1705,59 @@ class Statistics:
         self.count_lines_skipped_http_redirects = self.Counter()
         # Downloads
         self.count_lines_downloads = self.Counter()
+        # The tracker failed to track them, with --reject-file.
+        self.count_lines_rejected = self.Counter()
+        # Written to the --spool
+        self.count_lines_spooled = self.Counter()
         # Ignored downloads when --download-extensions is used
         self.count_lines_skipped_downloads = self.Counter()
 
+        # Size of the tracking request bodies with --compress-requests, before
+        # and after compression.
+        self.request_bytes = self.Total()
+        self.request_bytes_sent = self.Total()
+        # Why compression was disabled, if it was.
+        self.compression_disabled_reason = None
+        # Time tracking requests waited because of the rate limits, in seconds.
+        self.rate_limit_delay = self.Total()
+        # Number of hits of each partition of the Dispatcher.
+        self.partition_hits = []
+        # Time spent encoding tracking requests ahead of time, waiting for the
+        # recorders to take them, and sending them (summed over recorders),
+        # in seconds.
+        self.serialize_time = self.Total()
+        self.serializer_wait = self.Total()
+        self.send_time = self.Total()
+
         # Misc
         self.dates_recorded = set()
         self.monitor_stop = False
 
+    def get_parser_counts(self):
+        """
+        Return the current value of every parser counter, by counter name.
+        """
+        return dict(
+            (name, getattr(self, name).value)
+            for name in self.PARSER_COUNTERS
+        )
+
+    def add_parser_counts(self, counts):
+        """
+        Merge parser counter values (eg, sent by a parse worker) into ours.
+        """
+        for name, value in counts.items():
+            getattr(self, name).advance(value)
+
+    def add_partitions(self, sizes):
+        """
+        Called with the number of hits added to each partition for a batch.
+        """
+        if not self.partition_hits:
+            self.partition_hits = [0] * len(sizes)
+        for i, size in enumerate(sizes):
+            self.partition_hits[i] += size
+
     def set_time_start(self):
         self.time_start = time.time()
 
@@ -1393,7 +1808,7 @@ The following lines were not tracked by Matomo, either due to a malformed tracke
 
     %(count_lines_recorded)d requests imported successfully
     %(count_lines_downloads)d requests were downloads
-    %(total_lines_ignored)d requests ignored:
+%(rejected)s    %(total_lines_ignored)d requests ignored:
         %(count_lines_skipped_http_errors)d HTTP errors
         %(count_lines_skipped_http_redirects)d HTTP redirects
         %(count_lines_invalid)d invalid log lines
@@ -1420,7 +1835,7 @@ Performance summary
 
     Total time: %(total_time)d seconds
     Requests imported per second: %(speed_recording)s requests per second
-
+%(recorders)s%(endpoints)s%(routes)s%(mirrors)s%(partitions)s%(serializer)s%(spool)s%(export)s%(rate_limit)s%(circuit_breaker)s%(compression)s%(payload_sizes)s
 Processing your log data
 ------------------------
 
@@ -1430,6 +1845,9 @@ Processing your log data
 
     'count_lines_recorded': self.count_lines_recorded.value,
     'count_lines_downloads': self.count_lines_downloads.value,
+    'rejected': '    %d requests could not be tracked and were written to %s\n' % (
+            self.count_lines_rejected.value, config.options.reject_file,
+        ) if config.options.reject_file else '',
     'total_lines_ignored': sum([
             self.count_lines_invalid.value,
             self.count_lines_filtered.value,
@@ -1480,9 +1898,158 @@ Processing your log data
             self.time_start, self.time_stop,
         )),
     'url': config.options.matomo_api_url,
-    'invalid_lines': invalid_lines_summary
+    'invalid_lines': invalid_lines_summary,
+    'compression': self._get_compression_summary(),
+    'payload_sizes': self._get_payload_sizes_summary(),
+    'recorders': self._get_recorders_summary(),
+    'endpoints': self._get_endpoints_summary(),
+    'routes': self._get_routes_summary(),
+    'mirrors': self._get_mirrors_summary(),
+    'rate_limit': self._get_rate_limit_summary(),
+    'circuit_breaker': self._get_circuit_breaker_summary(),
+    'partitions': self._get_partitions_summary(),
+    'serializer': self._get_serializer_summary(),
+    'spool': self._get_spool_summary(),
+    'export': self._get_export_summary(),
 }))
 
+    def _get_export_summary(self):
+        exporter = Recorder.exporter
+        if exporter is None:
+            return ''
+
+        return '    Tracking requests written to %d files in %s\n' % (exporter.file_count, exporter.path)
+
+    def _get_spool_summary(self):
+        spool = Recorder.spool
+        if spool is None:
+            return ''
+
+        return '    %d requests were written to the spool %s%s\n' % (
+            self.count_lines_spooled.value, spool.path,
+            '' if spool.is_empty() else ', some are left in it to be recorded by the next import',
+        )
+
+    def _get_serializer_summary(self):
+        if Recorder.serializer is None:
+            return ''
+
+        return (
+            '    Encoding tracking requests: %s seconds, then waiting %s seconds for the recorders to take them\n'
+            '    Sending tracking requests: %s seconds in total over all recorders\n'
+        ) % (
+            self._round_value(self.serialize_time.value),
+            self._round_value(self.serializer_wait.value),
+            self._round_value(self.send_time.value),
+        )
+
+    def _get_partitions_summary(self):
+        total = sum(self.partition_hits)
+        if not total:
+            return ''
+
+        return '    Busiest partition: %s times the average number of hits per partition (partition key: %s)\n' % (
+            self._round_value(float(max(self.partition_hits)) * len(self.partition_hits) / total),
+            config.options.partition_key,
+        )
+
+    def _get_circuit_breaker_summary(self):
+        breaker = Recorder.circuit_breaker
+        if breaker is None or not breaker.count_trips:
+            return ''
+
+        return '    Matomo was unavailable %d times, the import was paused %d seconds in total\n' % (
+            breaker.count_trips, breaker.time_open,
+        )
+
+    def _get_rate_limit_summary(self):
+        if Recorder.rate_limiter is None:
+            return ''
+
+        return '    Tracking requests waited %s seconds in total because of the rate limits\n' % (
+            self._round_value(self.rate_limit_delay.value),
+        )
+
+    def _get_recorders_summary(self):
+        tuner = Recorder.tuner
+        if tuner is None:
+            return ''
+
+        return '    Recorders: %d at the end, between %d and %d\n' % (
+            len(Recorder.recorders), tuner.smallest_count, tuner.largest_count,
+        )
+
+    def _get_endpoints_summary(self):
+        if matomo.endpoints is None:
+            return ''
+
+        lines = []
+        for endpoint in matomo.endpoints.endpoints:
+            lines.append(
+                '    Tracker %s: %d requests imported, %s requests per second, %s seconds per tracking request, '
+                '%d failed requests, unavailable %d times for %s seconds\n' % (
+                    endpoint.url, endpoint.count_hits,
+                    self._round_value(self._compute_speed(endpoint.count_hits, self.time_start, self.time_stop)),
+                    self._round_value(endpoint.response_time / endpoint.count_requests if endpoint.count_requests else 0),
+                    endpoint.count_failures, endpoint.count_ejections,
+                    self._round_value(endpoint.time_ejected + (
+                        time.time() - endpoint.ejected_since if endpoint.ejected_since is not None else 0
+                    )),
+                )
+            )
+        return ''.join(lines)
+
+    def _get_routes_summary(self):
+        if Recorder.routes is None:
+            return ''
+
+        return ''.join(
+            '    Route %s: %d requests imported to %s\n' % (route.name, route.count_lines_recorded.value, ', '.join(route.urls))
+            for route in Recorder.routes.routes
+        )
+
+    def _get_mirrors_summary(self):
+        lines = []
+        for mirror in Recorder.mirrors:
+            spool = mirror.recorder.spool if mirror.recorder is not None else None
+            lines.append('    Mirror %s: %d requests imported, %d rejected%s%s\n' % (
+                mirror.urls[0], mirror.count_lines_recorded.value, mirror.count_lines_rejected.value,
+                ', %d dropped as it could not keep up' % mirror.count_lines_dropped.value
+                if mirror.count_lines_dropped.value else '',
+                ', some are left in the spool %s' % spool.path if spool is not None and not spool.is_empty() else '',
+            ))
+        return ''.join(lines)
+
+    def _get_payload_sizes_summary(self):
+        sizer = Recorder.payload_sizer
+        if sizer is None or not sizer.count_requests:
+            return ''
+
+        return (
+            '    Hits per tracking request: %d at the end, between %d and %d, %s on average\n'
+            '    Tracking requests split after a timeout or HTTP 413 error: %d\n'
+        ) % (
+            sizer.get_size(), sizer.smallest_size, sizer.largest_size,
+            self._round_value(float(sizer.count_hits) / sizer.count_requests),
+            sizer.count_splits,
+        )
+
+    def _get_compression_summary(self):
+        if not config.options.compress_requests:
+            return ''
+
+        if self.request_bytes_sent.value:
+            summary = '    Tracking requests: %s KB sent for %s KB of data (%s%%)\n' % (
+                self._round_value(self.request_bytes_sent.value / 1024.0),
+                self._round_value(self.request_bytes.value / 1024.0),
+                self._round_value(100.0 * self.request_bytes_sent.value / self.request_bytes.value),
+            )
+        else:
+            summary = ''
+        if self.compression_disabled_reason:
+            summary += '    Compression of tracking requests was disabled: %s\n' % self.compression_disabled_reason
+        return summary
+
     ##
     ## The monitor is a thread that prints a short summary each second.
     ##
@@ -1588,20 +2155,168 @@ class UrlHelper:
             result.append(d[str(i)])
         return result
 
+class TrackerEndpoints:
+    """
+    The tracker URLs given with several --url options. Each tracking request
+    has a routing key, the Dispatcher partition of its hits, and is sent to
+    the endpoint chosen for this key by rendezvous hashing among the
+    available endpoints: the hits of a visitor go to the same endpoint while
+    it is available, and only the partitions of a failing endpoint move to
+    other ones.
+
+    An endpoint is ejected when a request to it fails because it is
+    unreachable, times out or is overloaded, and a thread checks every
+    HEALTH_CHECK_INTERVAL seconds whether it answers again. While all the
+    endpoints are ejected, requests go to the one ejected first, so that the
+    usual retries and --circuit-breaker-timeout apply.
+    """
+
+    HEALTH_CHECK_INTERVAL = 5 # seconds
+
+    class Endpoint:
+        def __init__(self, url):
+            self.url = url
+            self.ejected_since = None
+
+            self.count_requests = 0
+            self.count_hits = 0
+            self.count_failures = 0
+            self.count_ejections = 0
+            self.response_time = 0.0
+            self.time_ejected = 0.0
+
+    def __init__(self, client, urls):
+        self.client = client
+        self.endpoints = [self.Endpoint(url) for url in urls]
+        self.lock = threading.Lock()
+        # The endpoints of each routing key, by decreasing rendezvous hash.
+        self.orders = {}
+        self.health_checks = None
+        self.stopped = threading.Event()
+
+    def _get_order(self, key):
+        order = self.orders.get(key)
+        if order is None:
+            with self.lock:
+                order = self.orders.get(key)
+                if order is None:
+                    order = self.orders[key] = sorted(
+                        self.endpoints, reverse=True,
+                        key=lambda endpoint: hashlib.md5(('%s %s' % (endpoint.url, key)).encode('utf-8')).digest(),
+                    )
+        return order
+
+    def get(self, key):
+        """
+        Return the endpoint to send the requests of a routing key to.
+        """
+        order = self._get_order(key)
+        for endpoint in order:
+            if endpoint.ejected_since is None:
+                return endpoint
+        return min(order, key=lambda endpoint: endpoint.ejected_since)
+
+    @staticmethod
+    def is_unavailable_error(e):
+        # Tracking failures of some hits are 400 or 500 errors: they would
+        # fail on the other endpoints too.
+        if isinstance(e, urllib.error.HTTPError):
+            return e.code == 429 or e.code >= 502
+        return not isinstance(e, ValueError)
+
+    def on_success(self, endpoint, hit_count, response_time):
+        with self.lock:
+            endpoint.count_requests += 1
+            endpoint.count_hits += hit_count
+            endpoint.response_time += response_time
+
+    def on_failure(self, endpoint, e):
+        """
+        Called when a request to an endpoint failed. Returns True if the
+        endpoint is ejected and the request can be sent again right away to
+        another one.
+        """
+        with self.lock:
+            endpoint.count_failures += 1
+            if not self.is_unavailable_error(e):
+                return False
+
+            if endpoint.ejected_since is None:
+                logging.warning('The tracker %s is unavailable (%s), sending its requests to the other ones.', endpoint.url, e)
+                endpoint.ejected_since = time.time()
+                endpoint.count_ejections += 1
+                if self.health_checks is None:
+                    self.health_checks = threading.Thread(target=self._run_health_checks)
+                    self.health_checks.daemon = True
+                    self.health_checks.start()
+            return any(other.ejected_since is None for other in self.endpoints)
+
+    def _run_health_checks(self):
+        while not self.stopped.wait(self.HEALTH_CHECK_INTERVAL):
+            for endpoint in self.endpoints:
+                if endpoint.ejected_since is None or not self._check(endpoint):
+                    continue
+                with self.lock:
+                    logging.info('The tracker %s is available again.', endpoint.url)
+                    endpoint.time_ejected += time.time() - endpoint.ejected_since
+                    endpoint.ejected_since = None
+
+    def close(self):
+        """
+        Stop the health checks.
+        """
+        self.stopped.set()
+        if self.health_checks is not None:
+            self.health_checks.join()
+
+    def _check(self, endpoint):
+        """
+        Returns whether the tracker of an endpoint answers a GET request.
+        """
+        url, body, headers = self.client._build_request(
+            config.options.matomo_tracker_endpoint_path, {}, None, endpoint.url, None
+        )
+        try:
+            status, reason, response_headers, result = self.client._send('GET', url, None, headers)
+        except (http.client.HTTPException, urllib.error.URLError, OSError) as e:
+            logging.debug('Health check of the tracker %s failed: %s', endpoint.url, e)
+            return False
+        return not (status == 429 or status >= 502)
+
 class MatomoHttpBase:
     class Error(Exception):
 
-        def __init__(self, message, code = None):
+        def __init__(self, message, code = None, response = None):
             super(MatomoHttpBase.Error, self).__init__(message)
 
             self.code = code
+            # the decoded JSON response of the tracker, if any
+            self.response = response
+
+    class PayloadError(Error):
+        """
+        The request timed out or was too large for the server: its payload
+        should be split rather than sent again.
+        """
+
+    class HitError(Error):
+        """
+        The tracker failed to track some hits of the request: they should be
+        found and rejected rather than sent again.
+        """
 
 
 class MatomoHttpUrllib(MatomoHttpBase):
     """
     Make requests to Matomo.
+
+    Each thread keeps a persistent HTTP/1.1 connection to every server it
+    talks to, and TLS sessions are resumed when a connection has to be opened
+    again. urllib is only used when a proxy is configured.
     """
 
+    MAX_REDIRECTS = 10
+
     class RedirectHandlerWithLogging(urllib.request.HTTPRedirectHandler):
         """
         Special implementation of HTTPRedirectHandler that logs redirects in debug mode
@@ -1613,13 +2328,157 @@ class MatomoHttpUrllib(MatomoHttpBase):
 
             return urllib.request.HTTPRedirectHandler.redirect_request(self, req, fp, code, msg, hdrs, newurl)
 
-    def _call(self, path, args, headers=None, url=None, data=None):
+    class HTTPConnection(http.client.HTTPConnection):
         """
-        Make a request to the Matomo site. It is up to the caller to format
-        arguments, to embed authentication, etc.
+        HTTP connection sending small requests without delay: http.client
+        sends the headers and the body separately, and Nagle's algorithm would
+        hold the body until the server acknowledges the headers.
+        """
+
+        def connect(self):
+            http.client.HTTPConnection.connect(self)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    class HTTPSConnection(http.client.HTTPSConnection):
+        """
+        HTTPS connection resuming the TLS session of a previous connection to
+        the same server, which saves a full handshake.
+        """
+
+        def __init__(self, host, port, timeout, context, sessions):
+            http.client.HTTPSConnection.__init__(self, host, port, timeout=timeout, context=context)
+            self.ssl_context = context
+            self.sessions = sessions
+
+        def connect(self):
+            http.client.HTTPConnection.connect(self)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            server_hostname = self._tunnel_host or self.host
+            kwargs = {'server_hostname': server_hostname}
+            session = self.sessions.get((self.host, self.port))
+            # The session argument is only available since Python 3.6.
+            if session is not None and hasattr(ssl.SSLSocket, 'session'):
+                kwargs['session'] = session
+            self.sock = self.ssl_context.wrap_socket(self.sock, **kwargs)
+
+        def save_session(self):
+            # With TLS 1.3 the session can only be resumed once some data was
+            # received, so this is called after each response.
+            session = getattr(self.sock, 'session', None)
+            if session is not None:
+                self.sessions[(self.host, self.port)] = session
+
+        def close(self):
+            self.save_session()
+            http.client.HTTPSConnection.close(self)
+
+    class Body:
+        """
+        The JSON body of a request encoded ahead of time, see encode_body().
+        """
+        def __init__(self, data, encoding):
+            self.json = json.dumps(data).encode('utf-8')
+            self.encoding = encoding
+            self.compressed = MatomoHttpUrllib._compress(self.json, encoding) if encoding else None
+
+    class StreamedBody:
+        """
+        The JSON body of a request, encoded while it is sent with chunked
+        transfer encoding (see --chunked-requests): the items of the list
+        data[key], the last value of data, are encoded one at a time, and
+        only about CHUNK_SIZE bytes of the body are kept in memory. The body is
+        encoded again each time it is sent.
+        """
+
+        CHUNK_SIZE = 64 * 1024
+
+        def __init__(self, data, key, encoding=None):
+            self.data = data
+            self.key = key
+            self.encoding = encoding
+            # Whether the size of the body is added to the statistics of
+            # --compress-requests, see MatomoHttpUrllib._compress_body.
+            self.count_bytes = False
+
+        def with_encoding(self, encoding):
+            body = MatomoHttpUrllib.StreamedBody(self.data, self.key, encoding)
+            body.count_bytes = True
+            return body
+
+        def iter_chunks(self):
+            """
+            Yield the parts of the (compressed) body, without chunk framing.
+            The uncompressed body is the same as json.dumps(data).
+            """
+            compressor = None
+            if self.encoding == 'gzip':
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            elif self.encoding == 'deflate':
+                compressor = zlib.compressobj(6)
+
+            others = collections.OrderedDict((key, value) for key, value in self.data.items() if key != self.key)
+            parts = [json.dumps(others)[:-1], ', ' if others else '', json.dumps(self.key), ': [']
+            size = sum(len(part) for part in parts)
+            body_size = sent_size = 0
+            for i, item in enumerate(self.data[self.key]):
+                part = (', ' if i else '') + json.dumps(item)
+                parts.append(part)
+                size += len(part)
+                if size >= self.CHUNK_SIZE:
+                    chunk = ''.join(parts).encode('utf-8')
+                    body_size += len(chunk)
+                    if compressor is not None:
+                        chunk = compressor.compress(chunk)
+                    sent_size += len(chunk)
+                    if chunk:
+                        yield chunk
+                    parts = []
+                    size = 0
+
+            parts.append(']}')
+            chunk = ''.join(parts).encode('utf-8')
+            body_size += len(chunk)
+            if compressor is not None:
+                chunk = compressor.compress(chunk) + compressor.flush()
+            sent_size += len(chunk)
+            if self.count_bytes:
+                stats.request_bytes.add(body_size)
+                stats.request_bytes_sent.add(sent_size)
+            yield chunk
+
+        def __iter__(self):
+            for chunk in self.iter_chunks():
+                if chunk:
+                    yield b'%x\r\n' % len(chunk) + chunk + b'\r\n'
+            yield b'0\r\n\r\n'
+
+        def read_all(self):
+            return b''.join(self.iter_chunks())
+
+    def __init__(self, tracker_urls=None):
+        self.local = threading.local()
+        self.ssl_context = None
+        self.ssl_sessions = {}
+        self.opener = None
+        self.proxies = urllib.request.getproxies()
+        self.compression_disabled = False
+        self.chunked_requests_disabled = False
+        # The URL of the Matomo of a --routes route, instead of --url
+        self.url = tracker_urls[0] if tracker_urls else None
+        if tracker_urls is None:
+            tracker_urls = config.options.matomo_tracker_urls
+        # The tracker endpoints, when --url is given several times
+        self.endpoints = None
+        if tracker_urls and len(tracker_urls) > 1:
+            self.endpoints = TrackerEndpoints(self, tracker_urls)
+
+    def _build_request(self, path, args, headers, url, data):
+        """
+        Return the URL, body and headers of a request to the Matomo site.
         """
         if url is None:
-            url = config.options.matomo_url
+            url = self.url or config.options.matomo_url
         headers = headers or {}
 
         if data is None:
@@ -1627,7 +2486,10 @@ class MatomoHttpUrllib(MatomoHttpBase):
             headers['Content-type'] = 'application/x-www-form-urlencoded'
             data = urllib.parse.urlencode(args)
         elif not isinstance(data, str) and headers['Content-type'] == 'application/json':
-            data = json.dumps(data)
+            if isinstance(data, self.StreamedBody):
+                headers['Transfer-Encoding'] = 'chunked'
+            elif not isinstance(data, self.Body):
+                data = json.dumps(data)
 
             if args:
                 path = path + '?' + urllib.parse.urlencode(args)
@@ -1637,13 +2499,6 @@ class MatomoHttpUrllib(MatomoHttpBase):
 
         headers['User-Agent'] = 'Matomo/LogImport'
 
-        try:
-            timeout = config.options.request_timeout
-        except:
-            timeout = None # the config global object may not be created at this point
-
-        request = urllib.request.Request(url + path, data.encode("utf-8"), headers)
-
         # Handle basic auth if auth_user set
         try:
             auth_user = config.options.auth_user
@@ -1654,133 +2509,672 @@ class MatomoHttpUrllib(MatomoHttpBase):
 
         if auth_user is not None:
             base64string = base64.encodebytes('{}:{}'.format(auth_user, auth_password).encode()).decode().replace('\n', '')
-            request.add_header("Authorization", "Basic %s" % base64string)
-
-        # Use non-default SSL context if invalid certificates shall be
-        # accepted.
-        if config.options.accept_invalid_ssl_certificate and \
-                sys.version_info >= (2, 7, 9):
-            ssl_context = ssl.create_default_context()
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-            https_handler_args = {'context': ssl_context}
+            headers['Authorization'] = "Basic %s" % base64string
+
+        if isinstance(data, self.Body):
+            body = data.json
+        elif isinstance(data, self.StreamedBody):
+            body = data
         else:
-            https_handler_args = {}
-        opener = urllib.request.build_opener(
-            self.RedirectHandlerWithLogging(),
-            urllib.request.HTTPSHandler(**https_handler_args))
-        response = opener.open(request, timeout = timeout)
-        encoding = response.info().get_content_charset('utf-8')
-        result = response.read()
-        response.close()
-        return result.decode(encoding)
+            body = data.encode("utf-8")
+        return url + path, body, headers
 
-    def _call_api(self, method, **kwargs):
+    def encode_body(self, data, compress=False, stream=None):
         """
-        Make a request to the Matomo API taking care of authentication, body
-        formatting, etc.
-        """
-        args = {
-            'module' : 'API',
-            'format' : 'json',
-            'method' : method,
-            'filter_limit' : '-1',
-        }
-        # token_auth, by default, is taken from config.
-        token_auth = kwargs.pop('_token_auth', None)
-        if token_auth is None:
-            token_auth = config.options.matomo_token_auth
-        if token_auth:
-            args['token_auth'] = token_auth
+        Encode the JSON data of a request ahead of time, and compress it if
+        compress is True and --compress-requests is used. The result is
+        given as the data of call() or call_async().
 
-        url = kwargs.pop('_url', None)
-        if url is None:
-            url = config.options.matomo_api_url
+        With --chunked-requests, the list data[stream] is instead encoded
+        while the request is sent, see StreamedBody.
+        """
+        if stream is not None and config.options.chunked_requests and not self.chunked_requests_disabled:
+            return self.StreamedBody(data, stream)
 
+        encoding = None
+        if compress and config.options.compress_requests and not self.compression_disabled:
+            encoding = config.options.compress_requests
+        return self.Body(data, encoding)
 
-        if kwargs:
-            args.update(kwargs)
+    def _get_timeout(self):
+        try:
+            return config.options.request_timeout
+        except:
+            return None # the config global object may not be created at this point
+
+    def _get_ssl_context(self):
+        if self.ssl_context is None:
+            self.ssl_context = ssl.create_default_context()
+            # Use non-default SSL context if invalid certificates shall be
+            # accepted.
+            if config.options.accept_invalid_ssl_certificate:
+                self.ssl_context.check_hostname = False
+                self.ssl_context.verify_mode = ssl.CERT_NONE
+        return self.ssl_context
+
+    def _uses_proxy(self, url):
+        parts = urllib.parse.urlsplit(url)
+        return parts.scheme in self.proxies and not urllib.request.proxy_bypass(parts.hostname)
+
+    def _call(self, path, args, headers=None, url=None, data=None, compress=False):
+        """
+        Make a request to the Matomo site. It is up to the caller to format
+        arguments, to embed authentication, etc.
 
-        # Convert lists into appropriate format.
-        # See: https://developer.matomo.org/api-reference/reporting-api#passing-an-array-of-data-as-a-parameter
-        # Warning: we have to pass the parameters in order: foo[0], foo[1], foo[2]
-        # and not foo[1], foo[0], foo[2] (it will break Matomo otherwise.)
-        final_args = []
-        for key, value in args.items():
-            if isinstance(value, (list, tuple)):
-                for index, obj in enumerate(value):
-                    final_args.append(('%s[%d]' % (key, index), obj))
-            else:
-                final_args.append((key, value))
+        If compress is True, the body is compressed as set by
+        --compress-requests.
+        """
+        url, body, headers = self._build_request(path, args, headers, url, data)
+        sent_body, encoding = self._compress_body(body, headers, compress, data)
 
+        try:
+            return self._send_request(url, sent_body, headers)
+        except urllib.error.HTTPError as e:
+            if encoding is None or e.code not in (400, 415):
+                raise
+            code = e.code
 
-#        logging.debug('%s' % final_args)
-#        logging.debug('%s' % url)
+        # The server may not support compressed requests: send the request
+        # again uncompressed, and stop compressing if it succeeds.
+        del headers['Content-Encoding']
+        result = self._send_request(url, body, headers)
+        self._disable_compression(code, encoding)
+        return result
 
-        res = self._call('/', final_args, url=url)
+    async def _call_async(self, connections, path, args, headers=None, url=None, data=None, compress=False):
+        """
+        Same as _call, for the async recorder engine. connections is the dict
+        of AsyncHttpConnection objects the caller keeps between requests.
+        """
+        url, body, headers = self._build_request(path, args, headers, url, data)
+        sent_body, encoding = self._compress_body(body, headers, compress, data)
 
         try:
-            return json.loads(res)
-        except ValueError:
-            raise urllib.error.URLError('Matomo returned an invalid response: ' + res.decode("utf-8") )
+            return await self._send_request_async(connections, url, sent_body, headers)
+        except urllib.error.HTTPError as e:
+            if encoding is None or e.code not in (400, 415):
+                raise
+            code = e.code
+
+        del headers['Content-Encoding']
+        result = await self._send_request_async(connections, url, body, headers)
+        self._disable_compression(code, encoding)
+        return result
 
-    def _call_wrapper(self, func, expected_response, on_failure, *args, **kwargs):
+    def _compress_body(self, body, headers, compress, data=None):
         """
-        Try to make requests to Matomo at most MATOMO_FAILURE_MAX_RETRY times.
+        Compress the body of a request if compress is True and
+        --compress-requests is used, unless data was already compressed by
+        encode_body(). Returns the body to send and its encoding, or None if
+        it is not compressed.
         """
-        errors = 0
-        while True:
-            try:
-                response = func(*args, **kwargs)
-                if expected_response is not None and response != expected_response:
-                    if on_failure is not None:
-                        error_message = on_failure(response, kwargs.get('data'))
-                    else:
-                        error_message = "didn't receive the expected response. Response was %s " % response
-
-                    raise urllib.error.URLError(error_message)
-                return response
-            except (urllib.error.URLError, http.client.HTTPException, ValueError, socket.timeout) as e:
-                logging.info('Error when connecting to Matomo: %s', e)
-
-                code = None
-                if isinstance(e, urllib.error.HTTPError):
-                    # See Python issue 13211.
-                    message = 'HTTP Error %s %s' % (e.code, e.msg)
-                    code = e.code
-                elif isinstance(e, urllib.error.URLError):
-                    message = e.reason
-                else:
-                    message = str(e)
+        if not compress or not config.options.compress_requests:
+            return body, None
+
+        encoding = None
+        if not self.compression_disabled:
+            encoding = config.options.compress_requests
+        if isinstance(body, self.StreamedBody):
+            # The body is compressed, and its size counted, while it is sent.
+            if encoding is not None:
+                headers['Content-Encoding'] = encoding
+            return body.with_encoding(encoding), encoding
+
+        sent_body = body
+        if not self.compression_disabled:
+            encoding = config.options.compress_requests
+            if isinstance(data, self.Body) and data.encoding == encoding:
+                sent_body = data.compressed
+            else:
+                sent_body = self._compress(body, encoding)
+            headers['Content-Encoding'] = encoding
+        stats.request_bytes.add(len(body))
+        stats.request_bytes_sent.add(len(sent_body))
+        return sent_body, encoding
+
+    @staticmethod
+    def _compress(body, encoding):
+        if encoding == 'gzip':
+            return gzip.compress(body, compresslevel=6)
+        return zlib.compress(body, 6)
+
+    def _disable_compression(self, code, encoding):
+        if not self.compression_disabled:
+            self.compression_disabled = True
+            stats.compression_disabled_reason = 'Matomo answered HTTP %d to a %s compressed request.' % (code, encoding)
+            logging.warning('%s Sending uncompressed requests from now on.', stats.compression_disabled_reason)
+
+    def _disable_chunked_requests(self, body, headers):
+        """
+        Return the body and headers to send a streamed request again with a
+        Content-Length, as the server doesn't accept chunked requests.
+        """
+        if not self.chunked_requests_disabled:
+            self.chunked_requests_disabled = True
+            logging.warning('Matomo answered HTTP 411 to a chunked request. Sending requests with a Content-Length from now on.')
+        headers = dict((name, value) for name, value in headers.items() if name.lower() != 'transfer-encoding')
+        return body.read_all(), headers
+
+    def _send_request(self, url, body, headers):
+        if self.proxies and self._uses_proxy(url):
+            if isinstance(body, self.StreamedBody):
+                body, headers = body.read_all(), dict(
+                    (name, value) for name, value in headers.items() if name.lower() != 'transfer-encoding'
+                )
+            return self._call_urllib(url, body, headers)
+
+        method = 'POST'
+        for redirects in range(self.MAX_REDIRECTS + 1):
+            status, reason, response_headers, result = self._send(method, url, body, headers)
+            if status == 411 and isinstance(body, self.StreamedBody):
+                body, headers = self._disable_chunked_requests(body, headers)
+                status, reason, response_headers, result = self._send(method, url, body, headers)
+            redirect = self._get_redirect(url, headers, status, response_headers)
+            if redirect is None:
+                return self._get_response_content(url, status, reason, response_headers, result)
+            url, headers = redirect
+            method = 'GET'
+            body = None
+
+        raise urllib.error.HTTPError(url, status, 'too many redirections', response_headers, io.BytesIO(result))
+
+    async def _send_request_async(self, connections, url, body, headers):
+        method = 'POST'
+        for redirects in range(self.MAX_REDIRECTS + 1):
+            status, reason, response_headers, result = await self._send_async(connections, method, url, body, headers)
+            if status == 411 and isinstance(body, self.StreamedBody):
+                body, headers = self._disable_chunked_requests(body, headers)
+                status, reason, response_headers, result = await self._send_async(connections, method, url, body, headers)
+            redirect = self._get_redirect(url, headers, status, response_headers)
+            if redirect is None:
+                return self._get_response_content(url, status, reason, response_headers, result)
+            url, headers = redirect
+            method = 'GET'
+            body = None
+
+        raise urllib.error.HTTPError(url, status, 'too many redirections', response_headers, io.BytesIO(result))
+
+    @staticmethod
+    def _get_redirect(url, headers, status, response_headers):
+        """
+        Return the URL and headers of the GET request following a redirection
+        (like urllib does), or None if the response is not a redirection.
+        """
+        location = response_headers.get('Location')
+        if status not in (301, 302, 303) or not location:
+            return None
 
-                # decorate message w/ HTTP response, if it can be retrieved
-                if hasattr(e, 'read'):
-                    message = message + ", response: " + e.read().decode()
+        newurl = urllib.parse.urljoin(url, location)
+        logging.debug("Request redirected (code: %s) to '%s'" % (status, newurl))
+        headers = dict(
+            (name, value) for name, value in headers.items()
+            if name.lower() not in ('content-type', 'content-length', 'content-encoding', 'transfer-encoding')
+        )
+        return newurl, headers
 
-                try:
-                    delay_after_failure = config.options.delay_after_failure
-                    max_attempts = config.options.max_attempts
-                except NameError:
-                    delay_after_failure = MATOMO_DEFAULT_DELAY_AFTER_FAILURE
-                    max_attempts = MATOMO_DEFAULT_MAX_ATTEMPTS
+    @staticmethod
+    def _get_response_content(url, status, reason, response_headers, result):
+        if not 200 <= status < 300:
+            raise urllib.error.HTTPError(url, status, reason, response_headers, io.BytesIO(result))
+
+        encoding = response_headers.get_content_charset('utf-8')
+        return result.decode(encoding)
+
+    def _send(self, method, url, body, headers):
+        """
+        Send a request on the persistent connection of the current thread to
+        the server, and return the status, reason, headers and content of the
+        response.
+        """
+        parts = urllib.parse.urlsplit(url)
+        selector = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+
+        key = (parts.scheme, parts.netloc)
+        while True:
+            connection = connections.get(key)
+            if connection is None:
+                connection = connections[key] = self._connect(parts)
+            reused = connection.sock is not None
+
+            try:
+                connection.request(method, selector, body, headers)
+                response = connection.getresponse()
+                result = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                del connections[key]
+
+                if reused and isinstance(e, ConnectionError):
+                    # The server closed the idle connection, send the request
+                    # again on a new one.
+                    logging.debug('Connection to %s was closed by the server, reconnecting.', parts.netloc)
+                    continue
+                if isinstance(e, (http.client.HTTPException, socket.timeout)):
+                    raise
+                raise urllib.error.URLError(e)
+
+            if isinstance(connection, self.HTTPSConnection):
+                connection.save_session()
+            return response.status, response.reason, response.msg, result
+
+    async def _send_async(self, connections, method, url, body, headers):
+        parts = urllib.parse.urlsplit(url)
+        selector = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+        key = (parts.scheme, parts.netloc)
+        connection = connections.get(key)
+        if connection is None:
+            ssl_context = self._get_ssl_context() if parts.scheme == 'https' else None
+            connection = connections[key] = AsyncHttpConnection(parts, ssl_context)
+
+        try:
+            return await asyncio.wait_for(connection.request(method, selector, body, headers), self._get_timeout())
+        except asyncio.TimeoutError:
+            connection.close()
+            raise socket.timeout('timed out')
+
+    def _connect(self, parts):
+        if parts.scheme == 'https':
+            return self.HTTPSConnection(
+                parts.hostname, parts.port, self._get_timeout(), self._get_ssl_context(), self.ssl_sessions
+            )
+        return self.HTTPConnection(parts.hostname, parts.port, timeout=self._get_timeout())
+
+    def _call_urllib(self, url, body, headers):
+        if self.opener is None:
+            self.opener = urllib.request.build_opener(
+                self.RedirectHandlerWithLogging(),
+                urllib.request.HTTPSHandler(context=self._get_ssl_context()))
+
+        request = urllib.request.Request(url, body, headers)
+        response = self.opener.open(request, timeout = self._get_timeout())
+        encoding = response.info().get_content_charset('utf-8')
+        result = response.read()
+        response.close()
+        return result.decode(encoding)
+
+    def _call_api(self, method, **kwargs):
+        """
+        Make a request to the Matomo API taking care of authentication, body
+        formatting, etc.
+        """
+        args = {
+            'module' : 'API',
+            'format' : 'json',
+            'method' : method,
+            'filter_limit' : '-1',
+        }
+        # token_auth, by default, is taken from config.
+        token_auth = kwargs.pop('_token_auth', None)
+        if token_auth is None:
+            token_auth = config.options.matomo_token_auth
+        if token_auth:
+            args['token_auth'] = token_auth
+
+        url = kwargs.pop('_url', None)
+        if url is None:
+            url = config.options.matomo_api_url
+
+
+        if kwargs:
+            args.update(kwargs)
+
+        # Convert lists into appropriate format.
+        # See: https://developer.matomo.org/api-reference/reporting-api#passing-an-array-of-data-as-a-parameter
+        # Warning: we have to pass the parameters in order: foo[0], foo[1], foo[2]
+        # and not foo[1], foo[0], foo[2] (it will break Matomo otherwise.)
+        final_args = []
+        for key, value in args.items():
+            if isinstance(value, (list, tuple)):
+                for index, obj in enumerate(value):
+                    final_args.append(('%s[%d]' % (key, index), obj))
+            else:
+                final_args.append((key, value))
+
+
+#        logging.debug('%s' % final_args)
+#        logging.debug('%s' % url)
+
+        res = self._call('/', final_args, url=url)
+
+        try:
+            return json.loads(res)
+        except ValueError:
+            raise urllib.error.URLError('Matomo returned an invalid response: ' + res.decode("utf-8") )
+
+    # Errors after which a request is tried again.
+    RETRIED_ERRORS = (urllib.error.URLError, http.client.HTTPException, ValueError, socket.timeout)
+
+    def _call_wrapper(self, func, expected_response, on_failure, *args, raise_payload_errors=False,
+                      raise_hit_errors=False, route=None, hit_count=0, **kwargs):
+        """
+        Try to make requests to Matomo at most MATOMO_FAILURE_MAX_RETRY times.
+
+        If raise_payload_errors is True, MatomoHttpBase.PayloadError is raised
+        without trying again when the request times out or is too large. If
+        raise_hit_errors is True, MatomoHttpBase.HitError is raised without
+        trying again when the tracker fails to track some hits because they
+        are invalid.
+
+        With several tracker endpoints, tracking requests are sent to the
+        endpoint of their route (see TrackerEndpoints).
+        """
+        errors = 0
+        while True:
+            endpoint = self._get_endpoint(route, kwargs)
+            time_start = time.time()
+            try:
+                response = func(*args, **kwargs)
+                response = self._check_response(response, expected_response, on_failure, kwargs.get('data'))
+            except self.RETRIED_ERRORS as e:
+                # A timeout of an endpoint which hangs is not due to the
+                # payload: the request is sent to another endpoint first.
+                if endpoint is not None and self.endpoints.on_failure(endpoint, e):
+                    continue
+                self._check_error(e, raise_payload_errors)
+                if raise_hit_errors:
+                    self._check_hit_error(e)
+                errors += 1
+                delay = self._on_call_error(e, errors)
+                time.sleep(delay)
+                continue
+            if endpoint is not None:
+                self.endpoints.on_success(endpoint, hit_count, time.time() - time_start)
+            return response
 
+    async def _call_wrapper_async(self, func, expected_response, on_failure, *args, raise_payload_errors=False,
+                                  raise_hit_errors=False, route=None, hit_count=0, **kwargs):
+        """
+        Same as _call_wrapper, for coroutines.
+        """
+        errors = 0
+        while True:
+            endpoint = self._get_endpoint(route, kwargs)
+            time_start = time.time()
+            try:
+                response = await func(*args, **kwargs)
+                response = self._check_response(response, expected_response, on_failure, kwargs.get('data'))
+            except self.RETRIED_ERRORS as e:
+                # A timeout of an endpoint which hangs is not due to the
+                # payload: the request is sent to another endpoint first.
+                if endpoint is not None and self.endpoints.on_failure(endpoint, e):
+                    continue
+                self._check_error(e, raise_payload_errors)
+                if raise_hit_errors:
+                    self._check_hit_error(e)
                 errors += 1
-                if errors == max_attempts:
-                    logging.info("Max number of attempts reached, server is unreachable!")
+                delay = self._on_call_error(e, errors)
+                await asyncio.sleep(delay)
+                continue
+            if endpoint is not None:
+                self.endpoints.on_success(endpoint, hit_count, time.time() - time_start)
+            return response
 
-                    raise MatomoHttpBase.Error(message, code)
-                else:
-                    logging.info("Retrying request, attempt number %d" % (errors + 1))
+    def _get_endpoint(self, route, kwargs):
+        """
+        Return the tracker endpoint of a route, and set the URL of the
+        request to it.
+        """
+        if route is None or self.endpoints is None:
+            return None
+        endpoint = self.endpoints.get(route)
+        kwargs['url'] = endpoint.url
+        return endpoint
+
+    def _check_error(self, e, raise_payload_errors):
+        """
+        Raise the MatomoHttpBase.PayloadError that the failed request calls
+        for, if any.
+        """
+        if raise_payload_errors and self._is_payload_error(e):
+            raise MatomoHttpBase.PayloadError(str(e), getattr(e, 'code', None))
+
+    def _check_hit_error(self, e):
+        """
+        Raise MatomoHttpBase.HitError if the tracker failed to track some hits
+        of a request because they are invalid. Other failures, eg. a database
+        outage, are not due to the hits: they are tried again, and stop the
+        import after the last attempt.
+        """
+        if isinstance(e, urllib.error.HTTPError) and e.code == 400:
+            # The tracker answers with a JSON error when a hit is invalid, as
+            # opposed to a web server or PHP error.
+            try:
+                response = json.loads(self._get_error_content(e))
+            except ValueError:
+                return
+            if isinstance(response, dict) and response.get('status') == 'error':
+                raise MatomoHttpBase.HitError(response.get('message') or str(e), e.code, response)
+
+    @staticmethod
+    def _is_payload_error(e):
+        # 504 is returned by proxies when Matomo takes too long to answer.
+        return isinstance(e, socket.timeout) or (isinstance(e, urllib.error.HTTPError) and e.code in (413, 504))
+
+    @staticmethod
+    def _get_error_content(e):
+        """
+        Return the content of an HTTP error response, which can only be read
+        once.
+        """
+        if not hasattr(e, 'content'):
+            e.content = e.read().decode('utf-8', 'replace')
+        return e.content
+
+    def _check_response(self, response, expected_response, on_failure, data):
+        if expected_response is not None and response != expected_response:
+            if on_failure is not None:
+                error_message = on_failure(response, data)
+            else:
+                error_message = "didn't receive the expected response. Response was %s " % response
+
+            raise urllib.error.URLError(error_message)
+        return response
+
+    def _on_call_error(self, e, errors):
+        """
+        Log the error of a failed request. Returns how long to wait before
+        trying again, or raises MatomoHttpBase.Error after the last attempt.
+        """
+        logging.info('Error when connecting to Matomo: %s', e)
+
+        code = None
+        if isinstance(e, urllib.error.HTTPError):
+            # See Python issue 13211.
+            message = 'HTTP Error %s %s' % (e.code, e.msg)
+            code = e.code
+        elif isinstance(e, urllib.error.URLError):
+            message = e.reason
+        else:
+            message = str(e)
+
+        # decorate message w/ HTTP response, if it can be retrieved
+        if hasattr(e, 'read'):
+            message = message + ", response: " + self._get_error_content(e)
+
+        try:
+            delay_after_failure = config.options.delay_after_failure
+            max_delay_after_failure = config.options.max_delay_after_failure
+            max_attempts = config.options.max_attempts
+        except NameError:
+            delay_after_failure = MATOMO_DEFAULT_DELAY_AFTER_FAILURE
+            max_delay_after_failure = MATOMO_DEFAULT_MAX_DELAY_AFTER_FAILURE
+            max_attempts = MATOMO_DEFAULT_MAX_ATTEMPTS
+
+        if errors == max_attempts:
+            logging.info("Max number of attempts reached, server is unreachable!")
+
+            raise MatomoHttpBase.Error(message, code)
+        else:
+            logging.info("Retrying request, attempt number %d" % (errors + 1))
+
+            # Exponential backoff, with jitter so that recorders which failed
+            # together don't retry together.
+            delay = min(delay_after_failure * 2 ** (errors - 1), max_delay_after_failure)
+            delay = random.uniform(delay / 2.0, delay)
+
+            retry_after = self._get_retry_after(e)
+            if retry_after is not None:
+                delay = min(retry_after, max_delay_after_failure)
+            return delay
+
+    @staticmethod
+    def _get_retry_after(e):
+        """
+        Return the number of seconds to wait given by the Retry-After header
+        of a 429 or 503 response, if any.
+        """
+        if not isinstance(e, urllib.error.HTTPError) or e.code not in (429, 503) or e.headers is None:
+            return None
+
+        value = e.headers.get('Retry-After')
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return int(value)
 
-                    time.sleep(delay_after_failure)
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0, email.utils.mktime_tz(date) - time.time())
 
-    def call(self, path, args, expected_content=None, headers=None, data=None, on_failure=None):
+    def call(self, path, args, expected_content=None, headers=None, data=None, on_failure=None, compress=False,
+             raise_payload_errors=False, raise_hit_errors=False, route=None, hit_count=0):
         return self._call_wrapper(self._call, expected_content, on_failure, path, args, headers,
-                                    data=data)
+                                    data=data, compress=compress, raise_payload_errors=raise_payload_errors,
+                                    raise_hit_errors=raise_hit_errors, route=route, hit_count=hit_count)
 
     def call_api(self, method, **kwargs):
         return self._call_wrapper(self._call_api, None, None, method, **kwargs)
 
+    async def call_async(self, connections, path, args, expected_content=None, headers=None, data=None,
+                         on_failure=None, compress=False, raise_payload_errors=False, raise_hit_errors=False,
+                         route=None, hit_count=0):
+        return await self._call_wrapper_async(self._call_async, expected_content, on_failure, connections, path,
+                                              args, headers, data=data, compress=compress,
+                                              raise_payload_errors=raise_payload_errors,
+                                              raise_hit_errors=raise_hit_errors, route=route, hit_count=hit_count)
+
+class AsyncHttpConnection:
+    """
+    A persistent HTTP/1.1 connection using asyncio streams, used by the async
+    recorder engine. Like the connections of MatomoHttpUrllib, a request sent
+    on a connection the server closed is sent again on a new one.
+    """
+
+    def __init__(self, parts, ssl_context):
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.netloc = parts.netloc
+        self.ssl_context = ssl_context
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, selector, body, headers):
+        """
+        Send a request, and return the status, reason, headers and content of
+        the response.
+        """
+        while True:
+            reused = self.writer is not None
+            try:
+                if self.writer is None:
+                    self.reader, self.writer = await asyncio.open_connection(
+                        self.host, self.port, ssl=self.ssl_context
+                    )
+                return await self._request(method, selector, body, headers)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                self.close()
+                if reused:
+                    logging.debug('Connection to %s was closed by the server, reconnecting.', self.netloc)
+                    continue
+                raise urllib.error.URLError(e)
+            except http.client.HTTPException:
+                self.close()
+                raise
+            except OSError as e:
+                self.close()
+                raise urllib.error.URLError(e)
+            except:
+                # eg, cancelled on timeout: the state of the connection is unknown.
+                self.close()
+                raise
+
+    async def _request(self, method, selector, body, headers):
+        lines = ['%s %s HTTP/1.1' % (method, selector), 'Host: %s' % self.netloc, 'Accept-Encoding: identity']
+        lines.extend('%s: %s' % (name, value) for name, value in headers.items())
+        if isinstance(body, bytes):
+            lines.append('Content-Length: %d' % len(body))
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if isinstance(body, bytes):
+            if body:
+                self.writer.write(body)
+        elif body is not None:
+            # A streamed body, see MatomoHttpUrllib.StreamedBody
+            for chunk in body:
+                self.writer.write(chunk)
+                await self.writer.drain()
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError('the server closed the connection')
+        try:
+            version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(None, 2) + [''])[:3]
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(status_line)
+
+        header_lines = []
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            header_lines.append(line)
+        response_headers = email.parser.Parser(_class=http.client.HTTPMessage).parsestr(
+            b''.join(header_lines).decode('iso-8859-1')
+        )
+
+        will_close = (
+            response_headers.get('Connection', '').lower() == 'close'
+            or (version == 'HTTP/1.0' and response_headers.get('Connection', '').lower() != 'keep-alive')
+        )
+        if response_headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            content = await self._read_chunked()
+        elif 'Content-Length' in response_headers:
+            content = await self.reader.readexactly(int(response_headers['Content-Length']))
+        elif status in (204, 304) or method == 'HEAD':
+            content = b''
+        else:
+            content = await self.reader.read()
+            will_close = True
+
+        if will_close:
+            self.close()
+        return status, reason, response_headers, content
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b';')[0].strip(), 16)
+            if size == 0:
+                break
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readline()
+
+        # Skip the trailer.
+        while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        return b''.join(chunks)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
 ##
 ## Resolvers.
 ##
@@ -1792,17 +3186,19 @@ class StaticResolver:
     Always return the same site ID, specified in the configuration.
     """
 
-    def __init__(self, site_id):
+    def __init__(self, site_id, main_url=None, api_url=None, token_auth=None):
         self.site_id = site_id
-        # Go get the main URL
-        site = matomo.call_api(
-            'SitesManager.getSiteFromId', idSite=self.site_id
-        )
-        if site.get('result') == 'error':
-            fatal_error(
-                "cannot get the main URL of this site: %s" % site.get('message')
+        if main_url is None:
+            # Go get the main URL
+            site = matomo.call_api(
+                'SitesManager.getSiteFromId', idSite=self.site_id, _url=api_url, _token_auth=token_auth
             )
-        self._main_url = site['main_url']
+            if site.get('result') == 'error':
+                fatal_error(
+                    "cannot get the main URL of this site: %s" % site.get('message')
+                )
+            main_url = site['main_url']
+        self._main_url = main_url
         stats.matomo_sites.add(self.site_id)
 
     def resolve(self, hit):
@@ -1818,14 +3214,20 @@ class DynamicResolver:
 
     _add_site_lock = threading.Lock()
 
-    def __init__(self):
+    def __init__(self, api_url=None, token_auth=None):
         self._cache = {}
+        # The Matomo of a --routes route, instead of --url
+        self._api_url = api_url
+        self._token_auth = token_auth
         if config.options.replay_tracking:
             # get existing sites
-            self._cache['sites'] = matomo.call_api('SitesManager.getAllSites')
+            self._cache['sites'] = self._call_api('SitesManager.getAllSites')
+
+    def _call_api(self, method, **kwargs):
+        return matomo.call_api(method, _url=self._api_url, _token_auth=self._token_auth, **kwargs)
 
     def _get_site_id_from_hit_host(self, hit):
-        return matomo.call_api(
+        return self._call_api(
             'SitesManager.getSitesIdFromSiteUrl',
             url=hit.host,
         )
@@ -1850,7 +3252,7 @@ class DynamicResolver:
                     # Let's just return a fake ID.
                     return 0
                 logging.debug('Creating a Matomo site for hostname %s', hit.host)
-                result = matomo.call_api(
+                result = self._call_api(
                     'SitesManager.addSite',
                     siteName=hit.host,
                     urls=[main_url],
@@ -1932,119 +3334,1985 @@ class DynamicResolver:
                 "specify the Matomo site ID with the --idsite argument"
             )
 
-class Recorder:
+class Checkpoint:
     """
-    A Recorder fetches hits from the Queue and inserts them into Matomo using
-    the API.
+    Keeps track, for each log file, of the position up to which all hits were
+    recorded, and saves it in a file so an interrupted import can be resumed
+    from there.
+
+    Positions are byte offsets in the uncompressed data (see LogFile). They
+    are saved with the inode and size of the file and a hash of its first
+    bytes (see Ledger), so that the position of a file that was rotated
+    since is not used for the new file of the same name.
     """
 
-    recorders = []
+    SAVE_INTERVAL = 1 # seconds
+    # Size of the first bytes of a file whose hash identifies it.
+    HEAD_SIZE = 4096
 
-    def __init__(self):
-        self.queue = queue.Queue(maxsize=2)
+    class Batch:
+        """
+        The hits of a log file that were handed to the recorders at once.
+        """
+        def __init__(self):
+            self.remaining = 0
+            self.offset = None
+            self.lineno = None
+
+    def __init__(self, path):
+        self.path = path
+        # filename => {'offset': ..., 'lineno': ..., 'inode': ..., 'size': ...,
+        # 'head': ..., 'head_size': ...}
+        self.positions = {}
+        # filename => the identity of the file, see _get_identity
+        self.identities = {}
+        # filename => deque of Batch objects, in the order they were added
+        self.pending_batches = {}
+        self.lock = threading.RLock()
+        self.last_save = 0
+        # Parse workers inherit this object, but only the main process knows
+        # which hits were recorded.
+        self.pid = os.getpid()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            logging.info('Checkpoint file %s does not exist yet, importing log files from the beginning.', self.path)
+            return
 
-        # if bulk tracking disabled, make sure we can store hits outside of the Queue
-        if not config.options.use_bulk_tracking:
-            self.unrecorded_hits = []
+        try:
+            with open(self.path) as file:
+                self.positions = json.load(file)['files']
+        except (IOError, OSError, ValueError, KeyError) as e:
+            fatal_error('cannot read the checkpoint file %s: %s' % (self.path, e))
 
-    @classmethod
-    def launch(cls, recorder_count):
+    def get_position(self, filename):
         """
-        Launch a bunch of Recorder objects in a separate thread.
+        Return the (offset, lineno) tuple to resume parsing filename at, or
+        None if nothing was recorded for this file, or for another file of
+        the same name.
         """
-        for i in range(recorder_count):
-            recorder = Recorder()
-            cls.recorders.append(recorder)
+        position = self.positions.get(os.path.abspath(filename))
+        if position is None:
+            return None
+        if 'head' in position and not self._is_same_file(filename, position):
+            logging.info('%s changed since the checkpoint was saved, importing it from the beginning.', filename)
+            return None
+        return (position['offset'], position['lineno'])
 
-            run = recorder._run_bulk if config.options.use_bulk_tracking else recorder._run_single
-            t = threading.Thread(target=run)
+    @staticmethod
+    def _is_same_file(filename, position):
+        try:
+            stat = os.stat(filename)
+            if [stat.st_dev, stat.st_ino] == position['inode'] and stat.st_size >= position['size']:
+                # The same file, which may have grown since.
+                return True
+            # Another file, eg. renamed or compressed by logrotate, with the
+            # same content.
+            head = Ledger._read(filename, 0, position['head_size'])
+        except (IOError, OSError, EOFError):
+            return False
+        return len(head) == position['head_size'] and Ledger._hash(head) == position['head']
 
-            t.daemon = True
-            t.start()
-            logging.debug('Launched recorder')
+    def _get_identity(self, filename):
+        """
+        Return the inode, size and hash of the first bytes of a file. The hash
+        is only computed again once the file was replaced, or if it was too
+        small to have HEAD_SIZE bytes.
+        """
+        stat = os.stat(filename)
+        inode = [stat.st_dev, stat.st_ino]
+        identity = self.identities.get(filename)
+        if identity is None or identity['inode'] != inode or identity['head_size'] < self.HEAD_SIZE:
+            head = Ledger._read(filename, 0, self.HEAD_SIZE)
+            identity = self.identities[filename] = {
+                'inode': inode,
+                'head': Ledger._hash(head),
+                'head_size': len(head),
+            }
+        identity = dict(identity)
+        identity['size'] = stat.st_size
+        return identity
 
-    @classmethod
-    def add_hits(cls, all_hits):
+    def add_batch(self, hits):
         """
-        Add a set of hits to the recorders queue.
+        Start tracking hits that are about to be handed to the recorders.
         """
-        # Organize hits so that one client IP will always use the same queue.
-        # We have to do this so visits from the same IP will be added in the right order.
-        hits_by_client = [[] for r in cls.recorders]
-        for hit in all_hits:
-            hits_by_client[hit.get_visitor_id_hash() % len(cls.recorders)].append(hit)
+        batches = {}
+        for hit in hits:
+            if hit.offset is None:
+                # eg, read from stdin
+                continue
 
-        for i, recorder in enumerate(cls.recorders):
-            recorder.queue.put(hits_by_client[i])
+            batch = batches.get(hit.filename)
+            if batch is None:
+                batch = batches[hit.filename] = self.Batch()
+            batch.remaining += 1
+            batch.offset = hit.offset
+            batch.lineno = hit.lineno + 1
+            hit.checkpoint_batch = batch
 
-    @classmethod
-    def wait_empty(cls):
+        with self.lock:
+            for filename, batch in batches.items():
+                filename = os.path.abspath(filename)
+                self.pending_batches.setdefault(filename, collections.deque()).append(batch)
+
+    def acknowledge(self, hits):
         """
-        Wait until all recorders have an empty queue.
+        Called by the recorders once hits have been recorded. The position of a
+        file moves forward once all the hits of its oldest batches are recorded.
         """
-        for recorder in cls.recorders:
-            recorder._wait_empty()
+        with self.lock:
+            for hit in hits:
+                batch = getattr(hit, 'checkpoint_batch', None)
+                if batch is not None:
+                    batch.remaining -= 1
+
+            changed = False
+            for filename, batches in self.pending_batches.items():
+                position = None
+                while batches and batches[0].remaining == 0:
+                    batch = batches.popleft()
+                    position = {'offset': batch.offset, 'lineno': batch.lineno}
+                if position is None:
+                    continue
+                try:
+                    position.update(self._get_identity(filename))
+                except (IOError, OSError, EOFError):
+                    # Removed since: the position can't be used anyway.
+                    pass
+                self.positions[filename] = position
+                changed = True
 
-    def _run_bulk(self):
-        while True:
+            if changed and time.time() - self.last_save >= self.SAVE_INTERVAL:
+                self.save()
+
+    def save(self):
+        if os.getpid() != self.pid:
+            return
+
+        with self.lock:
+            tmp_path = self.path + '.tmp'
             try:
-                hits = self.queue.get()
-            except:
-                # TODO: we should log something here, however when this happens, logging.etc will throw
-                return
+                with open(tmp_path, 'w') as file:
+                    json.dump({'files': self.positions}, file, indent=4, sort_keys=True)
+                os.replace(tmp_path, self.path)
+            except (IOError, OSError) as e:
+                logging.error('Cannot save the checkpoint file %s: %s', self.path, e)
+            self.last_save = time.time()
+
+class Ledger:
+    """
+    Remembers the content of imported log files, identified by a hash of their
+    first and last imported bytes, so that log files are not imported again
+    after being renamed or compressed by logrotate, and that only the new lines
+    of log files that grew since are imported.
+    """
 
-            if len(hits) > 0:
-                try:
-                    self._record_hits(hits)
-                except MatomoHttpBase.Error as e:
-                    fatal_error(e, hits[0].filename, hits[0].lineno) # approximate location of error
-            self.queue.task_done()
+    BLOCK_SIZE = 4096
+    MAX_ENTRIES = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        # filename => entry matching the content of the file
+        self.matches = {}
+        # filename => (offset, lineno) to start parsing the file at
+        self.start_positions = {}
+        # filename => (offset, lineno, last line) where parsing ended
+        self.end_positions = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
 
-    def _run_single(self):
-        while True:
-            if config.options.force_one_action_interval != False:
-                time.sleep(config.options.force_one_action_interval)
+        try:
+            with open(self.path) as file:
+                self.entries = json.load(file)['entries']
+        except (IOError, OSError, ValueError, KeyError) as e:
+            fatal_error('cannot read the ledger file %s: %s' % (self.path, e))
 
-            if len(self.unrecorded_hits) > 0:
-                hit = self.unrecorded_hits.pop(0)
+    @staticmethod
+    def _hash(data):
+        return hashlib.sha1(data).hexdigest()
 
-                try:
-                    self._record_hits([hit])
-                except MatomoHttpBase.Error as e:
-                    fatal_error(e, hit.filename, hit.lineno)
-            else:
-                self.unrecorded_hits = self.queue.get()
-                self.queue.task_done()
+    @staticmethod
+    def _get_identity(filename):
+        stat = os.stat(filename)
+        return [stat.st_dev, stat.st_ino, stat.st_size]
 
-    def _wait_empty(self):
+    @staticmethod
+    def _read(filename, offset, size):
         """
-        Wait until the queue is empty.
+        Read uncompressed data of a (possibly compressed) log file.
         """
-        while True:
-            if self.queue.empty():
-                # We still have to wait for the last queue item being processed
-                # (queue.empty() returns True before queue.task_done() is
-                # called).
-                self.queue.join()
-                return
-            time.sleep(1)
+        if filename.endswith('.bz2'):
+            open_func = bz2.open
+        elif filename.endswith('.gz'):
+            open_func = gzip.open
+        else:
+            open_func = open
+
+        with open_func(filename, 'rb') as file:
+            file.seek(offset)
+            return file.read(size)
+
+    def check(self, filename):
+        """
+        Return True if the file contains lines that were not imported yet. If
+        the beginning of the file was already imported, remember where to
+        resume.
+        """
+        try:
+            identity = self._get_identity(filename)
+            head = self._read(filename, 0, self.BLOCK_SIZE)
+        except (IOError, OSError, EOFError):
+            # The parser will report the error.
+            return True
+
+        filename = os.path.abspath(filename)
+        for entry in reversed(self.entries):
+            if len(head) < entry['head_size'] or self._hash(head[:entry['head_size']]) != entry['head']:
+                continue
+
+            if identity in entry['files']:
+                # The very same file, which did not change since.
+                more_content = False
+            else:
+                start = entry['offset'] - entry['tail_size']
+                try:
+                    tail = self._read(filename, start, entry['tail_size'] + 1)
+                except (IOError, OSError, EOFError):
+                    continue
+                if self._hash(tail[:entry['tail_size']]) != entry['tail']:
+                    continue
+                more_content = len(tail) > entry['tail_size']
+
+            self.matches[filename] = entry
+            self.start_positions[filename] = (entry['offset'], entry['lineno'])
+            if not more_content:
+                logging.info('Skipping %s: its content was already imported.', filename)
+                self.end_positions[filename] = (entry['offset'], entry['lineno'], None)
+                return False
+
+            logging.info('%s was already imported up to line %d, importing the new lines only.', filename, entry['lineno'])
+            return True
+
+        return True
+
+    def get_start_position(self, filename):
+        return self.start_positions.get(os.path.abspath(filename))
+
+    def record(self, filename, end_position):
+        """
+        Remember how far a file was parsed. end_position is the
+        (offset, lineno, last line) tuple returned by Parser.parse.
+        """
+        filename = os.path.abspath(filename)
+        previous = self.end_positions.get(filename)
+        if previous is None or previous[0] < end_position[0]:
+            self.end_positions[filename] = end_position
+
+    def save(self):
+        """
+        Update the entries of all parsed files and save the ledger. Must only
+        be called once all the hits have been recorded.
+        """
+        for filename, (offset, lineno, last_line) in self.end_positions.items():
+            entry = self.matches.get(filename)
+            if entry is None:
+                if not last_line:
+                    # Nothing was parsed.
+                    continue
+                entry = {'files': []}
+                self.entries.append(entry)
+            else:
+                # Move the entry to the end, which is searched first.
+                self.entries.remove(entry)
+                self.entries.append(entry)
+
+            try:
+                identity = self._get_identity(filename)
+                head = self._read(filename, 0, min(offset, self.BLOCK_SIZE))
+            except (IOError, OSError, EOFError) as e:
+                logging.error('Cannot add %s to the ledger: %s', filename, e)
+                self.entries.remove(entry)
+                continue
+
+            if last_line:
+                entry.update({
+                    'head': self._hash(head),
+                    'head_size': len(head),
+                    'tail': self._hash(last_line),
+                    'tail_size': len(last_line),
+                    'offset': offset,
+                    'lineno': lineno,
+                })
+
+            # A plain file bigger than what was parsed got new lines in the
+            # meantime, it can only be identified by its content.
+            is_compressed = filename.endswith('.bz2') or filename.endswith('.gz')
+            if (is_compressed or identity[2] == entry['offset']) and identity not in entry['files']:
+                entry['files'].append(identity)
+            entry['time'] = time.time()
+
+        self.entries = self.entries[-self.MAX_ENTRIES:]
+
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as file:
+                json.dump({'entries': self.entries}, file, indent=4, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            logging.error('Cannot save the ledger file %s: %s', self.path, e)
+
+class Route:
+    """
+    A destination of the --routes file: a Matomo server, with its own token
+    and recorders, where the hits of some hosts or sites are sent.
+    """
+
+    # Whether all the hits are sent to the route, see Mirror
+    mirror = False
+
+    def __init__(self, name, urls, token_auth, hosts, site_ids, site_id, recorder_count):
+        self.name = name
+        self.urls = urls
+        self.token_auth = token_auth
+        self.hosts = hosts
+        self.site_ids = site_ids
+        self.site_id = site_id
+        self.recorder_count = recorder_count
+
+        # Set by Recorder.launch: the client of the Matomo server, the
+        # resolver of the site of hits routed by host, and the Recorder
+        # class whose recorders send the hits.
+        self.matomo = None
+        self.resolver = None
+        self.recorder = None
+        self.count_lines_recorded = Statistics.Counter()
+        self.count_lines_rejected = Statistics.Counter()
+
+    def create_resolver(self):
+        """
+        Return the resolver of the site of the hits routed by host, which are
+        looked up in the Matomo of the route. Hits routed by site ID keep the
+        site found by the default resolver.
+        """
+        if not self.hosts:
+            return None
+        if self.site_id:
+            return StaticResolver(self.site_id, api_url=self.urls[0], token_auth=self.token_auth)
+        return DynamicResolver(api_url=self.urls[0], token_auth=self.token_auth)
+
+class Routes:
+    """
+    The --routes file, which sends the hits of some hosts or sites to other
+    Matomo servers than --url. Each section is a route:
+
+        [customer-a]
+        url = https://matomo-a.example.com
+        token_auth = ...
+        hosts = *.customer-a.com, shop.example.org
+
+    Hits whose host matches one of the hosts patterns go to the route, and
+    their site is found in its Matomo (or set with idsite). Routes can
+    instead have a list of idsites: hits whose site, as found by --idsite or
+    in the Matomo of --url, is one of them go to the route. Other hits go
+    to --url. A route can have several comma separated URLs (see
+    TrackerEndpoints) and its own number of recorders.
+    """
+
+    def __init__(self, path, recorder_count):
+        self.routes = []
+        parser = configparser.RawConfigParser()
+        try:
+            if not parser.read(path):
+                fatal_error('cannot read the routes file %s' % path)
+            for name in parser.sections():
+                section = dict(parser.items(name))
+                self.routes.append(self._create_route(name, section, recorder_count))
+        except (configparser.Error, ValueError) as e:
+            fatal_error('invalid routes file %s: %s' % (path, e))
+
+        self.routes_by_site = {}
+        for route in self.routes:
+            for site_id in route.site_ids:
+                self.routes_by_site[site_id] = route
+        # Route of each host, None for the default destination.
+        self.routes_by_host = {}
+
+    @staticmethod
+    def _create_route(name, section, recorder_count):
+        def get_list(key):
+            return [value.strip() for value in section.get(key, '').split(',') if value.strip()]
+
+        urls = [
+            url if url.startswith('http://') or url.startswith('https://') else 'http://' + url
+            for url in get_list('url')
+        ]
+        if not urls or not section.get('token_auth'):
+            raise ValueError('the route %s needs a url and a token_auth' % name)
+        hosts = [host.lower() for host in get_list('hosts')]
+        site_ids = get_list('idsites')
+        if bool(hosts) == bool(site_ids):
+            raise ValueError('the route %s needs either hosts or idsites' % name)
+
+        return Route(
+            name, urls, section['token_auth'], hosts, site_ids, section.get('idsite'),
+            int(section.get('recorders', recorder_count)),
+        )
+
+    def get(self, hit):
+        """
+        Return the route of a hit by its host, or None if it goes to --url or
+        to a route of its site (see get_by_site).
+        """
+        host = getattr(hit, 'host', '').lower()
+        try:
+            return self.routes_by_host[host]
+        except KeyError:
+            route = self.routes_by_host[host] = next((
+                route for route in self.routes
+                if any(fnmatch.fnmatch(host, pattern) for pattern in route.hosts)
+            ), None)
+            return route
+
+    def get_by_site(self, hit):
+        """
+        Return the route of the site of a hit, or None if it goes to --url.
+        Finding the site may call the Matomo API, so this is done by the
+        recorders rather than the parser.
+        """
+        site_id, main_url = resolver.resolve(hit)
+        return self.routes_by_site.get(str(site_id))
+
+    def split(self, hits, by_site=False):
+        """
+        Return the routes of some hits with their hits, in order.
+        """
+        get = self.get_by_site if by_site else self.get
+        hits_by_route = collections.OrderedDict()
+        for hit in hits:
+            hits_by_route.setdefault(get(hit), []).append(hit)
+        return hits_by_route.items()
+
+class Mirror(Route):
+    """
+    A --mirror-url: a Matomo server where all the hits are also sent, by its
+    own recorders, with the site IDs found for --url. Hits are copied before
+    being recorded, as recording them changes their custom variables.
+    """
+
+    mirror = True
+
+    def __init__(self, name, url, token_auth, recorder_count):
+        super(Mirror, self).__init__(name, [url], token_auth, [], [], None, recorder_count)
+        self.count_lines_spooled = Statistics.Counter()
+        # Hits not sent to the mirror as it couldn't keep up, without --spool
+        self.count_lines_dropped = Statistics.Counter()
+
+    def get_spool_path(self):
+        """
+        Return the directory of the --spool where the hits of the mirror wait
+        to be recorded. It is named after the URL of the mirror, so that the
+        hits left by an interrupted import go to the same mirror whatever the
+        order of the --mirror-url options.
+        """
+        url_hash = hashlib.sha1(self.urls[0].rstrip('/').encode('utf-8')).hexdigest()
+        return os.path.join(config.options.spool, 'mirror-%s' % url_hash[:16])
+
+    @staticmethod
+    def copy_hits(hits):
+        copies = []
+        for hit in hits:
+            copy = Hit.__new__(Hit)
+            copy.__dict__.update(hit.__dict__)
+            copy.args = dict(
+                (key, dict(value) if isinstance(value, dict) else value) for key, value in hit.args.items()
+            )
+            copies.append(copy)
+        return copies
+
+class RejectFile:
+    """
+    The --reject-file, where hits the tracker failed to track are appended,
+    one JSON object per line. With --routes or --mirror-url, each entry has
+    the URL of the Matomo the hit was sent to, as its tracking request has
+    the site ID of the hit in that Matomo.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    def add(self, hit, request, error, url):
+        entry = {
+            'filename': hit.filename,
+            'lineno': hit.lineno,
+            'error': str(error),
+            'request': request,
+            'url': url,
+        }
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a')
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class Spool:
+    """
+    The --spool directory, a write-ahead log of the parsed hits. Batches of
+    hits are appended to segment files as they are parsed, so that parsing
+    doesn't wait for Matomo, and a thread hands them over to the recorders
+    in order (see Recorder._read_spool).
+
+    Each batch is a record: its size and number of hits, then the pickled
+    hits, compressed. Once all the hits of the oldest records are recorded,
+    the position of the next record is saved and the segments before it are
+    removed, so an interrupted import sends the remaining hits first when it
+    is run again with the same spool.
+    """
+
+    SEGMENT_SIZE = 16 * 1024 * 1024
+    HEADER = struct.Struct('>II')
+    SAVE_INTERVAL = 1 # seconds
+    # Written data is synced to disk at most this often.
+    SYNC_INTERVAL = 1 # seconds
+    # Readable by all supported Python versions.
+    PICKLE_PROTOCOL = 4
+
+    class Record:
+        """
+        A batch read from the spool, whose hits are being recorded.
+        """
+        def __init__(self, segment, end, remaining):
+            self.segment = segment
+            self.end = end
+            self.remaining = remaining
+
+    def __init__(self, path, counter=None):
+        self.path = path
+        # Counts the spooled hits, stats.count_lines_spooled by default
+        self.counter = counter
+        self.condition = threading.Condition()
+        # Records read and not recorded yet, in order.
+        self.records = collections.deque()
+        # (segment, offset) of the first record not recorded yet
+        self.position = (0, 0)
+        self.read_position = None
+        self.write_segment = None
+        self.write_size = 0
+        self.file = None
+        self.closed = False
+        self.last_save = 0
+        self.last_sync = 0
+        # (on_synced, hits) of the batches written since the last sync
+        self.unsynced = []
+
+    def _sync(self):
+        """
+        Sync the written data to disk, and tell which batches are.
+        """
+        with self.condition:
+            if self.file is not None:
+                try:
+                    os.fsync(self.file.fileno())
+                except (IOError, OSError) as e:
+                    self.unsynced = []
+                    fatal_error('cannot write to the spool %s: %s' % (self.path, e))
+            self.last_sync = time.time()
+            unsynced, self.unsynced = self.unsynced, []
+            for on_synced, hits in unsynced:
+                on_synced(hits)
+
+    def _get_segment_path(self, segment):
+        return os.path.join(self.path, '%012d.spool' % segment)
+
+    def _get_segments(self):
+        return sorted(
+            int(name[:-len('.spool')]) for name in os.listdir(self.path)
+            if name.endswith('.spool') and name[:-len('.spool')].isdigit()
+        )
+
+    def open(self):
+        """
+        Open the spool, and start writing a new segment after the records left
+        by a previous import.
+        """
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            segments = self._get_segments()
+            position_path = os.path.join(self.path, 'position.json')
+            if os.path.exists(position_path):
+                with open(position_path) as file:
+                    position = json.load(file)
+                self.position = (position['segment'], position['offset'])
+            if segments and self.position[0] not in segments:
+                self.position = (segments[0], 0)
+
+            self.write_segment = max(segments + [self.position[0]]) + 1
+            if not segments:
+                self.position = (self.write_segment, 0)
+            self.file = open(self._get_segment_path(self.write_segment), 'ab')
+        except (IOError, OSError, ValueError, KeyError) as e:
+            fatal_error('cannot open the spool %s: %s' % (self.path, e))
+
+        self.read_position = self.position
+        if segments:
+            logging.info('Recording the hits left in the spool %s first.', self.path)
+
+    def append(self, hits, on_synced=None):
+        """
+        Add a batch of hits at the end of the spool. on_synced is called with
+        the hits once they are synced to disk.
+        """
+        if not hits:
+            return
+
+        data = zlib.compress(pickle.dumps([
+            dict((key, value) for key, value in hit.__dict__.items() if key not in ('checkpoint_batch', 'spool_record'))
+            for hit in hits
+        ], self.PICKLE_PROTOCOL), 1)
+
+        with self.condition:
+            try:
+                if self.write_size >= self.SEGMENT_SIZE:
+                    self.file.close()
+                    self.write_segment += 1
+                    self.write_size = 0
+                    self.file = open(self._get_segment_path(self.write_segment), 'ab')
+                self.file.write(self.HEADER.pack(len(data), len(hits)))
+                self.file.write(data)
+                self.file.flush()
+            except (IOError, OSError) as e:
+                fatal_error('cannot write to the spool %s: %s' % (self.path, e))
+            self.write_size += self.HEADER.size + len(data)
+            if on_synced is not None:
+                self.unsynced.append((on_synced, hits))
+            if time.time() - self.last_sync >= self.SYNC_INTERVAL:
+                self._sync()
+            self.condition.notify_all()
+        (self.counter if self.counter is not None else stats.count_lines_spooled).advance(len(hits))
+
+    def read(self):
+        """
+        Yield the batches of hits of the spool in order, waiting for new ones
+        until the spool is closed.
+        """
+        segment, offset = self.read_position
+        file = None
+        while True:
+            with self.condition:
+                self.read_position = (segment, offset)
+                self.condition.notify_all()
+                while (segment, offset) == (self.write_segment, self.write_size) and not self.closed:
+                    # Batches written while parsing stops are synced too.
+                    self.condition.wait(self.SYNC_INTERVAL if self.unsynced else None)
+                    if self.unsynced and time.time() - self.last_sync >= self.SYNC_INTERVAL:
+                        self._sync()
+                if (segment, offset) == (self.write_segment, self.write_size):
+                    break
+
+            if file is None:
+                try:
+                    file = open(self._get_segment_path(segment), 'rb')
+                except (IOError, OSError) as e:
+                    logging.warning('Skipping a segment of the spool: %s', e)
+                    segment += 1
+                    offset = 0
+                    continue
+                file.seek(offset)
+            header = file.read(self.HEADER.size)
+            size, count = self.HEADER.unpack(header) if len(header) == self.HEADER.size else (0, 0)
+            data = file.read(size)
+            if not count or len(data) < size:
+                # The end of a segment written before, possibly with the
+                # last record cut short by a crash.
+                if header:
+                    logging.warning('Ignoring an incomplete record at the end of %s.', file.name)
+                file.close()
+                file = None
+                segment += 1
+                offset = 0
+                continue
+
+            hits = []
+            for state in pickle.loads(zlib.decompress(data)):
+                hit = Hit.__new__(Hit)
+                hit.__dict__.update(state)
+                hits.append(hit)
+            offset += self.HEADER.size + size
+
+            record = self.Record(segment, offset, len(hits))
+            for hit in hits:
+                hit.spool_record = record
+            with self.condition:
+                self.records.append(record)
+                self.read_position = (segment, offset)
+            yield hits
+
+        if file is not None:
+            file.close()
+
+    def acknowledge(self, hits):
+        """
+        Called by the recorders once hits have been recorded.
+        """
+        with self.condition:
+            for hit in hits:
+                record = getattr(hit, 'spool_record', None)
+                if record is not None:
+                    record.remaining -= 1
+
+            first_segment = self.position[0]
+            changed = False
+            while self.records and self.records[0].remaining <= 0:
+                record = self.records.popleft()
+                self.position = (record.segment, record.end)
+                changed = True
+            if not changed:
+                return
+
+            for segment in range(first_segment, self.position[0]):
+                try:
+                    os.remove(self._get_segment_path(segment))
+                except OSError:
+                    pass
+            if time.time() - self.last_save >= self.SAVE_INTERVAL:
+                self.save()
+            self.condition.notify_all()
+
+    def is_empty(self):
+        with self.condition:
+            return not self.records and self.read_position == (self.write_segment, self.write_size)
+
+    def join(self):
+        """
+        Wait until all the hits of the spool are recorded.
+        """
+        with self.condition:
+            while self.records or self.read_position != (self.write_segment, self.write_size):
+                self.condition.wait()
+
+    def save(self):
+        with self.condition:
+            if self.unsynced:
+                self._sync()
+            tmp_path = os.path.join(self.path, 'position.json.tmp')
+            try:
+                with open(tmp_path, 'w') as file:
+                    json.dump({'segment': self.position[0], 'offset': self.position[1]}, file)
+                os.replace(tmp_path, os.path.join(self.path, 'position.json'))
+            except (IOError, OSError) as e:
+                logging.error('Cannot save the spool position in %s: %s', self.path, e)
+            self.last_save = time.time()
+
+    def close(self):
+        """
+        Close the spool. It is removed if all its hits were recorded,
+        otherwise the position of the first record to send is saved.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+            if self.file is None:
+                return
+            self._sync()
+            self.file.close()
+            self.file = None
+
+            if not self.is_empty():
+                self.save()
+                return
+
+            for segment in self._get_segments():
+                os.remove(self._get_segment_path(segment))
+            try:
+                os.remove(os.path.join(self.path, 'position.json'))
+            except OSError:
+                pass
+
+class RequestExporter:
+    """
+    The --export-requests directory, where the tracking requests of the hits
+    are written instead of being sent, for --replay-requests to send them
+    later, possibly from another machine.
+
+    Requests are sharded by visitor (see Hit.get_visitor_id_hash) into gzipped
+    files of JSON lines, each holding the requests of a batch of hits and the
+    log file name and line number of each hit. Files are named after the
+    host and process, so that several imports can export to the same
+    directory, and only get their final name once complete.
+    """
+
+    SUFFIX = '.ndjson.gz'
+    # Favors speed: JSON compresses well even at the lowest level.
+    COMPRESS_LEVEL = 1
+
+    def __init__(self, path, shard_count):
+        self.path = path
+        self.shard_count = shard_count
+        self.prefix = '%s-%d' % (socket.gethostname(), os.getpid())
+        self.locks = [threading.Lock() for i in range(shard_count)]
+        self.files = [None] * shard_count
+        self.file_count = 0
+
+    def _get_filename(self, shard):
+        return os.path.join(self.path, '%s-%03d%s' % (self.prefix, shard, self.SUFFIX))
+
+    def add(self, hits, requests):
+        """
+        Write the tracking requests of hits.
+        """
+        shards = {}
+        for hit, request in zip(hits, requests):
+            if request is not None:
+                shards.setdefault(hit.get_visitor_id_hash() % self.shard_count, []).append((hit, request))
+
+        for shard, items in shards.items():
+            line = json.dumps({
+                'requests': [request for hit, request in items],
+                'source': [[hit.filename, hit.lineno] for hit, request in items],
+            }) + '\n'
+            error = None
+            with self.locks[shard]:
+                try:
+                    if self.files[shard] is None:
+                        os.makedirs(self.path, exist_ok=True)
+                        self.files[shard] = gzip.open(self._get_filename(shard) + '.part', 'wb', self.COMPRESS_LEVEL)
+                        self.file_count += 1
+                    self.files[shard].write(line.encode('utf-8'))
+                except (IOError, OSError) as e:
+                    error = e
+            if error is not None:
+                # Outside of the lock, as fatal_error closes the files.
+                fatal_error('cannot write the exported requests to %s: %s' % (self.path, error))
+
+    def close(self, complete=True):
+        """
+        Close the exported files. They get their final name if complete,
+        otherwise they keep their .part suffix, so that they are not replayed.
+        """
+        for shard, lock in enumerate(self.locks):
+            with lock:
+                if self.files[shard] is None:
+                    continue
+                try:
+                    self.files[shard].close()
+                    if complete:
+                        os.replace(self._get_filename(shard) + '.part', self._get_filename(shard))
+                except (IOError, OSError) as e:
+                    logging.error('Cannot close the exported requests of %s: %s', self._get_filename(shard), e)
+                    complete = False
+                self.files[shard] = None
+        return complete
+
+    @classmethod
+    def get_files(cls, paths):
+        """
+        Returns the exported files to replay: the given files, and the
+        exported files of the given directories.
+        """
+        filenames = []
+        for path in paths:
+            if os.path.isdir(path):
+                filenames.extend(sorted(glob.glob(os.path.join(path, '*' + cls.SUFFIX))))
+            else:
+                filenames.append(path)
+        return filenames
+
+    @staticmethod
+    def read(filename):
+        """
+        Yield the hits and tracking requests of each line of an exported file.
+        The hits only have the file name and line number of the log line they
+        come from.
+        """
+        try:
+            with gzip.open(filename, 'rt', encoding='utf-8') as file:
+                for line in file:
+                    record = json.loads(line)
+                    hits = []
+                    for hit_filename, lineno in record['source']:
+                        hit = Hit.__new__(Hit)
+                        hit.filename = hit_filename
+                        hit.lineno = lineno
+                        hits.append(hit)
+                    yield hits, record['requests']
+        except (IOError, OSError, EOFError, ValueError, KeyError) as e:
+            fatal_error('cannot read the exported requests of %s: %s' % (filename, e))
+
+class PayloadSizer:
+    """
+    Adjusts the number of hits sent in one tracking request so that Matomo
+    answers within --recorder-target-response-time. Like TCP congestion
+    control, the size grows by a few hits after each fast response and is
+    cut by a factor after a slow one (AIMD), and is halved when a request
+    had to be split.
+
+    Small requests cannot be answered faster than the network latency, so
+    slow responses never make the size drop below a part of the maximum:
+    only failed requests do.
+    """
+
+    # Part of the maximum size added after a fast response.
+    INCREASE = 0.05
+    # Factor applied to the size after a slow response.
+    DECREASE = 0.7
+    # Part of the maximum size under which slow responses don't shrink it.
+    MIN_SIZE = 0.1
+
+    def __init__(self, max_size, target_response_time):
+        self.max_size = max_size
+        self.target_response_time = target_response_time
+        self.size = float(max_size)
+        self.min_size = max(1, int(max_size * self.MIN_SIZE))
+        self.lock = threading.Lock()
+
+        self.smallest_size = self.largest_size = max_size
+        self.count_requests = 0
+        self.count_hits = 0
+        self.count_splits = 0
+
+    def get_size(self):
+        return int(self.size)
+
+    def on_response(self, count, response_time):
+        """
+        Called after a request of count hits was answered.
+        """
+        with self.lock:
+            self.count_requests += 1
+            self.count_hits += count
+            if response_time > self.target_response_time:
+                self._set_size(max(min(self.size, count) * self.DECREASE, self.min_size))
+            elif count >= self.get_size():
+                # Only full requests tell that more hits could be sent.
+                self._set_size(self.size + max(1, self.max_size * self.INCREASE))
+
+    def on_split(self, count):
+        """
+        Called when a request of count hits had to be split.
+        """
+        with self.lock:
+            self.count_splits += 1
+            self._set_size(min(self.size, count) / 2.0)
+
+    def _set_size(self, size):
+        self.size = min(max(size, 1.0), float(self.max_size))
+        self.smallest_size = min(self.smallest_size, self.get_size())
+        self.largest_size = max(self.largest_size, self.get_size())
+
+class TokenBucket:
+    """
+    Limits the rate of an action shared by several threads. Tokens are added
+    at the given rate, up to one second worth of them, and each action takes
+    as many tokens as its size. When there are not enough tokens, the caller
+    has to wait until there will be.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = self.rate
+        self.tokens = self.capacity
+        self.time = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self, count):
+        """
+        Take count tokens, and return how many seconds to wait before acting.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.time) * self.rate)
+            self.time = now
+            self.tokens -= count
+            return max(0.0, -self.tokens / self.rate)
+
+class RateLimiter:
+    """
+    Applies --max-hits-per-second and --max-requests-per-second to the
+    tracking requests of all the recorders, during --rate-limit-hours only if
+    set.
+    """
+
+    def __init__(self, max_hits_per_second, max_requests_per_second, hours=None):
+        self.hits = TokenBucket(max_hits_per_second) if max_hits_per_second else None
+        self.requests = TokenBucket(max_requests_per_second) if max_requests_per_second else None
+        self.hours = hours
+        self.delay = stats.rate_limit_delay
+
+    def is_active(self, hour=None):
+        if not self.hours:
+            return True
+        if hour is None:
+            hour = time.localtime().tm_hour
+        return hour in self.hours
+
+    def get_delay(self, hit_count):
+        """
+        Return how many seconds to wait before sending a tracking request of
+        hit_count hits.
+        """
+        if not self.is_active():
+            return 0.0
+
+        delay = 0.0
+        if self.hits:
+            delay = max(delay, self.hits.reserve(hit_count))
+        if self.requests:
+            delay = max(delay, self.requests.reserve(1))
+        if delay:
+            self.delay.add(delay)
+        return delay
+
+class CircuitBreaker:
+    """
+    Pauses all the recorders while Matomo is unavailable, instead of exiting
+    as soon as a tracking request failed all its attempts.
+
+    When a request fails because Matomo is unreachable, times out or returns
+    a 429 or 5xx error, the breaker opens: a single recorder at a time keeps
+    sending its request, and the others wait. The first request that succeeds
+    closes the breaker, and all recorders resume. The import stops if Matomo
+    is still unavailable after --circuit-breaker-timeout seconds.
+    """
+
+    # Seconds between two checks of a waiting recorder.
+    POLL_INTERVAL = 1
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.open_since = None
+        self.probing = False
+
+        self.count_trips = 0
+        self.time_open = 0.0
+
+    @staticmethod
+    def is_unavailable_error(e):
+        return e.code is None or e.code == 429 or e.code >= 500
+
+    def get_delay(self):
+        """
+        Return 0 if a request can be sent now, otherwise how many seconds to
+        wait before asking again.
+        """
+        with self.lock:
+            if self.open_since is None:
+                return 0
+            if not self.probing:
+                self.probing = True
+                return 0
+            return self.POLL_INTERVAL
+
+    def on_success(self):
+        with self.lock:
+            if self.open_since is not None:
+                logging.info('Matomo is available again, resuming the import.')
+                self.time_open += time.time() - self.open_since
+                self.open_since = None
+            self.probing = False
+
+    def on_split(self):
+        """
+        Called when a request is split instead of being sent again: its
+        parts may be sent in its place.
+        """
+        with self.lock:
+            self.probing = False
+
+    def on_failure(self, e):
+        """
+        Called when a request failed all its attempts. Returns True if it
+        should be sent again once Matomo is available, False if the error
+        is fatal.
+        """
+        if not self.is_unavailable_error(e):
+            return False
+
+        with self.lock:
+            now = time.time()
+            if self.open_since is None:
+                logging.warning('Matomo is unavailable (%s), pausing the import until it answers again.', e)
+                self.open_since = now
+                self.count_trips += 1
+            self.probing = False
+            return now - self.open_since < self.timeout
+
+class RecorderTuner:
+    """
+    Chooses the number of recorders with --recorders=auto. At the end of each
+    period of a few seconds, it looks at how many hits were recorded per
+    second, how long Matomo took to answer and how long the log parser waited
+    for the recorders to accept more hits:
+
+    - while the parser spends much of its time waiting, recorders are the
+      bottleneck, and a quarter more recorders are added;
+    - if the recorders added didn't make the import faster, or made Matomo
+      answer much slower than it did with less recorders, they are removed
+      and no recorders are added for a while.
+    """
+
+    # Duration of a measurement period, in seconds.
+    INTERVAL = 5
+    START_RECORDERS = 2
+    MAX_RECORDERS = 32
+    # Part of the time the parser must wait for the recorders to add some.
+    BLOCKED_RATIO = 0.2
+    # Minimum throughput increase expected from added recorders.
+    MIN_GAIN = 1.1
+    # Increase of the response time, compared to the fastest period, meaning
+    # that Matomo is overloaded.
+    MAX_SLOWDOWN = 2.0
+    # Number of periods without adding recorders after removing some.
+    HOLD_PERIODS = 6
+
+    def __init__(self, count):
+        self.count = count
+        self.lock = threading.Lock()
+        self.previous_count = None
+        self.previous_throughput = None
+        self.min_response_time = None
+        self.hold = 0
+
+        self.period_start = time.time()
+        self.period_hits = stats.count_lines_recorded.value
+        self.blocked_time = 0.0
+        self.response_time = 0.0
+        self.count_responses = 0
+
+        self.smallest_count = self.largest_count = count
+
+    def on_blocked(self, seconds):
+        """
+        Called when the parser waited for the recorders to accept hits.
+        """
+        self.blocked_time += seconds
+
+    def on_response(self, response_time):
+        """
+        Called by the recorders after each tracking request.
+        """
+        with self.lock:
+            self.response_time += response_time
+            self.count_responses += 1
+
+    def get_count(self):
+        """
+        Return the number of recorders to use, which only changes at the end
+        of a period.
+        """
+        now = time.time()
+        elapsed = now - self.period_start
+        if elapsed < self.INTERVAL:
+            return self.count
+
+        hits = stats.count_lines_recorded.value
+        throughput = (hits - self.period_hits) / elapsed
+        blocked_ratio = self.blocked_time / elapsed
+        with self.lock:
+            response_time = self.response_time / self.count_responses if self.count_responses else None
+            self.response_time = 0.0
+            self.count_responses = 0
+        self.period_start = now
+        self.period_hits = hits
+        self.blocked_time = 0.0
+
+        if response_time is not None:
+            self._adjust(throughput, response_time, blocked_ratio)
+        return self.count
+
+    def _adjust(self, throughput, response_time, blocked_ratio):
+        """
+        Change the number of recorders given the measures of the last period.
+        """
+        if self.min_response_time is None or response_time < self.min_response_time:
+            self.min_response_time = response_time
+        overloaded = response_time > self.min_response_time * self.MAX_SLOWDOWN
+        count = self.count
+
+        if self.previous_count is not None and (
+            overloaded or throughput < self.previous_throughput * self.MIN_GAIN
+        ):
+            # The recorders added last didn't help.
+            self.count = self.previous_count
+            self.hold = self.HOLD_PERIODS
+        elif overloaded and self.count > 1:
+            self.count -= max(1, self.count // 4)
+            self.hold = self.HOLD_PERIODS
+        elif self.hold:
+            self.hold -= 1
+        elif blocked_ratio > self.BLOCKED_RATIO and self.count < self.MAX_RECORDERS:
+            self.count = min(self.count + max(1, self.count // 4), self.MAX_RECORDERS)
+
+        self.previous_count = count if self.count > count else None
+        self.previous_throughput = throughput
+        self.smallest_count = min(self.smallest_count, self.count)
+        self.largest_count = max(self.largest_count, self.count)
+        if self.count != count:
+            logging.debug('Using %d recorders instead of %d (%.1f hits/s, %.3fs response time, parser waited %d%% of the time)',
+                          self.count, count, throughput, response_time, blocked_ratio * 100)
+
+class Dispatcher:
+    """
+    Hands the hits over to the recorders. Hits are assigned to a fixed number
+    of partitions by visitor (see Hit.get_visitor_id_hash), and an idle
+    recorder takes the pending hits of the oldest partitions no other
+    recorder is recording. The hits of a visitor are thus recorded in order,
+    while a slow request only holds up the partitions whose hits it
+    contains.
+
+    Adding hits waits while the hits not recorded yet take more than
+    --recorder-queue-size bytes.
+    """
+
+    PARTITIONS = 256
+    # Approximate size of the tracking request of a hit, besides its URL,
+    # referrer and user agent.
+    HIT_SIZE = 200
+
+    class Work:
+        """
+        The hits of some partitions, taken by a recorder.
+        """
+        def __init__(self):
+            self.partitions = []
+            self.hits = []
+            self.size = 0
+            # The tracker endpoint of the partitions, see Dispatcher.get_route
+            self.route = None
+            # Set by the serializer: the tracking requests of the hits, and
+            # the (start, end, body) of each tracking request to send.
+            self.requests = None
+            self.payloads = None
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.condition = threading.Condition()
+        self.pending = [[] for i in range(self.PARTITIONS)]
+        self.pending_sizes = [0] * self.PARTITIONS
+        # Partitions with pending hits that no recorder is recording, in the
+        # order they got them.
+        self.ready = collections.deque()
+        self.busy = set()
+        self.count_pending = 0
+        # Size of the hits added and not recorded yet.
+        self.size = 0
+        # Called when hits are ready to be taken, to wake up the recorders of
+        # the async engine.
+        self.on_ready = None
+        # Returns the tracker endpoint of a partition, with several tracker
+        # endpoints: work only has the partitions of one endpoint.
+        self.get_route = None
+
+    def get_size(self, hit):
+        return self.HIT_SIZE + len(hit.full_path) + len(hit.referrer) + len(hit.user_agent)
+
+    def put(self, hits, block=True):
+        """
+        Add hits, once enough of the previous ones were recorded. Returns the
+        number of hits added to each partition, or None if block is False and
+        the hits were not added as there is no room for them.
+        """
+        partitions = [[] for i in range(self.PARTITIONS)]
+        for hit in hits:
+            partitions[hit.get_visitor_id_hash() % self.PARTITIONS].append(hit)
+        sizes = [sum(self.get_size(hit) for hit in partition) for partition in partitions]
+        size = sum(sizes)
+
+        with self.condition:
+            # Hits bigger than the maximum size are added on their own.
+            while self.size and self.size + size > self.max_size:
+                if not block:
+                    return None
+                self.condition.wait()
+
+            for i, partition in enumerate(partitions):
+                if not partition:
+                    continue
+                if not self.pending[i] and i not in self.busy:
+                    self.ready.append(i)
+                self.pending[i].extend(partition)
+                self.pending_sizes[i] += sizes[i]
+            self.count_pending += len(hits)
+            self.size += size
+            self.condition.notify_all()
+
+        if self.on_ready is not None:
+            self.on_ready()
+        return [len(partition) for partition in partitions]
+
+    def get(self, max_hits, stopped=None, block=True):
+        """
+        Take the pending hits of the oldest ready partitions, up to max_hits
+        hits unless a single partition has more. Returns None if there are
+        none and block is False, or when the stopped event is set.
+        """
+        with self.condition:
+            while not self.ready:
+                if not block or (stopped is not None and stopped.is_set()):
+                    return None
+                self.condition.wait()
+
+            work = self.Work()
+            # Partitions of other endpoints, put back in the same order.
+            skipped = []
+            while self.ready:
+                partition = self.ready[0]
+                if work.hits and len(work.hits) + len(self.pending[partition]) > max_hits:
+                    break
+                self.ready.popleft()
+                if self.get_route is not None:
+                    route = self.get_route(partition)
+                    if work.partitions and route is not work.route:
+                        skipped.append(partition)
+                        continue
+                    work.route = route
+                work.partitions.append(partition)
+                work.hits.extend(self.pending[partition])
+                work.size += self.pending_sizes[partition]
+                self.pending[partition] = []
+                self.pending_sizes[partition] = 0
+                self.busy.add(partition)
+            self.ready.extendleft(reversed(skipped))
+            self.count_pending -= len(work.hits)
+            return work
+
+    def done(self, work):
+        """
+        Called once the hits taken with get() are recorded.
+        """
+        with self.condition:
+            for partition in work.partitions:
+                self.busy.discard(partition)
+                if self.pending[partition]:
+                    self.ready.append(partition)
+            self.size -= work.size
+            ready = bool(self.ready)
+            self.condition.notify_all()
+
+        if ready and self.on_ready is not None:
+            self.on_ready()
+
+    def wake(self):
+        """
+        Wake up the recorders waiting for hits, eg. to let them stop.
+        """
+        with self.condition:
+            self.condition.notify_all()
+
+    def join(self):
+        """
+        Wait until all the hits added are recorded. Recorders notify the
+        condition as soon as they are done, so this returns right after the
+        last tracking request is answered.
+        """
+        with self.condition:
+            while self.count_pending or self.busy:
+                self.condition.wait()
+
+class Serializer:
+    """
+    Keeps the work taken from the Dispatcher whose tracking requests were
+    encoded ahead of time (see Recorder._run_serializer), until a recorder
+    sends them. Encoding requests is CPU work, which thus overlaps the
+    network waits of the recorders. With --chunked-requests, only the
+    requests are built ahead of time: their bodies are encoded while they
+    are sent.
+
+    Adding work waits while max_size works are ready, so that the encoded
+    requests don't pile up when Matomo is the bottleneck.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.condition = threading.Condition()
+        self.ready = collections.deque()
+        # Called when work is ready to be taken, to wake up the recorders of
+        # the async engine.
+        self.on_ready = None
+        # Set to stop the thread encoding the requests, see Recorder.stop()
+        self.stopped = threading.Event()
+
+    def put(self, work):
+        """
+        Add work whose requests are encoded, once there is room for it.
+        """
+        time_start = time.time()
+        with self.condition:
+            while len(self.ready) >= self.max_size and not self.stopped.is_set():
+                self.condition.wait()
+            self.ready.append(work)
+            self.condition.notify_all()
+        stats.serializer_wait.add(time.time() - time_start)
+
+        if self.on_ready is not None:
+            self.on_ready()
+
+    def get(self, stopped=None, block=True):
+        """
+        Take the oldest work. Returns None if there is none and block is
+        False, or when the stopped event is set.
+        """
+        with self.condition:
+            while not self.ready:
+                if not block or (stopped is not None and stopped.is_set()):
+                    return None
+                self.condition.wait()
+
+            work = self.ready.popleft()
+            self.condition.notify_all()
+            return work
+
+    def wake(self):
+        """
+        Wake up the recorders waiting for work, eg. to let them stop.
+        """
+        with self.condition:
+            self.condition.notify_all()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake()
+
+class Recorder:
+    """
+    A Recorder fetches hits from the Dispatcher and inserts them into Matomo
+    using the API.
+    """
+
+    recorders = []
+    dispatcher = None
+    # Encodes the tracking requests ahead of time, with bulk tracking
+    serializer = None
+    # Event loop of the async recorder engine.
+    loop = None
+    # Adjusts the size of tracking requests, with --recorder-target-response-time
+    payload_sizer = None
+    # Adjusts the number of recorders, with --recorders=auto
+    tuner = None
+    # Delays tracking requests, with --max-hits-per-second and --max-requests-per-second
+    rate_limiter = None
+    # Pauses recorders while Matomo is unavailable, with --circuit-breaker-timeout
+    circuit_breaker = None
+    # Where hits the tracker failed to track are written, with --reject-file
+    reject_file = None
+    # Where parsed hits wait to be recorded, with --spool
+    spool = None
+    # Where tracking requests are written instead of being sent, with --export-requests
+    exporter = None
+    # The --routes, and the route whose hits the recorders of a subclass send
+    routes = None
+    destination = None
+    # The --mirror-url mirrors, where all the hits are also sent
+    mirrors = ()
+    # URL prefix of each (host, main URL) pair, and JSON of the HTTP-code
+    # custom variable of each status
+    url_prefixes = {}
+    status_cvars = {}
+
+    def __init__(self):
+        # AsyncHttpConnection objects used by the async recorder engine
+        self.connections = {}
+        self.wakeup = None
+        # Set when the recorder is removed
+        self.stopped = threading.Event()
+        # Consecutive hits often have the same date
+        self.last_date = None
+        self.last_cdt = None
+        # Routing key of the tracking requests sent, see TrackerEndpoints
+        self.route = None
+
+    @classmethod
+    def launch(cls, recorder_count):
+        """
+        Launch a bunch of Recorder objects in a separate thread.
+        """
+        cls.dispatcher = Dispatcher(config.options.recorder_queue_size)
+        if cls.get_matomo().endpoints is not None:
+            cls.dispatcher.get_route = cls.get_matomo().endpoints.get
+
+        if config.options.recorder_target_response_time:
+            cls.payload_sizer = PayloadSizer(
+                config.options.recorder_max_payload_size, config.options.recorder_target_response_time
+            )
+
+        if config.options.max_hits_per_second or config.options.max_requests_per_second:
+            cls.rate_limiter = RateLimiter(
+                config.options.max_hits_per_second, config.options.max_requests_per_second,
+                config.options.rate_limit_hours,
+            )
+
+        if config.options.circuit_breaker_timeout > 0:
+            cls.circuit_breaker = CircuitBreaker(config.options.circuit_breaker_timeout)
+
+        if config.options.reject_file and cls.destination is None:
+            cls.reject_file = RejectFile(config.options.reject_file)
+
+        if config.options.export_requests:
+            cls.exporter = RequestExporter(config.options.export_requests, config.options.export_shards)
+
+        if config.options.replay_requests:
+            # The recorders are started by replay().
+            return
+
+        if config.options.recorders_auto:
+            if config.options.use_bulk_tracking:
+                cls.tuner = RecorderTuner(recorder_count)
+            else:
+                logging.info('--recorders=auto requires bulk tracking, using %d recorders.', recorder_count)
+
+        if config.options.recorder_engine == 'async':
+            if not config.options.use_bulk_tracking:
+                logging.info('The async recorder engine requires bulk tracking, using threads instead.')
+            elif cls.get_matomo().proxies:
+                logging.info('The async recorder engine cannot use a proxy, using threads instead.')
+            else:
+                cls._start_loop()
+                cls.dispatcher.on_ready = cls._wake_async
+
+        if (config.options.use_bulk_tracking and not config.options.dry_run and not config.options.export_requests
+                and config.options.serializer_queue_size > 0):
+            cls.serializer = Serializer(config.options.serializer_queue_size)
+            if cls.loop is not None:
+                cls.dispatcher.on_ready = None
+                cls.serializer.on_ready = cls._wake_async
+
+            t = threading.Thread(target=cls()._run_serializer)
+            t.daemon = True
+            t.start()
+
+        cls._add_recorders(recorder_count)
+
+        if cls.destination is None and config.options.routes:
+            cls.routes = config.routes
+            for route in cls.routes.routes:
+                cls._launch_route(route)
+
+        if cls.destination is None and config.mirrors:
+            cls.mirrors = config.mirrors
+            for mirror in cls.mirrors:
+                cls._launch_route(mirror)
+
+        if config.options.spool and cls.destination is None:
+            cls.spool = Spool(config.options.spool)
+            cls.spool.open()
+            if not cls.spool.is_empty() and not config.options.resume:
+                logging.warning(
+                    'The spool %s has hits left by an interrupted import, which are sent first: without --resume, '
+                    'the log files are parsed again from the beginning and these hits are sent twice.',
+                    cls.spool.path,
+                )
+            t = threading.Thread(target=cls._read_spool)
+            t.daemon = True
+            t.start()
+        elif config.options.spool and cls.is_mirror():
+            # A slow mirror doesn't hold up parsing.
+            cls.spool = Spool(cls.destination.get_spool_path(), cls.destination.count_lines_spooled)
+            cls.spool.open()
+            t = threading.Thread(target=cls._read_spool)
+            t.daemon = True
+            t.start()
+
+    @classmethod
+    def _launch_route(cls, route):
+        """
+        Launch the recorders of a --routes route or a mirror, which have
+        their own connections to its Matomo, and their own Dispatcher.
+        """
+        route.matomo = MatomoHttpUrllib(route.urls)
+        route.resolver = route.create_resolver()
+        attributes = {'recorders': [], 'destination': route, 'routes': None, 'mirrors': (), 'serializer': None}
+        if route.mirror:
+            # Mirrors don't record the hits of the --spool
+            attributes['spool'] = None
+        route.recorder = type('Recorder', (cls,), attributes)
+        route.recorder.launch(route.recorder_count)
+        logging.debug('Launched %d recorders for the route %s', route.recorder_count, route.name)
+
+    @classmethod
+    def get_matomo(cls):
+        return cls.destination.matomo if cls.destination is not None else matomo
+
+    @classmethod
+    def is_mirror(cls):
+        return cls.destination is not None and cls.destination.mirror
+
+    @classmethod
+    def replay(cls, filenames):
+        """
+        Send the tracking requests of files written by --export-requests. Each
+        file is sent in order by a single recorder, so that the hits of a
+        visitor are recorded in order.
+        """
+        filenames = collections.deque(filenames)
+        threads = []
+        for i in range(min(config.options.recorders, len(filenames))):
+            t = threading.Thread(target=cls()._run_replay, args=(filenames,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+    @classmethod
+    def _read_spool(cls):
+        """
+        Hand the hits of the spool over to the recorders, in order.
+        """
+        for hits in cls.spool.read():
+            cls._dispatch(hits)
+
+    @classmethod
+    def _start_loop(cls):
+        """
+        Start the event loop of the async recorder engine in a separate thread.
+        """
+        cls.loop = asyncio.new_event_loop()
+        t = threading.Thread(target=cls.loop.run_forever)
+        t.daemon = True
+        t.start()
+
+    @classmethod
+    def _add_recorders(cls, recorder_count):
+        """
+        Launch Recorder objects, each in a separate thread or as a coroutine
+        of the event loop.
+        """
+        for i in range(recorder_count):
+            recorder = cls()
+            cls.recorders.append(recorder)
+
+            if cls.loop is not None:
+                asyncio.run_coroutine_threadsafe(recorder._start_async(), cls.loop).result()
+                logging.debug('Launched recorder in the event loop')
+                continue
+
+            run = recorder._run_bulk if config.options.use_bulk_tracking else recorder._run_single
+            t = threading.Thread(target=run)
+
+            t.daemon = True
+            t.start()
+            logging.debug('Launched recorder')
+
+    @classmethod
+    def _resize(cls, recorder_count):
+        """
+        Change the number of recorders. Hits are assigned to partitions of the
+        Dispatcher rather than to recorders, so the hits of a visitor are
+        still recorded in order. Removed recorders finish recording the hits
+        they took first.
+        """
+        if recorder_count > len(cls.recorders):
+            cls._add_recorders(recorder_count - len(cls.recorders))
+        else:
+            for recorder in cls.recorders[recorder_count:]:
+                recorder._stop()
+            del cls.recorders[recorder_count:]
+            cls.dispatcher.wake()
+            if cls.serializer is not None:
+                cls.serializer.wake()
+
+    @classmethod
+    def stop(cls):
+        """
+        Stop the recorders and the threads started by launch(), along with
+        those of the routes and mirrors.
+        """
+        if cls.routes is not None:
+            for route in cls.routes.routes:
+                route.recorder.stop()
+        for mirror in cls.mirrors:
+            mirror.recorder.stop()
+
+        # The recorders of a route share the spool of the primary recorders.
+        if cls.spool is not None and (cls.destination is None or cls.is_mirror()):
+            cls.spool.close()
+        if cls.serializer is not None:
+            cls.serializer.stop()
+            cls.dispatcher.wake()
+        cls._resize(0)
+        if cls.get_matomo().endpoints is not None:
+            cls.get_matomo().endpoints.close()
+        if cls.loop is not None:
+            # Let the recorders stop before the event loop.
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0.1), cls.loop).result()
+            cls.loop.call_soon_threadsafe(cls.loop.stop)
+
+    async def _start_async(self):
+        # The event must be created in the thread of the event loop.
+        self.wakeup = asyncio.Event()
+        asyncio.ensure_future(self._run_bulk_async())
+
+    def _stop(self):
+        self.stopped.set()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    @classmethod
+    def _wake_async(cls):
+        cls.loop.call_soon_threadsafe(cls._wake_recorders_async)
+
+    @classmethod
+    def _wake_recorders_async(cls):
+        for recorder in list(cls.recorders):
+            if recorder.wakeup is not None:
+                recorder.wakeup.set()
+
+    @classmethod
+    def add_hits(cls, all_hits):
+        """
+        Add a set of hits to the recorders queue.
+        """
+        if config.options.checkpoint:
+            checkpoint.add_batch(all_hits)
+
+        for mirror in cls.mirrors:
+            if mirror.recorder.spool is not None:
+                mirror.recorder.spool.append(all_hits)
+            elif not mirror.recorder._put(Mirror.copy_hits(all_hits), block=False):
+                # A slow mirror doesn't hold up parsing.
+                if not mirror.count_lines_dropped.value:
+                    logging.warning(
+                        'The mirror %s cannot keep up, hits are not sent to it until it catches up: '
+                        'use --spool to keep them.', mirror.urls[0]
+                    )
+                mirror.count_lines_dropped.advance(len(all_hits))
+
+        if cls.spool is not None:
+            # Spooled hits are recorded even if the import is interrupted, as
+            # long as it is run again with the spool, once synced to disk.
+            cls.spool.append(all_hits, checkpoint.acknowledge if config.options.checkpoint else None)
+            return
+
+        cls._dispatch(all_hits)
+
+    @classmethod
+    def _dispatch(cls, all_hits):
+        if cls.routes is None:
+            cls._put(all_hits)
+            return
+
+        for route, hits in cls.routes.split(all_hits):
+            (route.recorder if route is not None else cls)._put(hits)
+
+    @classmethod
+    def _put(cls, all_hits, block=True):
+        """
+        Hand hits over to the recorders. Returns False if block is False and
+        the recorders are too far behind to take them.
+        """
+        if cls.tuner is not None:
+            recorder_count = cls.tuner.get_count()
+            if recorder_count != len(cls.recorders):
+                cls._resize(recorder_count)
+
+        time_start = time.time()
+        sizes = cls.dispatcher.put(all_hits, block)
+        if sizes is None:
+            return False
+        if not cls.is_mirror():
+            stats.add_partitions(sizes)
+        if cls.tuner is not None:
+            cls.tuner.on_blocked(time.time() - time_start)
+        return True
+
+    @classmethod
+    def wait_empty(cls):
+        """
+        Wait until all hits are recorded.
+        """
+        if cls.spool is not None:
+            cls.spool.join()
+        cls.dispatcher.join()
+        if cls.routes is not None:
+            for route in cls.routes.routes:
+                route.recorder.dispatcher.join()
+        for mirror in cls.mirrors:
+            mirror.recorder.wait_empty()
+
+    def _get_payload_size(self):
+        return self.payload_sizer.get_size() if self.payload_sizer else config.options.recorder_max_payload_size
+
+    def _get_work(self, block=True):
+        if self.serializer is not None:
+            return self.serializer.get(self.stopped, block)
+        return self.dispatcher.get(self._get_payload_size(), self.stopped, block)
+
+    def _run_serializer(self):
+        """
+        Take work from the Dispatcher and encode its tracking requests, for the
+        recorders to send them (see Serializer).
+        """
+        while True:
+            work = self.dispatcher.get(self._get_payload_size(), self.serializer.stopped)
+            if work is None:
+                # Recorder.stop() was called.
+                return
+
+            time_start = time.time()
+            try:
+                work.hits = self._route_by_site(work.hits)
+                # Let the recorders run every few hits: a recorder whose
+                # response arrived would otherwise wait for the thread switch
+                # interval before handling it.
+                work.requests = []
+                for start in range(0, len(work.hits), 10):
+                    work.requests.extend(self._get_hit_requests(work.hits[start:start + 10]))
+                    time.sleep(0)
+            except MatomoHttpBase.Error as e:
+                fatal_error(e, work.hits[0].filename, work.hits[0].lineno) # approximate location of error
+            work.payloads = []
+            for start, end in self._split_payload(work.requests):
+                args, data = self._get_tracking_request(work.requests[start:end])
+                work.payloads.append((start, end, self.get_matomo().encode_body(data, compress=True, stream='requests')))
+            stats.serialize_time.add(time.time() - time_start)
+
+            self.serializer.put(work)
+
+    def _run_bulk(self):
+        while True:
+            try:
+                work = self._get_work()
+            except:
+                # TODO: we should log something here, however when this happens, logging.etc will throw
+                return
+
+            if work is None:
+                # This recorder was removed.
+                return
+
+            self.route = work.partitions[0] if work.partitions else None
+            time_start = time.time()
+            try:
+                if work.payloads is None:
+                    self._record_hits(work.hits)
+                else:
+                    for start, end, body in work.payloads:
+                        self._wait_rate_limit(end - start)
+                        self._send_payload(work.hits[start:end], work.requests[start:end], body)
+            except MatomoHttpBase.Error as e:
+                fatal_error(e, work.hits[0].filename, work.hits[0].lineno) # approximate location of error
+            stats.send_time.add(time.time() - time_start)
+            self.dispatcher.done(work)
+
+    async def _run_bulk_async(self):
+        while True:
+            if self.stopped.is_set():
+                # This recorder was removed.
+                for connection in self.connections.values():
+                    connection.close()
+                return
+
+            work = self._get_work(block=False)
+            if work is None:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            self.route = work.partitions[0] if work.partitions else None
+            time_start = time.time()
+            try:
+                if work.payloads is None:
+                    await self._record_hits_async(work.hits)
+                else:
+                    for start, end, body in work.payloads:
+                        await self._wait_rate_limit_async(end - start)
+                        await self._send_payload_async(work.hits[start:end], work.requests[start:end], body)
+            except MatomoHttpBase.Error as e:
+                fatal_error(e, work.hits[0].filename, work.hits[0].lineno) # approximate location of error
+            stats.send_time.add(time.time() - time_start)
+            self.dispatcher.done(work)
+
+    def _run_single(self):
+        while True:
+            work = self.dispatcher.get(config.options.recorder_max_payload_size, self.stopped)
+            if work is None:
+                return
+
+            self.route = work.partitions[0]
+
+            for hit in work.hits:
+                if config.options.force_one_action_interval != False:
+                    time.sleep(config.options.force_one_action_interval)
+
+                try:
+                    self._record_hits([hit])
+                except MatomoHttpBase.Error as e:
+                    fatal_error(e, hit.filename, hit.lineno)
+            self.dispatcher.done(work)
+
+    def _run_replay(self, filenames):
+        while True:
+            try:
+                filename = filenames.popleft()
+            except IndexError:
+                return
+
+            logging.debug('Replaying the tracking requests of %s', filename)
+            self.route = filename
+            # Files have many small lines, one for each batch of hits and
+            # shard: they are sent in requests as big as usual.
+            hits, requests = [], []
+            for line_hits, line_requests in RequestExporter.read(filename):
+                stats.matomo_sites.update(request.get('idsite') for request in line_requests)
+                hits.extend(line_hits)
+                requests.extend(line_requests)
+                if len(requests) >= self._get_payload_size():
+                    self._replay_requests(hits, requests)
+                    hits, requests = [], []
+            if requests:
+                self._replay_requests(hits, requests)
+
+    def _replay_requests(self, hits, requests):
+        try:
+            for start, end in self._split_payload(requests):
+                self._wait_rate_limit(end - start)
+                self._send_payload(hits[start:end], requests[start:end])
+        except MatomoHttpBase.Error as e:
+            fatal_error(e)
+
+    def date_to_matomo(self, date):
+        if date == self.last_date and date.tzinfo is None:
+            return self.last_cdt
+
+        if date.tzinfo is None and not date.microsecond:
+            cdt = '%04d-%02d-%02d %02d:%02d:%02d' % (
+                date.year, date.month, date.day, date.hour, date.minute, date.second
+            )
+        else:
+            date_part, time_part = date.isoformat(sep=' ').split()
+            cdt = '%s %s' % (date_part, time_part.replace('-', ':'))
 
-    def date_to_matomo(self, date):
-        date, time = date.isoformat(sep=' ').split()
-        return '%s %s' % (date, time.replace('-', ':'))
+        self.last_date = date
+        self.last_cdt = cdt
+        return cdt
 
     def _get_hit_args(self, hit):
         """
         Returns the args used in tracking a hit, without the token_auth.
         """
-        site_id, main_url = resolver.resolve(hit)
+        site_resolver = resolver
+        if self.destination is not None and self.destination.resolver is not None:
+            site_resolver = self.destination.resolver
+        site_id, main_url = site_resolver.resolve(hit)
         if site_id is None:
             # This hit doesn't match any known Matomo site.
             if config.options.replay_tracking:
                 stats.matomo_sites_ignored.add('unrecognized site ID %s' % hit.args.get('idsite'))
             else:
                 stats.matomo_sites_ignored.add(hit.host)
-            stats.count_lines_no_site.increment()
+            if not self.is_mirror():
+                stats.count_lines_no_site.increment()
             return
 
         stats.dates_recorded.add(hit.date.date())
@@ -2064,7 +5332,15 @@ class Recorder:
             else:
                 hit.add_visit_custom_var("Not-Bot", hit.user_agent)
 
-        hit.add_page_custom_var("HTTP-code", hit.status)
+        if 'cvar' in hit.args:
+            hit.add_page_custom_var("HTTP-code", hit.status)
+            status_cvar = None
+        else:
+            # The HTTP-code custom variable is usually the only page custom
+            # variable: its JSON only depends on the status.
+            status_cvar = self.status_cvars.get(hit.status)
+            if status_cvar is None:
+                status_cvar = self.status_cvars[hit.status] = json.dumps({1: ["HTTP-code", hit.status]})
 
         args = {
             'rec': '1',
@@ -2088,6 +5364,8 @@ class Recorder:
             del hit.args['idsite']
 
         args.update(hit.args)
+        if status_cvar is not None:
+            args['cvar'] = status_cvar
 
         if hit.is_download:
             args['download'] = args['url']
@@ -2126,75 +5404,330 @@ class Recorder:
         if '_cvar' in args and not isinstance(args['_cvar'], str):
             args['_cvar'] = json.dumps(args['_cvar'])
 
-        return UrlHelper.convert_array_args(args)
+        # Only args from the log line can be PHP arrays, see --replay-tracking
+        if any('[' in key for key in hit.args):
+            return UrlHelper.convert_array_args(args)
+        return args
 
     def _get_host_with_protocol(self, host, main_url):
-        if '://' not in host:
-            parts = urllib.parse.urlparse(main_url)
-            host = parts.scheme + '://' + host
-        return host
+        url_prefix = self.url_prefixes.get((host, main_url))
+        if url_prefix is None:
+            url_prefix = host
+            if '://' not in host:
+                parts = urllib.parse.urlparse(main_url)
+                url_prefix = parts.scheme + '://' + host
+            self.url_prefixes[(host, main_url)] = url_prefix
+        return url_prefix
 
     def _record_hits(self, hits):
         """
         Inserts several hits into Matomo.
         """
-        if not config.options.dry_run:
-            data = {
-                'token_auth': config.options.matomo_token_auth,
-                'requests': [self._get_hit_args(hit) for hit in hits]
-            }
+        hits = self._route_by_site(hits)
+        if config.options.dry_run:
+            self._on_hits_recorded(hits)
+            return
+
+        requests = self._get_hit_requests(hits)
+        if self.exporter is not None:
+            self.exporter.add(hits, requests)
+            self._on_hits_recorded(hits)
+            return
+
+        for start, end in self._split_payload(requests):
+            self._wait_rate_limit(end - start)
+            self._send_payload(hits[start:end], requests[start:end])
+
+    async def _record_hits_async(self, hits):
+        """
+        Same as _record_hits, for the async recorder engine.
+        """
+        hits = self._route_by_site(hits)
+        if config.options.dry_run:
+            self._on_hits_recorded(hits)
+            return
+
+        requests = self._get_hit_requests(hits)
+        if self.exporter is not None:
+            self.exporter.add(hits, requests)
+            self._on_hits_recorded(hits)
+            return
+
+        for start, end in self._split_payload(requests):
+            await self._wait_rate_limit_async(end - start)
+            await self._send_payload_async(hits[start:end], requests[start:end])
+
+    def _route_by_site(self, hits):
+        """
+        Hand the hits of the sites of --routes over to the recorders of their
+        route, and return the other hits.
+        """
+        if self.routes is None or not self.routes.routes_by_site:
+            return hits
+
+        kept = []
+        for route, route_hits in self.routes.split(hits, by_site=True):
+            if route is None:
+                kept.extend(route_hits)
+            else:
+                route.recorder._put(route_hits)
+        return kept
+
+    def _wait_rate_limit(self, hit_count):
+        """
+        Wait before sending a tracking request with --max-hits-per-second or
+        --max-requests-per-second. The halves of a request which has to be
+        split are not charged again.
+        """
+        if self.rate_limiter:
+            time.sleep(self.rate_limiter.get_delay(hit_count))
+
+    async def _wait_rate_limit_async(self, hit_count):
+        if self.rate_limiter:
+            await asyncio.sleep(self.rate_limiter.get_delay(hit_count))
+
+    def _send_payload(self, hits, requests, body=None):
+        """
+        Send one tracking request, whose body may be encoded already (see
+        Serializer). If the request has to be split (see PayloadSizer), each
+        half is sent in turn.
+        """
+        while True:
+            if self.circuit_breaker:
+                delay = self.circuit_breaker.get_delay()
+                if delay:
+                    time.sleep(delay)
+                    continue
+
+            time_start = time.time()
             try:
-                args = {
-                    'queuedtracking': '0'
-                }
+                args, data = self._get_tracking_request(requests)
+                if body is None:
+                    body = self.get_matomo().encode_body(data, compress=True, stream='requests')
+                response = self.get_matomo().call(
+                    config.options.matomo_tracker_endpoint_path, args=args,
+                    expected_content=None,
+                    headers={'Content-type': 'application/json'},
+                    data=body,
+                    on_failure=self._on_tracking_failure,
+                    compress=True,
+                    raise_payload_errors=self.payload_sizer is not None and len(hits) > 1,
+                    raise_hit_errors=self.reject_file is not None,
+                    route=self.route,
+                    hit_count=len(hits),
+                )
+                break
+            except MatomoHttpBase.PayloadError as e:
+                middle = self._on_payload_error(hits, e)
+                self._send_payload(hits[:middle], requests[:middle])
+                self._send_payload(hits[middle:], requests[middle:])
+                return
+            except MatomoHttpBase.HitError as e:
+                for start, end in self._on_hit_error(hits, requests, e):
+                    self._send_payload(hits[start:end], requests[start:end])
+                return
+            except MatomoHttpBase.Error as e:
+                self._on_tracking_error(hits, e)
+                if not (self.circuit_breaker and self.circuit_breaker.on_failure(e)):
+                    raise
 
-                if config.options.debug_tracker:
-                    args['debug'] = '1'
+        self._check_tracking_response(hits, response)
+        self._on_payload_sent(hits, time.time() - time_start)
 
-                response = matomo.call(
+    async def _send_payload_async(self, hits, requests, body=None):
+        """
+        Same as _send_payload, for the async recorder engine.
+        """
+        while True:
+            if self.circuit_breaker:
+                delay = self.circuit_breaker.get_delay()
+                if delay:
+                    await asyncio.sleep(delay)
+                    continue
+
+            time_start = time.time()
+            try:
+                args, data = self._get_tracking_request(requests)
+                if body is None:
+                    body = self.get_matomo().encode_body(data, compress=True, stream='requests')
+                response = await self.get_matomo().call_async(
+                    self.connections,
                     config.options.matomo_tracker_endpoint_path, args=args,
                     expected_content=None,
                     headers={'Content-type': 'application/json'},
-                    data=data,
-                    on_failure=self._on_tracking_failure
+                    data=body,
+                    on_failure=self._on_tracking_failure,
+                    compress=True,
+                    raise_payload_errors=self.payload_sizer is not None and len(hits) > 1,
+                    raise_hit_errors=self.reject_file is not None,
+                    route=self.route,
+                    hit_count=len(hits),
                 )
+                break
+            except MatomoHttpBase.PayloadError as e:
+                middle = self._on_payload_error(hits, e)
+                await self._send_payload_async(hits[:middle], requests[:middle])
+                await self._send_payload_async(hits[middle:], requests[middle:])
+                return
+            except MatomoHttpBase.HitError as e:
+                for start, end in self._on_hit_error(hits, requests, e):
+                    await self._send_payload_async(hits[start:end], requests[start:end])
+                return
+            except MatomoHttpBase.Error as e:
+                self._on_tracking_error(hits, e)
+                if not (self.circuit_breaker and self.circuit_breaker.on_failure(e)):
+                    raise
 
-                if config.options.debug_tracker:
-                    logging.debug('tracker response:\n%s' % response)
+        self._check_tracking_response(hits, response)
+        self._on_payload_sent(hits, time.time() - time_start)
 
-                # check for invalid requests
-                try:
-                    response = json.loads(response)
-                except:
-                    logging.info("bulk tracking returned invalid JSON")
+    def _get_hit_requests(self, hits):
+        requests = []
+        for hit in hits:
+            try:
+                requests.append(self._get_hit_args(hit))
+            except MatomoHttpBase.Error as e:
+                # The Matomo API failed to tell the site of the hit.
+                logging.error('Cannot find the site of the hit of %s line %s: %s', hit.filename, hit.lineno, e)
+                raise
+        return requests
+
+    def _split_payload(self, requests):
+        """
+        Return the (start, end) ranges of the requests to send in each
+        tracking request, so that none has more hits than chosen by the
+        PayloadSizer or is bigger than --recorder-max-payload-bytes.
+        """
+        max_size = self._get_payload_size()
+        if max_size < 1:
+            max_size = len(requests)
+        max_bytes = config.options.recorder_max_payload_bytes
+
+        ranges = []
+        start = 0
+        payload_bytes = 0
+        for i, request in enumerate(requests):
+            request_bytes = len(json.dumps(request)) + 2 if max_bytes else 0
+            if i > start and (i - start >= max_size or (max_bytes and payload_bytes + request_bytes > max_bytes)):
+                ranges.append((start, i))
+                start = i
+                payload_bytes = 0
+            payload_bytes += request_bytes
+        ranges.append((start, len(requests)))
+        return ranges
+
+    def _get_tracking_request(self, requests):
+        """
+        Returns the args and data of the bulk tracking request.
+        """
+        data = {
+            'token_auth': (self.destination is not None and self.destination.token_auth) or config.options.matomo_token_auth,
+            'requests': requests,
+        }
+        args = {
+            'queuedtracking': '0'
+        }
+
+        if config.options.debug_tracker:
+            args['debug'] = '1'
 
-                    # don't display the tracker response if we're debugging the tracker.
-                    # debug tracker output will always break the normal JSON output.
-                    if not config.options.debug_tracker:
-                        logging.info("tracker response:\n%s" % response)
+        return args, data
 
-                    response = {}
+    def _check_tracking_response(self, hits, response):
+        if config.options.debug_tracker:
+            logging.debug('tracker response:\n%s' % response)
 
-                if ('invalid_indices' in response and isinstance(response['invalid_indices'], list) and
-                    response['invalid_indices']):
-                    invalid_count = len(response['invalid_indices'])
+        # check for invalid requests
+        try:
+            response = json.loads(response)
+        except:
+            logging.info("bulk tracking returned invalid JSON")
 
-                    invalid_lines = [str(hits[index].lineno) for index in response['invalid_indices']]
-                    invalid_lines_str = ", ".join(invalid_lines)
+            # don't display the tracker response if we're debugging the tracker.
+            # debug tracker output will always break the normal JSON output.
+            if not config.options.debug_tracker:
+                logging.info("tracker response:\n%s" % response)
 
-                    stats.invalid_lines.extend(invalid_lines)
+            response = {}
 
-                    logging.info("The Matomo tracker identified %s invalid requests on lines: %s" % (invalid_count, invalid_lines_str))
-                elif 'invalid' in response and response['invalid'] > 0:
-                    logging.info("The Matomo tracker identified %s invalid requests." % response['invalid'])
-            except MatomoHttpBase.Error as e:
-                # if the server returned 400 code, BulkTracking may not be enabled
-                if e.code == 400:
-                    fatal_error("Server returned status 400 (Bad Request).\nIs the BulkTracking plugin disabled?", hits[0].filename, hits[0].lineno)
+        if ('invalid_indices' in response and isinstance(response['invalid_indices'], list) and
+            response['invalid_indices']):
+            invalid_count = len(response['invalid_indices'])
 
-                raise
+            invalid_lines = [str(hits[index].lineno) for index in response['invalid_indices']]
+            invalid_lines_str = ", ".join(invalid_lines)
+
+            if not self.is_mirror():
+                stats.invalid_lines.extend(invalid_lines)
+
+            logging.info("The Matomo tracker identified %s invalid requests on lines: %s" % (invalid_count, invalid_lines_str))
+        elif 'invalid' in response and response['invalid'] > 0:
+            logging.info("The Matomo tracker identified %s invalid requests." % response['invalid'])
+
+    def _on_tracking_error(self, hits, e):
+        # if the server returned 400 code, BulkTracking may not be enabled
+        if e.code == 400:
+            fatal_error("Server returned status 400 (Bad Request).\nIs the BulkTracking plugin disabled?", hits[0].filename, hits[0].lineno)
 
-        stats.count_lines_recorded.advance(len(hits))
+    def _on_payload_error(self, hits, e):
+        """
+        Returns where to split the hits of a request that timed out or was too
+        large.
+        """
+        logging.info('Splitting a tracking request of %d hits in two: %s', len(hits), e)
+        self.payload_sizer.on_split(len(hits))
+        if self.circuit_breaker:
+            self.circuit_breaker.on_split()
+        return len(hits) // 2
+
+    def _on_hit_error(self, hits, requests, e):
+        """
+        Returns the (start, end) ranges of the hits to send again after the
+        tracker failed to track some invalid hits of a request. A hit failing
+        alone is rejected. Otherwise, the hits are sent again in two halves:
+        the number of hits the tracker says it tracked is not trusted, as the
+        bulk request is rolled back when it runs in a transaction.
+        """
+        if self.circuit_breaker:
+            # Matomo answered.
+            self.circuit_breaker.on_success()
+
+        if len(hits) == 1:
+            logging.info('The tracker failed to track the hit of %s line %s: %s', hits[0].filename, hits[0].lineno, e)
+            url = self.destination.urls[0] if self.destination is not None else config.options.matomo_url
+            self.reject_file.add(hits[0], requests[0], e, url)
+            if self.is_mirror():
+                self.destination.count_lines_rejected.increment()
+            else:
+                stats.count_lines_rejected.increment()
+            self._acknowledge(hits)
+            return []
+
+        middle = len(hits) // 2
+        return [(0, middle), (middle, len(hits))]
+
+    def _on_payload_sent(self, hits, response_time):
+        if self.circuit_breaker:
+            self.circuit_breaker.on_success()
+        if self.payload_sizer:
+            self.payload_sizer.on_response(len(hits), response_time)
+        if self.tuner:
+            self.tuner.on_response(response_time)
+        self._on_hits_recorded(hits)
+
+    def _on_hits_recorded(self, hits):
+        if not self.is_mirror():
+            stats.count_lines_recorded.advance(len(hits))
+        if self.destination is not None:
+            self.destination.count_lines_recorded.advance(len(hits))
+        self._acknowledge(hits)
+
+    def _acknowledge(self, hits):
+        # The --checkpoint follows the hits sent to --url.
+        if config.options.checkpoint and not self.is_mirror():
+            checkpoint.acknowledge(hits)
+        if self.spool is not None:
+            self.spool.acknowledge(hits)
 
     def _is_json(self, result):
         try:
@@ -2235,6 +5768,8 @@ class Hit:
 
     def get_visitor_id_hash(self):
         visitor_id = self.ip
+        if config.options.partition_key == 'ip-ua':
+            visitor_id = (self.ip, self.user_agent)
 
         if config.options.replay_tracking:
             for param_name_to_use in ['uid', 'cid', '_id', 'cip']:
@@ -2267,6 +5802,279 @@ class Hit:
         index = len(self.args[api_arg_name]) + 1
         self.args[api_arg_name][index] = [key, value]
 
+class LogFile:
+    """
+    A log file read in binary mode. Lines are decoded as they are read and the
+    byte offset of the next line is tracked, which allows splitting a log file
+    in byte ranges and seeking to a given line. Like in the universal newlines
+    mode of text files, lines end with \n, \r\n or \r.
+    """
+
+    def __init__(self, file, encoding):
+        self.file = file
+        self.encoding = encoding
+        self.offset = 0
+        self.last_line = None
+        # Lines ending with \r read along with the next ones.
+        self.pending_lines = collections.deque()
+
+    @staticmethod
+    def supports_encoding(encoding):
+        # Lines are split on the newline byte, so the encoding must be a
+        # superset of ASCII (which rules out UTF-16 for example).
+        try:
+            return '\n'.encode(encoding) == b'\n'
+        except LookupError:
+            return False
+
+    def readline(self):
+        if self.pending_lines:
+            return self._decode_line(self.pending_lines.popleft())
+        return self._split_line(self.file.readline())
+
+    def _split_line(self, line):
+        """
+        Return the first line of data read up to a \n, keeping the lines
+        ending with \r only before it for the next calls.
+        """
+        end = line.find(b'\r')
+        if end != -1 and end < len(line) - 2:
+            # Rare: some lines end with \r only.
+            pieces = line.split(b'\r')
+            lines = [piece + b'\r' for piece in pieces[:-1]]
+            if pieces[-1] == b'\n':
+                lines[-1] += b'\n'
+            elif pieces[-1]:
+                lines.append(pieces[-1])
+            line = lines[0]
+            self.pending_lines.extend(lines[1:])
+        return self._decode_line(line)
+
+    def _decode_line(self, line):
+        self.offset += len(line)
+        if line:
+            self.last_line = line
+        line = line.decode(self.encoding, 'surrogateescape')
+
+        # Behave like universal newlines mode of text files.
+        if line.endswith('\r\n'):
+            line = line[:-2] + '\n'
+        elif line.endswith('\r'):
+            line = line[:-1] + '\n'
+        return line
+
+    def read(self, size):
+        data = self.file.read(size)
+        self.offset += len(data)
+        return data.decode(self.encoding, 'surrogateescape')
+
+    def seek(self, offset):
+        self.file.seek(offset)
+        self.offset = offset
+        self.pending_lines.clear()
+
+    def tell(self):
+        return self.offset
+
+    def close(self):
+        self.file.close()
+
+class FileWatcher:
+    """
+    Waits for log files to change, using inotify on Linux and polling on other
+    platforms.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+
+    POLL_INTERVAL = 1 # seconds
+
+    def __init__(self):
+        self.libc = None
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            logging.debug('inotify is not available, polling the log file for changes.')
+            return
+        if fd >= 0:
+            self.libc = libc
+            self.fd = fd
+
+    def watch(self, filename):
+        """
+        Watch changes to the file and the creation of files in its directory,
+        which is how a rotated log file is replaced.
+        """
+        if self.fd is None:
+            return
+
+        watches = (
+            (filename, self.IN_MODIFY | self.IN_ATTRIB | self.IN_MOVE_SELF | self.IN_DELETE_SELF),
+            (os.path.dirname(os.path.abspath(filename)), self.IN_CREATE | self.IN_MOVED_TO),
+        )
+        for path, mask in watches:
+            if self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+                logging.debug('Cannot watch %s with inotify (%s), polling the log file for changes.',
+                              path, os.strerror(ctypes.get_errno()))
+                self.close()
+                return
+
+    def wait(self, timeout):
+        """
+        Wait until a watched file changes, or for at most timeout seconds.
+        """
+        if self.fd is None:
+            time.sleep(min(timeout, self.POLL_INTERVAL))
+            return
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            # The events themselves don't matter, the caller checks the file.
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except OSError:
+                pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class LogFollower(LogFile):
+    """
+    A log file that keeps being read as it grows, like tail -F. When the file
+    is rotated, the rest of the old file is read before the new one is opened,
+    and when it is truncated it is read again from the beginning.
+
+    Once follow is set, readline() only returns complete lines, and returns
+    None when no line was written for TICK_INTERVAL seconds so the caller can
+    do some periodic work.
+    """
+
+    TICK_INTERVAL = 1 # seconds
+
+    def __init__(self, filename, encoding):
+        super(LogFollower, self).__init__(open(filename, 'rb'), encoding)
+        self.filename = filename
+        self.follow = False
+        # Set when the file was reopened or read again from the beginning.
+        self.reopened = False
+        self.stat = os.fstat(self.file.fileno())
+        self.watcher = FileWatcher()
+        self.watcher.watch(filename)
+
+    def readline(self):
+        if not self.follow or self.pending_lines:
+            return super(LogFollower, self).readline()
+
+        line = self.file.readline()
+        if line.endswith(b'\n'):
+            return self._split_line(line)
+
+        if self._is_rotated():
+            if line:
+                # The last line of the rotated file will never be completed.
+                return self._split_line(line)
+            if self._reopen():
+                return self.readline()
+        elif line:
+            # Wait for the rest of the line.
+            self.file.seek(self.offset)
+        elif os.fstat(self.file.fileno()).st_size < self.offset:
+            logging.info('%s was truncated, reading it from the beginning.', self.filename)
+            self.seek(0)
+            self.reopened = True
+            return self.readline()
+
+        self.watcher.wait(self.TICK_INTERVAL)
+        return None
+
+    def wait_for_content(self, stopped):
+        """
+        Wait until the file is not empty, so that its format can be detected.
+        Returns False if the stopped callable returned True first.
+        """
+        while os.fstat(self.file.fileno()).st_size == 0:
+            if stopped():
+                return False
+            if self._is_rotated():
+                self._reopen()
+            else:
+                self.watcher.wait(self.TICK_INTERVAL)
+        return True
+
+    def _is_rotated(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            # Removed and not created again yet.
+            return False
+        return (stat.st_dev, stat.st_ino) != (self.stat.st_dev, self.stat.st_ino)
+
+    def _reopen(self):
+        try:
+            file = open(self.filename, 'rb')
+        except IOError:
+            return False
+
+        logging.info('%s was rotated, reading the new log file.', self.filename)
+        self.file.close()
+        self.file = file
+        self.stat = os.fstat(file.fileno())
+        self.offset = 0
+        self.reopened = True
+        self.watcher.watch(self.filename)
+        return True
+
+    def close(self):
+        self.watcher.close()
+        super(LogFollower, self).close()
+
+class StreamReader:
+    """
+    Reads the lines of a stream (stdin) in a thread, so that readline() can
+    return None when no line was received for TICK_INTERVAL seconds, like
+    LogFollower does.
+    """
+
+    TICK_INTERVAL = 1 # seconds
+    QUEUE_SIZE = 10000 # lines
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lines = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.eof = False
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        try:
+            for line in iter(self.stream.readline, ''):
+                self.lines.put(line)
+        finally:
+            self.lines.put('')
+
+    def readline(self):
+        if self.eof:
+            return ''
+
+        try:
+            line = self.lines.get(timeout=self.TICK_INTERVAL)
+        except queue.Empty:
+            return None
+        if not line:
+            self.eof = True
+        return line
+
 class Parser:
     """
     The Parser parses the lines in a specified file and inserts them into
@@ -2277,6 +6085,16 @@ class Parser:
         self.check_methods = [method for name, method
                               in inspect.getmembers(self, predicate=inspect.ismethod)
                               if name.startswith('check_')]
+        # Set to stop parsing the followed log file, see stop_following
+        self.following_stopped = False
+
+    def stop_following(self, signum=None, frame=None):
+        """
+        Stop parsing the followed log file once the current line is parsed,
+        eg. on Ctrl+C, so that the parsed hits are recorded and its position
+        saved.
+        """
+        self.following_stopped = True
 
     ## All check_* methods are called for each hit and must return True if the
     ## hit can be imported, False otherwise.
@@ -2476,9 +6294,40 @@ class Parser:
 
         return (False, None)
 
-    def parse(self, filename):
+    @staticmethod
+    def open_log_file(filename, follow=False, track_offsets=False):
+        """
+        Open a (possibly compressed) log file for parsing. If track_offsets is
+        True, the file is read with LogFile when possible, which is slower than
+        a text file.
+        """
+        if follow:
+            return LogFollower(filename, config.options.encoding)
+
+        if filename.endswith('.bz2'):
+            open_func = bz2.open
+        elif filename.endswith('.gz'):
+            open_func = gzip.open
+        else:
+            open_func = open
+
+        if track_offsets and LogFile.supports_encoding(config.options.encoding):
+            return LogFile(open_func(filename, mode='rb'), config.options.encoding)
+        return open_func(filename, mode='rt', encoding=config.options.encoding, errors="surrogateescape")
+
+    def parse(self, filename, byte_range=None, follow=False):
         """
         Parse the specified filename and insert hits in the queue.
+
+        byte_range can be set to a (start, end, first_lineno) tuple to only
+        parse the lines starting between the start and end byte offsets of an
+        uncompressed file, first_lineno being the number of lines before start.
+
+        If follow is True, the file keeps being parsed as it grows until
+        stop_following is called (see LogFollower).
+
+        Returns the (offset, lineno, last line) where parsing ended, or None if
+        positions in the file cannot be tracked.
         """
         def invalid_line(line, reason):
             stats.count_lines_invalid.increment()
@@ -2498,17 +6347,23 @@ class Parser:
                 print("\n=====> Warning: File %s does not exist <=====" % filename, file=sys.stderr)
                 return
             else:
-                if filename.endswith('.bz2'):
-                    open_func = bz2.open
-                elif filename.endswith('.gz'):
-                    open_func = gzip.open
-                else:
-                    open_func = open
+                # Positions in the file are only needed to split it, and to
+                # resume its import.
+                track_offsets = bool(
+                    byte_range or config.options.checkpoint or config.options.resume or config.options.ledger
+                )
+                file = self.open_log_file(filename, follow, track_offsets)
 
-                file = open_func(filename, mode='rt', encoding=config.options.encoding, errors="surrogateescape")
+        if follow:
+            if not file.wait_for_content(lambda: self.following_stopped):
+                file.close()
+                return
 
         if config.options.show_progress:
-            print(('Parsing log %s...' % filename))
+            if byte_range:
+                print(('Parsing log %s (bytes %d to %d)...' % (filename, byte_range[0], byte_range[1])))
+            else:
+                print(('Parsing log %s...' % filename))
 
         if config.format:
             # The format was explicitly specified.
@@ -2554,9 +6409,42 @@ class Parser:
 
         hits = []
         lineno = -1
+        end = None
+        track_offsets = isinstance(file, LogFile)
+        if byte_range:
+            start, end, lineno = byte_range
+            lineno -= 1
+            file.seek(start)
+        elif track_offsets:
+            position = self._get_start_position(filename)
+            if position is not None:
+                logging.debug('Resuming the import of %s at line %d', filename, position[1])
+                file.seek(position[0])
+                lineno = position[1] - 1
+
+        flush_interval = config.options.flush_interval
+        flush_time = None
+        if follow:
+            file.follow = True
+        elif flush_interval and file is sys.stdin:
+            file = StreamReader(file)
+
         while True:
+            if end is not None and file.tell() >= end:
+                break
+            if follow and self.following_stopped:
+                break
             line = file.readline()
+            if line is None:
+                # No new line was received for a while.
+                if hits and flush_interval and time.time() >= flush_time:
+                    self._add_hits(hits)
+                    hits = []
+                continue
             if not line: break
+            if follow and file.reopened:
+                file.reopened = False
+                lineno = -1
             lineno = lineno + 1
 
             stats.count_lines_parsed.increment()
@@ -2571,13 +6459,14 @@ class Parser:
             valid_lines_count = valid_lines_count + 1
             if config.options.debug_request_limit and valid_lines_count >= config.options.debug_request_limit:
                 if len(hits) > 0:
-                    Recorder.add_hits(hits)
+                    self._add_hits(hits)
                 logging.info("Exceeded limit specified in --debug-request-limit, exiting.")
                 return
 
             hit = Hit(
                 filename=filename,
                 lineno=lineno,
+                offset=file.tell() if track_offsets else None,
                 status=format.get('status'),
                 full_path=format.get('path'),
                 is_download=False,
@@ -2741,14 +6630,44 @@ class Parser:
                 continue
 
             hits.append(hit)
+            if flush_interval and len(hits) == 1:
+                flush_time = time.time() + flush_interval
 
-            if len(hits) >= config.options.recorder_max_payload_size * len(Recorder.recorders):
-                Recorder.add_hits(hits)
+            if len(hits) >= self._get_max_hits_per_batch() or (flush_interval and time.time() >= flush_time):
+                self._add_hits(hits)
                 hits = []
 
         # add last chunk of hits
         if len(hits) > 0:
-            Recorder.add_hits(hits)
+            self._add_hits(hits)
+
+        if track_offsets:
+            return (file.tell(), lineno + 1, file.last_line)
+
+    def _get_start_position(self, filename):
+        """
+        Return the (offset, lineno) to start parsing filename at, from the
+        --resume checkpoint or the ledger, whichever is further.
+        """
+        positions = []
+        if config.options.resume:
+            positions.append(checkpoint.get_position(filename))
+        if config.options.ledger:
+            positions.append(config.ledger.get_start_position(filename))
+
+        positions = [position for position in positions if position is not None]
+        if not positions:
+            return None
+        return max(positions)
+
+    def _add_hits(self, hits):
+        """
+        Hand a batch of parsed hits over to the recorders.
+        """
+        Recorder.add_hits(hits)
+
+    def _get_max_hits_per_batch(self):
+        return config.options.recorder_max_payload_size * len(Recorder.recorders)
 
     def is_hit_for_tracker(self, hit):
         filesToCheck = ['piwik.php', 'matomo.php']
@@ -2775,10 +6694,247 @@ class Parser:
                 else:
                     hit.add_visit_custom_var(custom_var_name, value)
 
+class ParseWorkerParser(Parser):
+    """
+    The Parser used in parse worker processes. Instead of adding hits to the
+    Recorders, it sends them to the main process along with the parser
+    counters updated since the last batch.
+    """
+
+    def __init__(self, worker_id, results):
+        super(ParseWorkerParser, self).__init__()
+        self.worker_id = worker_id
+        self.results = results
+        self.last_counts = stats.get_parser_counts()
+
+    def get_counts_delta(self):
+        counts = stats.get_parser_counts()
+        delta = dict(
+            (name, value - self.last_counts[name])
+            for name, value in counts.items()
+        )
+        self.last_counts = counts
+        return delta
+
+    def _add_hits(self, hits):
+        self.results.put(('hits', self.worker_id, hits, self.get_counts_delta()))
+
+    def _get_max_hits_per_batch(self):
+        # Workers are forked before the recorders are launched.
+        if config.options.recorders_auto:
+            return config.options.recorder_max_payload_size * RecorderTuner.MAX_RECORDERS
+        return config.options.recorder_max_payload_size * config.options.recorders
+
+class ParserPool:
+    """
+    Parses log files in several worker processes at once. Each worker parses
+    one whole file at a time and sends the hits back to the main process, which
+    adds them to the Recorders.
+    """
+
+    # In a worker process, its ID and the queue of results, where fatal errors
+    # are sent to the main process (see fatal_error).
+    worker_id = None
+    worker_results = None
+
+    def __init__(self, worker_count):
+        self.worker_count = worker_count
+        self.context = multiprocessing.get_context('fork')
+        self.tasks = self.context.Queue()
+        # Bounded, so workers wait when the recorders can't keep up.
+        self.results = self.context.Queue(maxsize=worker_count * 2)
+        self.workers = []
+
+    @staticmethod
+    def is_supported():
+        # Workers inherit the configuration, resolver and statistics objects
+        # of the main process, which is only possible when forking.
+        return 'fork' in multiprocessing.get_all_start_methods()
+
+    def start(self):
+        """
+        Fork the workers. Must be called before any thread is started.
+        """
+        parent_pid = os.getpid()
+        for worker_id in range(self.worker_count):
+            process = self.context.Process(target=self._run, args=(worker_id, parent_pid))
+            process.daemon = True
+            process.start()
+            self.workers.append(process)
+            logging.debug('Launched parse worker')
+
+    def _run(self, worker_id, parent_pid):
+        # Ctrl+C is handled by the main process.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        ParserPool.worker_id = worker_id
+        ParserPool.worker_results = self.results
+
+        worker_parser = ParseWorkerParser(worker_id, self.results)
+        while True:
+            try:
+                task = self.tasks.get(timeout=1)
+            except queue.Empty:
+                if os.getppid() != parent_pid:
+                    # The main process died (eg, after a fatal error).
+                    return
+                continue
+
+            if task is None:
+                return
+
+            action, filename, byte_range = task
+            if action == 'count':
+                start, end = byte_range
+                count = self._count_lines(filename, start, end)
+                self.results.put(('counted', worker_id, (filename, start, count), {}))
+            else:
+                end_position = worker_parser.parse(filename, byte_range)
+                self.results.put(('done', worker_id, (filename, end_position), worker_parser.get_counts_delta()))
+
+    @staticmethod
+    def _count_lines(filename, start, end):
+        """
+        Count the lines between two offsets, ending with \n, \r\n or \r (see
+        LogFile).
+        """
+        count = 0
+        last_byte = b''
+        with open(filename, 'rb') as file:
+            file.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = file.read(min(remaining, 1024 * 1024))
+                if not data:
+                    break
+                count += data.count(b'\n')
+                if b'\r' in data:
+                    count += data.count(b'\r') - data.count(b'\r\n')
+                if last_byte == b'\r' and data.startswith(b'\n'):
+                    # A \r\n split between two reads.
+                    count -= 1
+                last_byte = data[-1:]
+                remaining -= len(data)
+        return count
+
+    @staticmethod
+    def split(filename, chunk_size):
+        """
+        Return the (start, end) byte ranges to split the specified log file
+        into, each range starting at the beginning of a line. Returns None if
+        the file should be parsed as a whole.
+        """
+        if (not chunk_size or filename.endswith('.bz2') or filename.endswith('.gz')
+                or not LogFile.supports_encoding(config.options.encoding)):
+            return None
+
+        if config.options.ledger and config.ledger.get_start_position(filename):
+            # Only the end of the file is parsed.
+            return None
+
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            # The worker will report the missing file.
+            return None
+
+        if size <= chunk_size:
+            return None
+
+        boundaries = [0]
+        with open(filename, 'rb') as file:
+            while boundaries[-1] + chunk_size < size:
+                file.seek(boundaries[-1] + chunk_size - 1)
+                file.readline()
+                if file.tell() >= size:
+                    break
+                boundaries.append(file.tell())
+        boundaries.append(size)
+
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def parse(self, filenames):
+        """
+        Parse the specified files in the workers and add the hits they send
+        back to the Recorders. Returns once every file has been parsed.
+
+        Big uncompressed files are split into chunks parsed by different
+        workers. The lines of each chunk, except the last one, are counted
+        first so that hits still get their line number in the whole file.
+        """
+        pending = 0
+        chunks = {}
+        line_counts = {}
+        whole_files = []
+        for filename in filenames:
+            ranges = self.split(filename, config.options.parse_chunk_size)
+            if ranges:
+                chunks[filename] = ranges
+                line_counts[filename] = {}
+                for start, end in ranges[:-1]:
+                    self.tasks.put(('count', filename, (start, end)))
+                    pending += 1
+            else:
+                whole_files.append(filename)
+
+        for filename in whole_files:
+            self.tasks.put(('parse', filename, None))
+            pending += 1
+
+        while pending > 0:
+            try:
+                kind, worker_id, payload, counts = self.results.get(timeout=1)
+            except queue.Empty:
+                self._check_workers()
+                continue
+
+            stats.add_parser_counts(counts)
+            if kind == 'hits':
+                Recorder.add_hits(payload)
+                continue
+            if kind == 'error':
+                # The spool, checkpoint and exporter of the main process are
+                # saved, rather than the stale copies of the worker.
+                fatal_error(*payload)
+
+            pending -= 1
+            if kind == 'done':
+                filename, end_position = payload
+                if end_position is not None and config.options.ledger:
+                    config.ledger.record(filename, end_position)
+            elif kind == 'counted':
+                filename, start, count = payload
+                line_counts[filename][start] = count
+                if len(line_counts[filename]) == len(chunks[filename]) - 1:
+                    first_lineno = 0
+                    for start, end in chunks[filename]:
+                        self.tasks.put(('parse', filename, (start, end, first_lineno)))
+                        pending += 1
+                        first_lineno += line_counts[filename].get(start, 0)
+
+    def _check_workers(self):
+        for process in self.workers:
+            if not process.is_alive():
+                fatal_error('a parse worker exited unexpectedly (exit code: %s)' % process.exitcode)
+
+    def stop(self):
+        for dummy in self.workers:
+            self.tasks.put(None)
+        for process in self.workers:
+            process.join()
+
 def main():
     """
     Start the importing process.
     """
+    parser_pool = None
+    filenames = config.filenames
+    if config.options.parse_workers and not config.options.dump_log_regex and not config.options.replay_requests:
+        if ParserPool.is_supported():
+            parser_pool = ParserPool(config.options.parse_workers)
+            parser_pool.start()
+        else:
+            logging.info('--parse-workers is not supported on this platform, parsing log files in the main process.')
+
     stats.set_time_start()
 
     if config.options.show_progress:
@@ -2786,14 +6942,66 @@ def main():
 
     recorders = Recorder.launch(config.options.recorders)
 
+    followed_filename = None
+    if config.options.follow:
+        followed_filename = filenames[-1]
+        filenames = filenames[:-1]
+
+    completed = False
     try:
-        for filename in config.filenames:
-            parser.parse(filename)
+        if config.options.replay_requests:
+            # The files hold tracking requests rather than log lines.
+            Recorder.replay(filenames)
+            filenames = []
+
+        if parser_pool:
+            # stdin can only be read by the main process
+            parser_pool.parse([filename for filename in filenames if filename != '-'])
+            parser_pool.stop()
+            filenames = [filename for filename in filenames if filename == '-']
+
+        for filename in filenames:
+            end_position = parser.parse(filename)
+            if end_position is not None and config.options.ledger:
+                config.ledger.record(filename, end_position)
+
+        if followed_filename:
+            # Ctrl+C stops following the log file: the hits parsed so far are
+            # recorded, and its position is saved.
+            previous_handler = signal.signal(signal.SIGINT, parser.stop_following)
+            try:
+                end_position = parser.parse(followed_filename, follow=True)
+            finally:
+                signal.signal(signal.SIGINT, previous_handler)
+            if end_position is not None and config.options.ledger:
+                config.ledger.record(followed_filename, end_position)
 
         Recorder.wait_empty()
+        completed = True
+
+        if config.options.ledger:
+            config.ledger.save()
     except KeyboardInterrupt:
         pass
 
+    if Recorder.reject_file:
+        Recorder.reject_file.close()
+
+    if Recorder.spool:
+        Recorder.spool.close()
+    for mirror in Recorder.mirrors:
+        if mirror.recorder.spool:
+            mirror.recorder.spool.close()
+
+    if Recorder.exporter and not Recorder.exporter.close(completed) and Recorder.exporter.file_count:
+        print((
+            'The import was interrupted: the exported requests are left in .part files in "%s", '
+            'which are not replayed.' % config.options.export_requests
+        ), file=sys.stderr)
+
+    if config.options.checkpoint:
+        checkpoint.save()
+
     stats.set_time_stop()
 
     if config.options.show_progress:
@@ -2802,8 +7010,48 @@ def main():
     stats.print_summary()
 
 def fatal_error(error, filename=None, lineno=None):
+    if ParserPool.worker_results is not None:
+        # In a parse worker: the main process stops the import.
+        ParserPool.worker_results.put(('error', ParserPool.worker_id, (str(error), filename, lineno), {}))
+        ParserPool.worker_results.close()
+        ParserPool.worker_results.join_thread()
+        os._exit(1)
+
     print('Fatal error: %s' % error, file=sys.stderr)
-    if filename and lineno is not None:
+
+    try:
+        checkpoint_enabled = config.options.checkpoint and checkpoint is not None
+    except (NameError, AttributeError):
+        # the configuration is not created yet
+        checkpoint_enabled = False
+
+    exporter = getattr(Recorder, 'exporter', None)
+    if isinstance(exporter, RequestExporter):
+        exporter.close(complete=False)
+        print((
+            'The requests exported so far are left in .part files in "%s", which are not replayed.\n' % exporter.path
+        ), file=sys.stderr)
+
+    for mirror in getattr(Recorder, 'mirrors', ()):
+        if isinstance(getattr(mirror.recorder, 'spool', None), Spool):
+            mirror.recorder.spool.save()
+
+    spool = getattr(Recorder, 'spool', None)
+    spool_enabled = isinstance(spool, Spool)
+    if spool_enabled:
+        spool.save()
+        print((
+            'The hits not recorded yet are kept in the spool "%s": they are sent first by '
+            'the next import run with --spool=%s.\n' % (spool.path, spool.path)
+        ), file=sys.stderr)
+
+    if checkpoint_enabled:
+        checkpoint.save()
+        print((
+            'You can restart the import from the last recorded hit of each log file '
+            'by running the same command with --resume (progress is saved in "%s").\n' % config.options.checkpoint
+        ), file=sys.stderr)
+    elif filename and lineno is not None and not spool_enabled:
         print((
             'You can restart the import of "%s" from the point it failed by '
             'specifying --skip=%d on the command line.\n' % (filename, lineno)
@@ -2820,6 +7068,7 @@ if __name__ == '__main__':
         # it after creating the matomo object.
         config.init_token_auth()
         stats = Statistics()
+        checkpoint = config.get_checkpoint()
         resolver = config.get_resolver()
         parser = Parser()
         main()
@@ -1,12 +1,21 @@
 # vim: et sw=4 ts=4:
 import datetime
+import gzip
+import http.server
+import io
 import json
 import os
 import re
+import socketserver
 from collections import OrderedDict
 
+import pytest
+
 import import_logs
 
+# Tests replace import_logs.Recorder with a mock.
+RealRecorder = import_logs.Recorder
+
 
 # utility functions
 def add_junk_to_file(path):
@@ -57,6 +66,14 @@ def use_ipv6_in_file(path):
 
     return 'tmp.log'
 
+def write_common_log_file(path, count):
+    file = open(path, 'w')
+    for i in range(count):
+        file.write('1.2.3.%d - - [10/Feb/2012:16:42:%02d -0500] "GET /page/%d HTTP/1.0" 200 368 "-" "Mozilla/5.0"\n' % (i, i % 60, i))
+    file.close()
+
+    return path
+
 def tearDownModule():
     if os.path.exists('tmp.log'):
         os.remove('tmp.log')
@@ -171,6 +188,9 @@ class Options(object):
         self.force_lowercase_path = False
         self.included_paths = []
         self.enable_http_errors = False
+        self.strip_query_string = False
+        self.reverse_dns = False
+        self.title_category_delimiter = '/'
         self.download_extensions = 'doc,pdf'
         self.custom_w3c_fields = {}
         self.dump_log_regex = False
@@ -189,6 +209,49 @@ class Options(object):
         self.track_http_method = True
         self.seconds_to_add_to_date = 0
         self.request_suffix = None
+        self.parse_chunk_size = 0
+        self.checkpoint = None
+        self.resume = False
+        self.ledger = None
+        self.follow = False
+        self.flush_interval = None
+        self.matomo_url = None
+        self.matomo_tracker_urls = None
+        self.request_timeout = 5
+        self.auth_user = None
+        self.auth_password = None
+        self.accept_invalid_ssl_certificate = False
+        self.compress_requests = None
+        self.chunked_requests = False
+        self.recorders = 1
+        self.recorders_auto = False
+        self.recorder_engine = 'threads'
+        self.partition_key = 'ip'
+        self.recorder_queue_size = 16 * 1024 * 1024
+        self.serializer_queue_size = 0
+        self.spool = None
+        self.routes = None
+        self.mirror_urls = []
+        self.mirror_token_auths = []
+        self.export_requests = None
+        self.export_main_url = None
+        self.export_shards = 16
+        self.replay_requests = False
+        self.reject_file = None
+        self.max_attempts = 3
+        self.delay_after_failure = 10
+        self.max_delay_after_failure = 300
+        self.circuit_breaker_timeout = 0
+        self.max_hits_per_second = None
+        self.max_requests_per_second = None
+        self.rate_limit_hours = None
+        self.recorder_target_response_time = None
+        self.recorder_max_payload_bytes = 0
+        self.use_bulk_tracking = True
+        self.dry_run = False
+        self.debug_tracker = False
+        self.matomo_token_auth = 'token'
+        self.matomo_tracker_endpoint_path = '/matomo.php'
 
 class Config(object):
     """Mock configuration."""
@@ -196,6 +259,7 @@ class Config(object):
     def __init__(self):
         self.options = Options()
         self.format = import_logs.FORMATS['ncsa_extended']
+        self.mirrors = []
 
 class Resolver(object):
     """Mock resolver which doesn't check connection to real piwik."""
@@ -1093,6 +1157,30 @@ def test_log_file_with_random_encoding():
     assert hits[0]['path'] == '/為其兼行惡道'
 
 
+def test_log_file_newlines():
+    """Test that LogFile splits lines on \\n, \\r\\n and \\r, like text files in universal newlines mode."""
+
+    data = b'a\nb\r\nc\rd\r\re\r\nf'
+    file_ = import_logs.LogFile(io.BytesIO(data), 'utf-8')
+    lines = []
+    while True:
+        line = file_.readline()
+        if not line:
+            break
+        lines.append((line, file_.tell()))
+    assert [line for line, offset in lines] == io.TextIOWrapper(io.BytesIO(data), newline=None).readlines()
+    assert [offset for line, offset in lines] == [2, 5, 7, 9, 10, 13, 14]
+
+    file_.seek(5)
+    assert file_.readline() == 'c\n'
+
+    # Log files are only read with LogFile when positions in them are needed.
+    for track_offsets in (False, True):
+        file_ = import_logs.Parser.open_log_file('logs/common.log', track_offsets=track_offsets)
+        assert isinstance(file_, import_logs.LogFile) == track_offsets
+        file_.close()
+
+
 def test_ignore_groups_option_removes_groups():
     """Test that the --ignore-groups option removes groups so they do not appear in hits."""
 
@@ -1332,4 +1420,1536 @@ def test_bz2_parsing():
     assert hits[0]['path'] == '/'
     assert hits[0]['status'] == '200'
     assert hits[0]['length'] == 444
-    assert hits[0]['userid'] == 'theboss'
\ No newline at end of file
+    assert hits[0]['userid'] == 'theboss'
+
+
+def test_parser_pool():
+    """Test parsing log files in parse worker processes."""
+
+    files = ['logs/common.log', 'logs/ncsa_extended.log', 'logs/common_vhost.log']
+
+    import_logs.config.options.custom_w3c_fields = {}
+    import_logs.config.options.recorders = 2
+    import_logs.config.format = None
+
+    # parse in the main process first to know what to expect
+    import_logs.stats = import_logs.Statistics()
+    Recorder.recorders = []
+    import_logs.parser = import_logs.Parser()
+    for file_ in files:
+        import_logs.parser.parse(file_)
+
+    expected_hits = sorted((hit.filename, hit.lineno, hit.path, hit.date) for hit in Recorder.recorders)
+    expected_counts = import_logs.stats.get_parser_counts()
+
+    import_logs.stats = import_logs.Statistics()
+    Recorder.recorders = []
+    pool = import_logs.ParserPool(2)
+    pool.start()
+    pool.parse(files)
+    pool.stop()
+
+    hits = sorted((hit.filename, hit.lineno, hit.path, hit.date) for hit in Recorder.recorders)
+
+    assert len(hits) > 0
+    assert hits == expected_hits
+    assert import_logs.stats.get_parser_counts() == expected_counts
+
+def test_counter_advance():
+    """Test that counters are advanced in one step, eg. by the counts of parse workers."""
+
+    counter = import_logs.Statistics.Counter()
+    counter.increment()
+    counter.advance(10 ** 9)
+    counter.increment()
+    assert counter.value == 10 ** 9 + 2
+    assert str(counter) == str(10 ** 9 + 2)
+
+def test_parser_pool_fatal_error(tmpdir, monkeypatch):
+    """Test that a fatal error in a parse worker is handled by the main process."""
+
+    file_ = str(tmpdir.join('garbage.log'))
+    with open(file_, 'w') as f:
+        f.write('not a log line\n' * 10)
+
+    import_logs.config.format = None
+    pool = import_logs.ParserPool(2)
+    pool.start()
+
+    class FatalError(Exception):
+        pass
+
+    def fatal_error(error, filename=None, lineno=None):
+        raise FatalError(error)
+
+    # The workers are forked already: only the main process is patched.
+    monkeypatch.setattr(import_logs, 'fatal_error', fatal_error)
+    with pytest.raises(FatalError) as e:
+        pool.parse([file_])
+    assert 'cannot automatically determine the log format' in str(e.value)
+    pool.stop()
+
+def test_parser_pool_split_file(tmpdir):
+    """Test parsing one log file split into byte ranges by parse workers."""
+
+    file_ = write_common_log_file(str(tmpdir.join('access.log')), 50)
+
+    import_logs.config.options.custom_w3c_fields = {}
+    import_logs.config.options.recorders = 2
+    import_logs.config.format = None
+
+    import_logs.stats = import_logs.Statistics()
+    Recorder.recorders = []
+    import_logs.parser = import_logs.Parser()
+    import_logs.parser.parse(file_)
+
+    expected_hits = sorted((hit.lineno, hit.path) for hit in Recorder.recorders)
+    expected_counts = import_logs.stats.get_parser_counts()
+
+    ranges = import_logs.ParserPool.split(file_, 1000)
+    assert len(ranges) > 3
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == os.path.getsize(file_)
+
+    import_logs.config.options.parse_chunk_size = 1000
+    import_logs.stats = import_logs.Statistics()
+    Recorder.recorders = []
+    pool = import_logs.ParserPool(3)
+    pool.start()
+    pool.parse([file_])
+    pool.stop()
+    import_logs.config.options.parse_chunk_size = 0
+
+    hits = sorted((hit.lineno, hit.path) for hit in Recorder.recorders)
+
+    assert len(hits) == 50
+    assert hits == expected_hits
+    assert hits[17] == (17, '/page/17')
+    assert import_logs.stats.get_parser_counts() == expected_counts
+
+def test_valid_size():
+    """Test parsing of size option values."""
+
+    config = import_logs.Configuration(["--url=http://localhost", "logs/common.log"])
+
+    assert config._valid_size('123') == 123
+    assert config._valid_size('4K') == 4096
+    assert config._valid_size('256M') == 256 * 1024 * 1024
+    assert config._valid_size('2gb') == 2 * 1024 * 1024 * 1024
+    assert config.options.parse_chunk_size == 256 * 1024 * 1024
+
+def test_checkpoint(tmpdir):
+    """Test that the checkpoint only moves forward once all previous hits are recorded."""
+
+    def _hit(lineno):
+        return import_logs.Hit(filename='logs/common.log', lineno=lineno, offset=(lineno + 1) * 100, full_path='/')
+
+    path = str(tmpdir.join('checkpoint.json'))
+    checkpoint = import_logs.Checkpoint(path)
+
+    first_batch = [_hit(0), _hit(1)]
+    second_batch = [_hit(2), _hit(3)]
+    stdin_hit = import_logs.Hit(filename='(stdin)', lineno=0, offset=None, full_path='/')
+    checkpoint.add_batch(first_batch)
+    checkpoint.add_batch(second_batch + [stdin_hit])
+
+    checkpoint.acknowledge(second_batch + [stdin_hit])
+    assert checkpoint.get_position('logs/common.log') is None
+
+    checkpoint.acknowledge(first_batch[:1])
+    assert checkpoint.get_position('logs/common.log') is None
+
+    checkpoint.acknowledge(first_batch[1:])
+    assert checkpoint.get_position('logs/common.log') == (400, 4)
+    assert checkpoint.get_position('(stdin)') is None
+
+    checkpoint.save()
+    loaded = import_logs.Checkpoint(path)
+    loaded.load()
+    assert loaded.get_position(os.path.abspath('logs/common.log')) == (400, 4)
+
+def test_checkpoint_rotated_file(tmpdir):
+    """Test that the position of a log file is not used for another file of the same name."""
+
+    file_ = write_common_log_file(str(tmpdir.join('access.log')), 10)
+    checkpoint = import_logs.Checkpoint(str(tmpdir.join('checkpoint.json')))
+    hit = import_logs.Hit(filename=file_, lineno=4, offset=500, full_path='/')
+    checkpoint.add_batch([hit])
+    checkpoint.acknowledge([hit])
+    assert checkpoint.get_position(file_) == (500, 5)
+
+    # Grown, or copied with the same content.
+    with open(file_, 'a') as f:
+        f.write('new line\n')
+    assert checkpoint.get_position(file_) == (500, 5)
+    with open(file_) as f:
+        content = f.read()
+    os.remove(file_)
+    with open(file_, 'w') as f:
+        f.write(content)
+    assert checkpoint.get_position(file_) == (500, 5)
+
+    # Rotated: a new file with other lines.
+    os.rename(file_, file_ + '.1')
+    write_common_log_file(file_, 3)
+    with open(file_, 'r+') as f:
+        f.write('9')
+    assert checkpoint.get_position(file_) is None
+
+def test_resume_from_checkpoint(tmpdir):
+    """Test that --resume starts parsing log files at the saved position."""
+
+    file_ = write_common_log_file(str(tmpdir.join('access.log')), 10)
+
+    import_logs.config.options.custom_w3c_fields = {}
+    import_logs.config.format = None
+    import_logs.config.options.resume = True
+    import_logs.checkpoint = import_logs.Checkpoint(None)
+    Recorder.recorders = []
+    import_logs.parser = import_logs.Parser()
+    import_logs.parser.parse(file_)
+
+    all_hits = Recorder.recorders
+    assert len(all_hits) == 10
+    assert all_hits[-1].offset == os.path.getsize(file_)
+
+    import_logs.checkpoint.positions[os.path.abspath(file_)] = {
+        'offset': all_hits[0].offset,
+        'lineno': all_hits[0].lineno + 1,
+    }
+
+    Recorder.recorders = []
+    import_logs.parser.parse(file_)
+    import_logs.config.options.resume = False
+
+    hits = [(hit.lineno, hit.path) for hit in Recorder.recorders]
+    assert hits[0] == (1, '/page/1')
+    assert hits == [(hit.lineno, hit.path) for hit in all_hits[1:]]
+
+def test_ledger(tmpdir):
+    """Test that the ledger skips imported content and resumes grown files."""
+
+    file_ = write_common_log_file(str(tmpdir.join('access.log')), 10)
+    ledger_path = str(tmpdir.join('ledger.json'))
+
+    import_logs.config.options.custom_w3c_fields = {}
+    import_logs.config.format = None
+    import_logs.config.options.ledger = ledger_path
+    import_logs.config.ledger = import_logs.Ledger(ledger_path)
+    Recorder.recorders = []
+    import_logs.parser = import_logs.Parser()
+
+    assert import_logs.config.ledger.check(file_)
+    import_logs.config.ledger.record(file_, import_logs.parser.parse(file_))
+    import_logs.config.ledger.save()
+    assert len(Recorder.recorders) == 10
+
+    # The same file, or a compressed copy of it, is skipped.
+    ledger = import_logs.Ledger(ledger_path)
+    ledger.load()
+    assert not ledger.check(file_)
+    with open(file_, 'rb') as src, gzip.open(file_ + '.gz', 'wb') as dst:
+        dst.write(src.read())
+    assert not ledger.check(file_ + '.gz')
+
+    # Only the new lines of a grown file are imported.
+    with open(file_, 'a') as file:
+        file.write('1.2.3.4 - - [10/Feb/2012:16:43:00 -0500] "GET /new HTTP/1.0" 200 368 "-" "Mozilla/5.0"\n')
+    ledger = import_logs.Ledger(ledger_path)
+    ledger.load()
+    assert ledger.check(file_)
+    import_logs.config.ledger = ledger
+
+    Recorder.recorders = []
+    import_logs.parser.parse(file_)
+    import_logs.config.options.ledger = None
+    import_logs.config.ledger = None
+
+    assert [(hit.lineno, hit.path) for hit in Recorder.recorders] == [(10, '/new')]
+
+def test_log_follower(tmpdir, monkeypatch):
+    """Test that LogFollower reads complete lines across truncation and rotation."""
+
+    monkeypatch.setattr(import_logs.LogFollower, 'TICK_INTERVAL', 0.01)
+    path = write_common_log_file(str(tmpdir.join('access.log')), 2)
+    file_ = import_logs.LogFollower(path, 'utf-8')
+    file_.follow = True
+
+    assert file_.readline().endswith('/page/0 HTTP/1.0" 200 368 "-" "Mozilla/5.0"\n')
+    assert file_.readline() is not None
+    assert file_.readline() is None
+
+    # Incomplete lines are only returned once complete.
+    with open(path, 'a') as f:
+        f.write('line 2')
+    assert file_.readline() is None
+    with open(path, 'a') as f:
+        f.write(' end\n')
+    assert file_.readline() == 'line 2 end\n'
+    assert file_.readline() is None
+
+    # Lines ending with \r only are split too.
+    with open(path, 'ab') as f:
+        f.write(b'line 3\rline 4\r\n')
+    assert file_.readline() == 'line 3\n'
+    assert file_.readline() == 'line 4\n'
+    assert file_.readline() is None
+
+    # Truncation
+    with open(path, 'w') as f:
+        f.write('line 0\n')
+    assert file_.readline() == 'line 0\n'
+    assert file_.reopened
+    file_.reopened = False
+
+    # Rotation: the rest of the old file is read before the new file.
+    with open(path, 'a') as f:
+        f.write('line 1\n')
+    os.rename(path, path + '.1')
+    with open(path, 'w') as f:
+        f.write('new line 0\n')
+    assert file_.readline() == 'line 1\n'
+    assert not file_.reopened
+    assert file_.readline() == 'new line 0\n'
+    assert file_.reopened
+    assert file_.tell() == len('new line 0\n')
+    assert file_.readline() is None
+
+    file_.close()
+
+def test_flush_interval_stdin(monkeypatch):
+    """Test that --flush-interval sends hits read from stdin without waiting for a full batch."""
+
+    class BatchParser(import_logs.Parser):
+        batches = []
+
+        def _add_hits(self, hits):
+            self.batches.append(len(hits))
+
+    read_fd, write_fd = os.pipe()
+    stdin = import_logs.sys.stdin
+    import_logs.sys.stdin = os.fdopen(read_fd)
+    monkeypatch.setattr(import_logs.StreamReader, 'TICK_INTERVAL', 0.01)
+
+    import_logs.config.options.custom_w3c_fields = {}
+    import_logs.config.options.flush_interval = 0.1
+    import_logs.config.format = import_logs.FORMATS['ncsa_extended']
+    import_logs.parser = BatchParser()
+
+    line = '1.2.3.4 - - [10/Feb/2012:16:42:07 -0500] "GET /page HTTP/1.0" 200 368 "-" "Mozilla/5.0"\n'
+    def write_lines():
+        with os.fdopen(write_fd, 'w') as writer:
+            writer.write(line * 2)
+            writer.flush()
+            import_logs.time.sleep(0.5)
+            writer.write(line)
+
+    thread = import_logs.threading.Thread(target=write_lines)
+    thread.start()
+    try:
+        import_logs.parser.parse('-')
+    finally:
+        thread.join()
+        import_logs.sys.stdin.close()
+        import_logs.sys.stdin = stdin
+        import_logs.config.options.flush_interval = None
+        import_logs.config.format = None
+
+    assert BatchParser.batches == [2, 1]
+
+def test_stop_following(tmpdir, monkeypatch):
+    """Test that stopping to follow a log file sends the parsed hits, and returns the position in the file."""
+
+    class BatchParser(import_logs.Parser):
+        batches = []
+
+        def _add_hits(self, hits):
+            self.batches.append(len(hits))
+
+    monkeypatch.setattr(import_logs.LogFollower, 'TICK_INTERVAL', 0.01)
+    import_logs.config.options.flush_interval = 60
+    import_logs.config.format = import_logs.FORMATS['common']
+    path = write_common_log_file(str(tmpdir.join('access.log')), 3)
+    parser = BatchParser()
+    timer = import_logs.threading.Timer(0.2, parser.stop_following)
+    timer.start()
+    try:
+        position = parser.parse(path, follow=True)
+    finally:
+        timer.cancel()
+        import_logs.config.options.flush_interval = None
+        import_logs.config.format = None
+
+    assert BatchParser.batches == [3]
+    assert position[:2] == (os.path.getsize(path), 3)
+    assert position[2].endswith(b'/page/2 HTTP/1.0" 200 368 "-" "Mozilla/5.0"\n')
+
+class TrackerServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args):
+        http.server.HTTPServer.__init__(self, *args)
+        self.connections = []
+
+    def process_request(self, request, client_address):
+        self.connections.append(request)
+        socketserver.ThreadingMixIn.process_request(self, request, client_address)
+
+    def server_close(self):
+        http.server.HTTPServer.server_close(self)
+        # Connections kept alive by the clients would keep their thread.
+        for connection in self.connections:
+            try:
+                connection.shutdown(import_logs.socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class Recording(object):
+    """
+    Fake trackers and recorders started by a test, with fresh globals of
+    import_logs. They are stopped, and the globals restored, by close().
+    """
+
+    def __init__(self):
+        self.globals = dict((name, getattr(import_logs, name, None)) for name in ('config', 'matomo', 'resolver', 'stats'))
+        self.servers = []
+        self.recorders = []
+        import_logs.config = Config()
+        import_logs.stats = import_logs.Statistics()
+        import_logs.resolver = SiteResolver()
+
+    def start_server(self, handler):
+        """Start a fake tracker answering with handler, and return its URL."""
+        server = TrackerServer(('127.0.0.1', 0), handler)
+        thread = import_logs.threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return 'http://127.0.0.1:%d' % server.server_address[1]
+
+    def launch(self, recorder_count, recorder_class=RealRecorder):
+        """Launch the recorders of a new subclass of recorder_class, with a new import_logs.matomo."""
+        import_logs.matomo = import_logs.MatomoHttpUrllib()
+        recorder = type(recorder_class.__name__, (recorder_class,), {'recorders': []})
+        self.recorders.append(recorder)
+        recorder.launch(recorder_count)
+        return recorder
+
+    def close(self):
+        for recorder in self.recorders:
+            recorder.stop()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        for name, value in self.globals.items():
+            setattr(import_logs, name, value)
+
+@pytest.fixture
+def recording():
+    recording = Recording()
+    yield recording
+    recording.close()
+
+class TrackerHandler(http.server.BaseHTTPRequestHandler):
+    """Fake tracker keeping connections alive, which closes them after two requests."""
+    protocol_version = 'HTTP/1.1'
+    connections = []
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        self.connections.append(self.client_address)
+        self.requests = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.requests += 1
+        if self.path.startswith('/redirect'):
+            self.send_response(302)
+            self.send_header('Location', '/ok')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.do_GET()
+
+    def do_GET(self):
+        body = b'{"status": "success"}' if self.path == '/ok' else b'error'
+        self.send_response(200 if self.path == '/ok' else 500)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+        if self.requests == 2:
+            # Close the idle connection without telling the client.
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+def test_http_keep_alive(recording):
+    """Test that requests to Matomo reuse connections and reconnect when they were closed."""
+
+    import_logs.config.options.matomo_url = recording.start_server(TrackerHandler)
+    matomo = import_logs.MatomoHttpUrllib()
+    assert matomo._call('/ok', {}) == '{"status": "success"}'
+    assert matomo._call('/ok', {}) == '{"status": "success"}'
+    assert len(TrackerHandler.connections) == 1
+
+    # The server closed the connection after the second request.
+    import_logs.time.sleep(0.1)
+    assert matomo._call('/ok', {}) == '{"status": "success"}'
+    assert len(TrackerHandler.connections) == 2
+
+    assert matomo._call('/redirect', {}) == '{"status": "success"}'
+    assert len(TrackerHandler.connections) == 2
+
+    try:
+        matomo._call('/error', {})
+        assert False
+    except import_logs.urllib.error.HTTPError as e:
+        assert e.code == 500
+        assert e.read() == b'error'
+
+class CompressionHandler(http.server.BaseHTTPRequestHandler):
+    """Fake tracker which rejects compressed requests sent to /reject."""
+    protocol_version = 'HTTP/1.1'
+    bodies = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        encoding = self.headers.get('Content-Encoding')
+        if encoding and self.path == '/reject':
+            self.send_response(415)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding == 'deflate':
+            body = import_logs.zlib.decompress(body)
+        self.bodies.append((encoding, body))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+def test_compress_requests(recording):
+    """Test that tracking requests are compressed, and sent uncompressed if Matomo rejects them."""
+
+    import_logs.config.options.matomo_url = recording.start_server(CompressionHandler)
+    import_logs.config.options.compress_requests = 'deflate'
+    CompressionHandler.bodies = []
+    matomo = import_logs.MatomoHttpUrllib()
+    data = {'requests': ['?idsite=1&url=http%3A%2F%2Fexample.com%2F'] * 100}
+    headers = {'Content-type': 'application/json'}
+    assert matomo._call('/ok', {}, dict(headers), data=data, compress=True) == 'ok'
+    assert matomo._call('/ok', {}, dict(headers), data=data) == 'ok'
+    assert CompressionHandler.bodies[0] == ('deflate', json.dumps(data).encode())
+    assert CompressionHandler.bodies[1][0] is None
+    assert import_logs.stats.request_bytes.value == len(json.dumps(data))
+    assert import_logs.stats.request_bytes_sent.value < import_logs.stats.request_bytes.value / 10
+
+    assert matomo._call('/reject', {}, dict(headers), data=data, compress=True) == 'ok'
+    assert matomo.compression_disabled
+    assert '415' in import_logs.stats.compression_disabled_reason
+    assert CompressionHandler.bodies[2] == (None, json.dumps(data).encode())
+
+def test_http_keep_alive_async(recording):
+    """Test that the async recorder engine reuses connections and reconnects when they were closed."""
+
+    TrackerHandler.connections = []
+    import_logs.config.options.matomo_url = recording.start_server(TrackerHandler)
+    matomo = import_logs.MatomoHttpUrllib()
+    connections = {}
+    loop = import_logs.asyncio.new_event_loop()
+
+    def call(path):
+        return loop.run_until_complete(matomo._call_async(connections, path, {}))
+
+    try:
+        assert call('/ok') == '{"status": "success"}'
+        assert call('/ok') == '{"status": "success"}'
+        assert len(TrackerHandler.connections) == 1
+
+        import_logs.time.sleep(0.1)
+        assert call('/ok') == '{"status": "success"}'
+        assert len(TrackerHandler.connections) == 2
+
+        assert call('/redirect') == '{"status": "success"}'
+        assert len(TrackerHandler.connections) == 2
+
+        try:
+            call('/error')
+            assert False
+        except import_logs.urllib.error.HTTPError as e:
+            assert e.code == 500
+            assert e.read() == b'error'
+    finally:
+        for connection in connections.values():
+            connection.close()
+        loop.close()
+
+def test_payload_sizer():
+    """Test that the payload sizer grows slowly on fast responses and shrinks quickly otherwise."""
+
+    sizer = import_logs.PayloadSizer(100, 1.0)
+    assert sizer.get_size() == 100
+
+    sizer.on_response(100, 2.0)
+    assert sizer.get_size() == 70
+    sizer.on_response(70, 0.5)
+    assert sizer.get_size() == 75
+    # Requests smaller than the size don't make it grow.
+    sizer.on_response(10, 0.5)
+    assert sizer.get_size() == 75
+    sizer.on_split(75)
+    assert sizer.get_size() == 37
+    for i in range(100):
+        sizer.on_response(sizer.get_size(), 0.1)
+    assert sizer.get_size() == 100
+    assert (sizer.smallest_size, sizer.largest_size, sizer.count_splits) == (37, 100, 1)
+
+    # Slow responses alone don't make it smaller than a tenth of the maximum.
+    for i in range(20):
+        sizer.on_response(sizer.get_size(), 2.0)
+    assert sizer.get_size() == 10
+    sizer.on_split(10)
+    assert sizer.get_size() == 5
+
+class PayloadHandler(http.server.BaseHTTPRequestHandler):
+    """Fake tracker which rejects requests of more than 3 hits."""
+    protocol_version = 'HTTP/1.1'
+    payloads = []
+
+    def do_POST(self):
+        requests = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())['requests']
+        status = 413 if len(requests) > 3 else 200
+        if status == 200:
+            self.payloads.append([request['n'] for request in requests])
+        body = json.dumps({'status': 'success', 'tracked': len(requests)}).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def test_split_payload(recording):
+    """Test that tracking requests are split by size, and split again when too large."""
+
+    import_logs.config.options.matomo_url = recording.start_server(PayloadHandler)
+    import_logs.matomo = import_logs.MatomoHttpUrllib()
+    recorder = RealRecorder()
+    requests = [{'n': i} for i in range(10)]
+    assert recorder._split_payload(requests) == [(0, 10)]
+    import_logs.config.options.recorder_max_payload_bytes = 30
+    assert recorder._split_payload(requests) == [(0, 3), (3, 6), (6, 9), (9, 10)]
+    import_logs.config.options.recorder_max_payload_bytes = 0
+
+    recorder.payload_sizer = import_logs.PayloadSizer(8, 10.0)
+    assert recorder._split_payload(requests) == [(0, 8), (8, 10)]
+    recorder._send_payload(list(range(8)), requests[:8])
+    assert PayloadHandler.payloads == [[0, 1], [2, 3], [4, 5], [6, 7]]
+    assert recorder.payload_sizer.count_splits == 3
+    assert import_logs.stats.count_lines_recorded.value == 8
+
+    # The halves of a split request are not charged to the rate limiter again.
+    class RateLimiter(object):
+        charged = []
+
+        def get_delay(self, hit_count):
+            self.charged.append(hit_count)
+            return 0
+
+    recorder.rate_limiter = RateLimiter()
+    recorder.payload_sizer = import_logs.PayloadSizer(8, 10.0)
+    recorder._get_hit_requests = lambda hits: requests[:8]
+    PayloadHandler.payloads = []
+    recorder._record_hits(list(range(8)))
+    assert PayloadHandler.payloads == [[0, 1], [2, 3], [4, 5], [6, 7]]
+    assert RateLimiter.charged == [8]
+
+def test_recorder_tuner():
+    """Test that recorders are added while they help, and removed when Matomo slows down."""
+
+    import_logs.stats = import_logs.Statistics()
+    tuner = import_logs.RecorderTuner(2)
+
+    # The parser waits for the recorders, and more recorders help.
+    tuner._adjust(100, 0.1, 0.5)
+    assert tuner.count == 3
+    tuner._adjust(150, 0.1, 0.5)
+    assert tuner.count == 4
+    # The last recorder added didn't help: it is removed for a while.
+    tuner._adjust(160, 0.1, 0.5)
+    assert tuner.count == 3
+    for i in range(tuner.HOLD_PERIODS):
+        tuner._adjust(160, 0.1, 0.5)
+        assert tuner.count == 3
+    tuner._adjust(160, 0.1, 0.5)
+    assert tuner.count == 4
+    # Matomo answers much slower with more recorders.
+    tuner._adjust(200, 0.3, 0.5)
+    assert tuner.count == 3
+    for i in range(tuner.HOLD_PERIODS):
+        tuner._adjust(200, 0.1, 0.5)
+    tuner._adjust(200, 0.3, 0.0)
+    assert tuner.count == 2
+    # The parser doesn't wait for the recorders.
+    for i in range(tuner.HOLD_PERIODS + 1):
+        tuner._adjust(200, 0.1, 0.0)
+    assert tuner.count == 2
+    assert (tuner.smallest_count, tuner.largest_count) == (2, 4)
+
+class OrderHit:
+    def __init__(self, visitor, n):
+        self.visitor = visitor
+        self.n = n
+        self.full_path = '/page/%d' % n
+        self.referrer = ''
+        self.user_agent = 'Browser'
+
+    def get_visitor_id_hash(self):
+        return self.visitor
+
+class OrderRecorder(RealRecorder):
+    """Recorder keeping the hits it records, in order."""
+    recorded = []
+
+    def _record_hits(self, hits):
+        import_logs.time.sleep(0.001 * len(hits))
+        self.recorded.extend((hit.visitor, hit.n) for hit in hits)
+
+    async def _record_hits_async(self, hits):
+        await import_logs.asyncio.sleep(0.001 * len(hits))
+        self.recorded.extend((hit.visitor, hit.n) for hit in hits)
+
+def check_recorders_resize(recording):
+    recorder = recording.launch(2, OrderRecorder)
+    recorder.recorded = []
+    n = 0
+    for count in (2, 5, 3, 1, 4):
+        if count != len(recorder.recorders):
+            recorder._resize(count)
+        assert len(recorder.recorders) == count
+        for batch in range(3):
+            recorder.add_hits([OrderHit(visitor, n + i) for i in range(10) for visitor in range(7)])
+            n += 10
+    recorder.wait_empty()
+
+    assert len(recorder.recorded) == n * 7
+    for visitor in range(7):
+        assert [hit for v, hit in recorder.recorded if v == visitor] == list(range(n))
+    return recorder
+
+def test_recorders_resize(recording):
+    """Test that recorders can be added and removed while keeping the hits of each visitor in order."""
+
+    import_logs.config.options.matomo_url = 'http://127.0.0.1:1'
+    check_recorders_resize(recording)
+
+    import_logs.config.options.recorder_engine = 'async'
+    assert check_recorders_resize(recording).loop is not None
+
+def test_rate_limiter():
+    """Test that tracking requests are delayed to keep under the rate limits, during the configured hours."""
+
+    bucket = import_logs.TokenBucket(10)
+    assert bucket.reserve(10) == 0
+    assert abs(bucket.reserve(5) - 0.5) < 0.05
+    bucket.time -= 1
+    assert abs(bucket.reserve(10) - 0.5) < 0.05
+
+    config = import_logs.Configuration(["--url=http://localhost", "logs/common.log"])
+    hours = config._valid_hours('8-12, 14-19')
+    assert hours == set([8, 9, 10, 11, 14, 15, 16, 17, 18])
+    assert config._valid_hours('22-6') == set([22, 23, 0, 1, 2, 3, 4, 5])
+    assert config._valid_hours('0-24') == set(range(24))
+    try:
+        config._valid_hours('8')
+        assert False
+    except import_logs.argparse.ArgumentTypeError:
+        pass
+
+    import_logs.stats = import_logs.Statistics()
+    limiter = import_logs.RateLimiter(None, 2, hours)
+    assert limiter.is_active(8)
+    assert not limiter.is_active(12)
+    limiter.hours = None
+    assert limiter.get_delay(100) == 0
+    assert limiter.get_delay(100) == 0
+    assert abs(limiter.get_delay(100) - 0.5) < 0.05
+    assert abs(import_logs.stats.rate_limit_delay.value - 0.5) < 0.05
+
+def test_retry_delay():
+    """Test that the delay between attempts grows exponentially, unless Matomo asks for a delay."""
+
+    matomo = import_logs.MatomoHttpUrllib()
+
+    def http_error(code, retry_after=None):
+        headers = import_logs.email.message.Message()
+        if retry_after is not None:
+            headers['Retry-After'] = retry_after
+        return import_logs.urllib.error.HTTPError('http://localhost', code, 'error', headers, import_logs.io.BytesIO(b''))
+
+    import_logs.config.options.max_attempts = 10
+    try:
+        for errors, delay in ((1, 10), (2, 20), (3, 40), (6, 300)):
+            assert delay / 2.0 <= matomo._on_call_error(http_error(500), errors) <= delay
+        assert matomo._on_call_error(http_error(503, '7'), 1) == 7
+        assert matomo._on_call_error(http_error(429, '3600'), 1) == 300
+        retry_after = import_logs.email.utils.formatdate(import_logs.time.time() + 60, usegmt=True)
+        assert 55 <= matomo._on_call_error(http_error(503, retry_after), 1) <= 60
+        # Retry-After is only used with 429 and 503 errors.
+        assert 5 <= matomo._on_call_error(http_error(500, '7'), 1) <= 10
+
+        matomo._on_call_error(http_error(503, '7'), 10)
+        assert False
+    except import_logs.MatomoHttpBase.Error as e:
+        assert e.code == 503
+    finally:
+        import_logs.config.options.max_attempts = 3
+
+class UnavailableHandler(http.server.BaseHTTPRequestHandler):
+    """Fake tracker which is unavailable for its first requests."""
+    protocol_version = 'HTTP/1.1'
+    failures = 0
+    requests = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        UnavailableHandler.requests += 1
+        status = 503 if UnavailableHandler.requests <= self.failures else 200
+        body = json.dumps({'status': 'success'}).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def test_circuit_breaker(recording):
+    """Test that recorders wait for Matomo to be available again, and give up after the timeout."""
+
+    breaker = import_logs.CircuitBreaker(60)
+    error = import_logs.MatomoHttpBase.Error('unavailable', 503)
+    assert breaker.get_delay() == 0
+    assert breaker.on_failure(error)
+    # One recorder at a time tries again.
+    assert breaker.get_delay() == 0
+    assert breaker.get_delay() == breaker.POLL_INTERVAL
+    assert breaker.on_failure(error)
+    assert breaker.get_delay() == 0
+    breaker.on_success()
+    assert breaker.get_delay() == 0
+    assert breaker.get_delay() == 0
+    assert not breaker.on_failure(import_logs.MatomoHttpBase.Error('forbidden', 403))
+    assert breaker.count_trips == 1
+    breaker.on_failure(error)
+    breaker.open_since -= 60
+    assert not breaker.on_failure(error)
+
+    import_logs.config.options.matomo_url = recording.start_server(UnavailableHandler)
+    import_logs.config.options.max_attempts = 1
+    import_logs.matomo = import_logs.MatomoHttpUrllib()
+    UnavailableHandler.failures = 3
+    recorder = RealRecorder()
+    recorder.circuit_breaker = import_logs.CircuitBreaker(60)
+    recorder._send_payload([1, 2], [{'n': 1}, {'n': 2}])
+    assert UnavailableHandler.requests == 4
+    assert recorder.circuit_breaker.count_trips == 1
+    assert recorder.circuit_breaker.open_since is None
+    assert import_logs.stats.count_lines_recorded.value == 2
+
+class PoisonHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Fake tracker which rejects the requests with hits marked as poison as
+    invalid, and fails on the first transient_errors requests. Failed
+    requests are rolled back.
+    """
+    protocol_version = 'HTTP/1.1'
+    payloads = []
+    report_tracked = True
+    transient_errors = 0
+
+    def do_POST(self):
+        requests = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())['requests']
+        poisoned = [i for i, request in enumerate(requests) if request.get('poison')]
+        if PoisonHandler.transient_errors:
+            PoisonHandler.transient_errors -= 1
+            status = 500
+            response = {'status': 'error', 'message': 'database unavailable'}
+        elif poisoned:
+            status = 400
+            response = {'status': 'error', 'message': 'poison'}
+            if self.report_tracked:
+                response['tracked'] = poisoned[0]
+        else:
+            status = 200
+            response = {'status': 'success', 'tracked': len(requests)}
+            self.payloads.append([request['n'] for request in requests])
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def test_reject_hits(tmpdir, recording):
+    """Test that the hits the tracker fails to track are found and rejected, and the others tracked."""
+
+    import_logs.config.options.matomo_url = recording.start_server(PoisonHandler)
+    import_logs.config.options.delay_after_failure = 0
+    import_logs.matomo = import_logs.MatomoHttpUrllib()
+    hits = [import_logs.Hit(filename='access.log', lineno=i, full_path='/') for i in range(8)]
+    requests = [{'n': i, 'poison': i in (3, 6)} for i in range(8)]
+    # The hits the tracker says it tracked before failing are rolled back:
+    # they are sent again. Invalid hits are split right away, other errors
+    # are tried again.
+    for report_tracked, transient_errors in ((True, 0), (False, 0), (True, 2)):
+        import_logs.stats = import_logs.Statistics()
+        PoisonHandler.payloads = []
+        PoisonHandler.report_tracked = report_tracked
+        PoisonHandler.transient_errors = transient_errors
+        path = str(tmpdir.join('rejected-%s-%d.json' % (report_tracked, transient_errors)))
+        recorder = RealRecorder()
+        recorder.reject_file = import_logs.RejectFile(path)
+        recorder._send_payload(hits, requests)
+        recorder.reject_file.close()
+
+        assert PoisonHandler.payloads == [[0, 1], [2], [4, 5], [7]]
+        assert import_logs.stats.count_lines_recorded.value == 6
+        assert import_logs.stats.count_lines_rejected.value == 2
+        with open(path) as f:
+            rejected = [json.loads(line) for line in f]
+        assert [(entry['filename'], entry['lineno'], entry['error']) for entry in rejected] == [
+            ('access.log', 3, 'poison'), ('access.log', 6, 'poison'),
+        ]
+        assert rejected[0]['request'] == {'n': 3, 'poison': True}
+        assert rejected[0]['url'] == import_logs.config.options.matomo_url
+
+    # An outage is not due to the hits: they are not split nor rejected.
+    import_logs.stats = import_logs.Statistics()
+    PoisonHandler.payloads = []
+    PoisonHandler.transient_errors = 3
+    recorder = RealRecorder()
+    recorder.reject_file = import_logs.RejectFile(str(tmpdir.join('rejected-outage.json')))
+    with pytest.raises(import_logs.MatomoHttpBase.Error):
+        recorder._send_payload(hits[:2], [{'n': 0}, {'n': 1}])
+    recorder.reject_file.close()
+    assert PoisonHandler.transient_errors == 0
+    assert PoisonHandler.payloads == []
+    assert import_logs.stats.count_lines_rejected.value == 0
+
+def test_partitions():
+    """Test that hits are shared between recorders by visitor, and that the imbalance is measured."""
+
+    def hit(ip, user_agent):
+        hit = import_logs.Hit(filename='access.log', lineno=0, full_path='/', args={})
+        hit.ip = ip
+        hit.user_agent = user_agent
+        return hit
+
+    hits = [hit('10.0.0.1', 'Browser %d' % i) for i in range(100)]
+    assert len(set(hit.get_visitor_id_hash() for hit in hits)) == 1
+    import_logs.config.options.partition_key = 'ip-ua'
+    try:
+        assert len(set(hit.get_visitor_id_hash() for hit in hits)) == 100
+        assert hits[0].get_visitor_id_hash() == hit('10.0.0.1', 'Browser 0').get_visitor_id_hash()
+    finally:
+        import_logs.config.options.partition_key = 'ip'
+
+    stats = import_logs.Statistics()
+    assert stats._get_partitions_summary() == ''
+    stats.add_partitions([30, 10, 0, 0])
+    stats.add_partitions([10, 10, 10, 10])
+    assert stats._get_partitions_summary() == (
+        '    Busiest partition: 2.0 times the average number of hits per partition (partition key: ip)\n'
+    )
+
+def test_split_payload_max_size():
+    """Test that the hits given to a recorder are sent in requests of at most --recorder-max-payload-size hits."""
+
+    recorder = RealRecorder()
+    requests = [{'n': i} for i in range(10)]
+    import_logs.config.options.recorder_max_payload_size = 4
+    try:
+        assert recorder._split_payload(requests) == [(0, 4), (4, 8), (8, 10)]
+    finally:
+        import_logs.config.options.recorder_max_payload_size = 200
+
+def test_dispatcher():
+    """Test that idle recorders take the hits of the partitions no other recorder is recording."""
+
+    dispatcher = import_logs.Dispatcher(3000)
+    partitions = dispatcher.PARTITIONS
+    hits = [OrderHit(visitor, n) for n in range(3) for visitor in (0, 1, 2)]
+    sizes = dispatcher.put(hits)
+    assert sizes[:3] == [3, 3, 3] and sum(sizes) == 9
+
+    first = dispatcher.get(6)
+    assert [(hit.visitor, hit.n) for hit in first.hits] == [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2)]
+    # Partitions being recorded are not given to another recorder, even with new hits.
+    dispatcher.put([OrderHit(0, 3), OrderHit(partitions + 3, 0)])
+    second = dispatcher.get(100)
+    assert [(hit.visitor, hit.n) for hit in second.hits] == [(2, 0), (2, 1), (2, 2), (partitions + 3, 0)]
+    assert dispatcher.get(100, block=False) is None
+
+    dispatcher.done(first)
+    third = dispatcher.get(100)
+    assert [(hit.visitor, hit.n) for hit in third.hits] == [(0, 3)]
+
+    # Adding hits waits until the previous ones are recorded.
+    added = import_logs.threading.Event()
+    def put():
+        dispatcher.put([OrderHit(4, n) for n in range(10)])
+        added.set()
+    thread = import_logs.threading.Thread(target=put)
+    thread.daemon = True
+    thread.start()
+    assert not added.wait(0.2)
+    dispatcher.done(second)
+    dispatcher.done(third)
+    assert added.wait(5)
+
+    # A stopped recorder doesn't wait for hits.
+    work = dispatcher.get(100)
+    dispatcher.done(work)
+    dispatcher.join()
+    stopped = import_logs.threading.Event()
+    stopped.set()
+    assert dispatcher.get(100, stopped) is None
+
+def test_wait_empty(recording):
+    """Test that waiting for the recorders returns as soon as the last hits are recorded."""
+
+    import_logs.config.options.matomo_url = 'http://127.0.0.1:1'
+    recorder = recording.launch(3, OrderRecorder)
+    recorder.recorded = []
+    recorder.wait_empty()
+    for i in range(5):
+        recorder.add_hits([OrderHit(visitor, i) for visitor in range(50)])
+        time_start = import_logs.time.time()
+        recorder.wait_empty()
+        assert import_logs.time.time() - time_start < 0.5
+        assert len(recorder.recorded) == (i + 1) * 50
+
+class SiteResolver(object):
+    """Resolver giving the same site to all hits."""
+    def resolve(self, hit):
+        return 1, 'https://example.com'
+
+def make_hit(**kwargs):
+    fields = dict(
+        filename='access.log', lineno=0, full_path='/', path='/page', query_string='x=1', host='example.org',
+        referrer='http://ref.example/', ip='10.0.0.1', user_agent='Browser', status='200', length=1000,
+        date=datetime.datetime(2012, 2, 10, 12, 30, 5), is_robot=False, is_download=False,
+        is_error=False, is_redirect=False, generation_time_milli=0, event_category=None, event_action=None,
+        event_name=None, args={},
+    )
+    fields.update(kwargs)
+    return import_logs.Hit(**fields)
+
+def test_get_hit_args():
+    """Test the tracking args of hits, including the cached parts shared by hits."""
+
+    import_logs.stats = import_logs.Statistics()
+    import_logs.config = Config()
+    import_logs.config.options.replay_tracking = False
+    import_logs.resolver = SiteResolver()
+    recorder = RealRecorder()
+    for i in range(2):
+        assert json.dumps(recorder._get_hit_args(make_hit())) == (
+            '{"rec": "1", "apiv": "1", "url": "https://example.org/page?x=1", "urlref": "http://ref.example/", '
+            '"cip": "10.0.0.1", "cdt": "2012-02-10 12:30:05", "idsite": 1, "queuedtracking": "0", "dp": "1", '
+            '"ua": "Browser", "cvar": "{\\"1\\": [\\"HTTP-code\\", \\"200\\"]}", "bw_bytes": 1000}'
+        )
+
+    args = recorder._get_hit_args(make_hit(
+        host='http://example.net', status='404', is_error=True, length=0,
+        date=datetime.datetime(2012, 2, 10, 12, 30, 5, 250000),
+        args={'_id': 'abc', 'cvar': {1: ['Country', 'FR']}},
+    ))
+    assert json.dumps(args) == (
+        '{"rec": "1", "apiv": "1", "url": "http://example.net/page?x=1", "urlref": "http://ref.example/", '
+        '"cip": "10.0.0.1", "cdt": "2012-02-10 12:30:05.250000", "idsite": 1, "queuedtracking": "0", "dp": "1", '
+        '"ua": "Browser", "_id": "abc", "cvar": "{\\"1\\": [\\"Country\\", \\"FR\\"], \\"2\\": [\\"HTTP-code\\", \\"404\\"]}", '
+        '"action_name": "404/URL = http%3A%2F%2Fexample.net%2Fpage%3Fx%3D1/From = http%3A%2F%2Fref.example%2F"}'
+    )
+
+    args = recorder._get_hit_args(make_hit(args={'ec_items[0][]': 'sku', 'ec_items[1][]': 'name'}, length=0))
+    assert json.dumps(args) == (
+        '{"rec": "1", "apiv": "1", "url": "https://example.org/page?x=1", "urlref": "http://ref.example/", '
+        '"cip": "10.0.0.1", "cdt": "2012-02-10 12:30:05", "idsite": 1, "queuedtracking": "0", "dp": "1", '
+        '"ua": "Browser", "ec_items": [["sku"], ["name"]], "cvar": "{\\"1\\": [\\"HTTP-code\\", \\"200\\"]}"}'
+    )
+    assert recorder.url_prefixes[('example.org', 'https://example.com')] == 'https://example.org'
+
+def test_serializer(recording):
+    """Test that tracking requests are encoded ahead of time, up to --serializer-queue-size batches."""
+
+    serializer = import_logs.Serializer(2)
+    works = [import_logs.Dispatcher.Work() for i in range(3)]
+    serializer.put(works[0])
+    serializer.put(works[1])
+    added = import_logs.threading.Event()
+    def put():
+        serializer.put(works[2])
+        added.set()
+    thread = import_logs.threading.Thread(target=put)
+    thread.daemon = True
+    thread.start()
+    assert not added.wait(0.2)
+    assert serializer.get() is works[0]
+    assert added.wait(5)
+    assert serializer.get() is works[1]
+    assert serializer.get() is works[2]
+    assert serializer.get(block=False) is None
+    stopped = import_logs.threading.Event()
+    stopped.set()
+    assert serializer.get(stopped) is None
+
+    import_logs.config.options.replay_tracking = False
+    import_logs.config.options.matomo_url = recording.start_server(CompressionHandler)
+    import_logs.config.options.matomo_tracker_endpoint_path = '/ok'
+    import_logs.config.options.compress_requests = 'gzip'
+    import_logs.config.options.recorder_max_payload_size = 10
+    import_logs.config.options.serializer_queue_size = 2
+    CompressionHandler.bodies = []
+    recorder = recording.launch(2)
+    assert recorder.serializer is not None
+    hits = [make_hit(ip='10.0.0.%d' % (i % 5), path='/page/%d' % i) for i in range(100)]
+    recorder.add_hits(hits)
+    recorder.wait_empty()
+
+    requests = [json.loads(body.decode())['requests'] for encoding, body in CompressionHandler.bodies]
+    assert all(encoding == 'gzip' for encoding, body in CompressionHandler.bodies)
+    assert sorted(len(payload) for payload in requests) == [10] * 10
+    urls = [request['url'] for payload in requests for request in payload]
+    assert sorted(urls) == sorted('https://example.org/page/%d?x=1' % i for i in range(100))
+    # The hits of a visitor are sent in order.
+    for ip in range(5):
+        visitor_urls = [url for url in urls if int(url.split('/')[-1].split('?')[0]) % 5 == ip]
+        assert visitor_urls == ['https://example.org/page/%d?x=1' % i for i in range(ip, 100, 5)]
+    assert import_logs.stats.count_lines_recorded.value == 100
+    assert import_logs.stats.serialize_time.value > 0
+    assert import_logs.stats.send_time.value > 0
+
+class ChunkedHandler(http.server.BaseHTTPRequestHandler):
+    """Fake tracker reading chunked requests, except on /length-required."""
+    protocol_version = 'HTTP/1.1'
+    bodies = []
+
+    def do_POST(self):
+        chunked = self.headers.get('Transfer-Encoding') == 'chunked'
+        if chunked:
+            body = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+
+        if chunked and self.path == '/length-required':
+            self.send_response(411)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.bodies.append((chunked, body))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+def test_chunked_requests(recording):
+    """Test that request bodies are encoded while they are sent, with chunked transfer encoding."""
+
+    data = {'token_auth': 'token', 'requests': [{'url': 'http://example.com/%d' % i, 'n': i} for i in range(500)]}
+    expected = json.dumps(data).encode()
+    body = import_logs.MatomoHttpUrllib.StreamedBody(data, 'requests')
+    body.CHUNK_SIZE = 1000
+    chunks = list(body.iter_chunks())
+    assert len(chunks) > 10 and all(len(chunk) < 1100 for chunk in chunks)
+    assert b''.join(chunks) == expected
+    assert b''.join(body).endswith(b'\r\n0\r\n\r\n')
+    for encoding, decompress in (('gzip', gzip.decompress), ('deflate', import_logs.zlib.decompress)):
+        assert decompress(body.with_encoding(encoding).read_all()) == expected
+    empty = {'token_auth': 'token', 'requests': []}
+    assert import_logs.MatomoHttpUrllib.StreamedBody(empty, 'requests').read_all() == json.dumps(empty).encode()
+
+    import_logs.config.options.matomo_url = recording.start_server(ChunkedHandler)
+    import_logs.stats = import_logs.Statistics()
+    import_logs.config.options.chunked_requests = True
+    import_logs.config.options.compress_requests = 'gzip'
+    ChunkedHandler.bodies = []
+    matomo = import_logs.MatomoHttpUrllib()
+    headers = {'Content-type': 'application/json'}
+    loop = import_logs.asyncio.new_event_loop()
+    try:
+        body = matomo.encode_body(data, compress=True, stream='requests')
+        assert isinstance(body, import_logs.MatomoHttpUrllib.StreamedBody)
+        assert matomo._call('/ok', {}, dict(headers), data=body, compress=True) == 'ok'
+        assert loop.run_until_complete(
+            matomo._call_async({}, '/ok', {}, dict(headers), data=body, compress=True)
+        ) == 'ok'
+        assert ChunkedHandler.bodies == [(True, expected), (True, expected)]
+        assert import_logs.stats.request_bytes.value == 2 * len(expected)
+        assert 0 < import_logs.stats.request_bytes_sent.value < import_logs.stats.request_bytes.value
+
+        # The server doesn't accept chunked requests: they are sent with a Content-Length.
+        assert matomo._call('/length-required', {}, dict(headers), data=body, compress=True) == 'ok'
+        assert ChunkedHandler.bodies[2] == (False, expected)
+        assert matomo.chunked_requests_disabled
+        assert isinstance(matomo.encode_body(data, compress=True, stream='requests'), import_logs.MatomoHttpUrllib.Body)
+    finally:
+        loop.close()
+
+def test_spool_sync(tmpdir):
+    """Test that spooled hits are only acknowledged once synced to disk."""
+
+    import_logs.config = Config()
+    spool = import_logs.Spool(str(tmpdir.join('spool')))
+    spool.SYNC_INTERVAL = 3600
+    spool.open()
+    batches = [[make_hit(path='/page/%d' % i)] for i in range(3)]
+    synced = []
+    spool.append(batches[0], synced.extend)
+    assert synced == batches[0]
+    spool.append(batches[1], synced.extend)
+    spool.append(batches[2])
+    assert synced == batches[0]
+    spool.save()
+    assert synced == batches[0] + batches[1]
+    spool.close()
+
+def test_spool(tmpdir, recording):
+    """Test that hits go through the spool in order and are kept there until they are recorded."""
+
+    path = str(tmpdir.join('spool'))
+    spool = import_logs.Spool(path)
+    spool.SEGMENT_SIZE = 1
+    spool.open()
+    batches = [[make_hit(path='/page/%d/%d' % (i, j)) for j in range(3)] for i in range(4)]
+    for batch in batches:
+        spool.append(batch)
+    assert import_logs.stats.count_lines_spooled.value == 12
+    assert len(os.listdir(path)) == 4
+
+    reader = spool.read()
+    first, second = next(reader), next(reader)
+    assert [hit.path for hit in first] == [hit.path for hit in batches[0]]
+    assert first[0].date == batches[0][0].date and first[0].args == batches[0][0].args
+    # The first batch is not fully recorded: nothing can be removed yet.
+    spool.acknowledge(second + first[:2])
+    assert len(os.listdir(path)) == 4
+    spool.acknowledge(first[2:])
+    segments = ['000000000002.spool', '000000000003.spool', '000000000004.spool']
+    assert sorted(os.listdir(path)) == segments + ['position.json']
+    spool.close()
+    assert sorted(os.listdir(path)) == segments + ['position.json']
+
+    # The hits not recorded are read first when the spool is opened again.
+    spool = import_logs.Spool(path)
+    spool.open()
+    spool.append(batches[0])
+    reader = spool.read()
+    hits = [next(reader) for i in range(3)]
+    assert [[hit.path for hit in batch] for batch in hits] == [
+        [hit.path for hit in batch] for batch in batches[2:] + batches[:1]
+    ]
+    for batch in hits:
+        spool.acknowledge(batch)
+    spool.close()
+    assert list(reader) == []
+    assert os.listdir(path) == []
+
+    import_logs.config.options.replay_tracking = False
+    import_logs.config.options.matomo_url = recording.start_server(CompressionHandler)
+    import_logs.config.options.matomo_tracker_endpoint_path = '/ok'
+    import_logs.config.options.recorder_max_payload_size = 10
+    import_logs.config.options.spool = path
+    import_logs.stats = import_logs.Statistics()
+    CompressionHandler.bodies = []
+    recorder = recording.launch(2)
+    hits = [make_hit(ip='10.0.0.%d' % (i % 5), path='/page/%d' % i) for i in range(100)]
+    recorder.add_hits(hits[:50])
+    recorder.add_hits(hits[50:])
+    recorder.wait_empty()
+    recorder.spool.close()
+
+    urls = [
+        request['url'] for encoding, body in CompressionHandler.bodies
+        for request in json.loads(body.decode())['requests']
+    ]
+    assert sorted(urls) == sorted('https://example.org/page/%d?x=1' % i for i in range(100))
+    assert import_logs.stats.count_lines_spooled.value == 100
+    assert import_logs.stats.count_lines_recorded.value == 100
+    assert os.listdir(path) == []
+
+def test_export_requests(tmpdir, recording):
+    """Test that tracking requests are written to files by --export-requests, and sent by --replay-requests."""
+
+    path = str(tmpdir.join('export'))
+    import_logs.config.options.replay_tracking = False
+    import_logs.config.options.export_requests = path
+    import_logs.config.options.export_shards = 4
+    import_logs.config.options.recorder_max_payload_size = 10
+    import_logs.resolver = import_logs.StaticResolver(1, 'https://example.com')
+    recorder = recording.launch(2)
+    assert recorder.serializer is None
+    hits = [make_hit(ip='10.0.0.%d' % (i % 5), path='/page/%d' % i, lineno=i) for i in range(100)]
+    recorder.add_hits(hits)
+    recorder.wait_empty()
+    recorder.exporter.close()
+
+    filenames = import_logs.RequestExporter.get_files([path])
+    assert 1 < len(filenames) <= 4
+    assert all(filename.endswith('.ndjson.gz') for filename in filenames)
+    exported = {}
+    for filename in filenames:
+        for line_hits, requests in import_logs.RequestExporter.read(filename):
+            for hit, request in zip(line_hits, requests):
+                assert hit.filename == 'access.log'
+                exported[hit.lineno] = request
+    assert sorted(exported) == list(range(100))
+    assert exported[7]['url'] == 'https://example.org/page/7?x=1' and exported[7]['idsite'] == 1
+    assert import_logs.stats.count_lines_recorded.value == 100
+
+    import_logs.config = Config()
+    import_logs.config.options.matomo_url = recording.start_server(CompressionHandler)
+    import_logs.config.options.matomo_tracker_endpoint_path = '/ok'
+    import_logs.config.options.recorder_max_payload_size = 30
+    import_logs.config.options.replay_requests = True
+    import_logs.config.options.recorders = 2
+    import_logs.stats = import_logs.Statistics()
+    CompressionHandler.bodies = []
+    recorder = recording.launch(2)
+    assert recorder.recorders == []
+    recorder.replay(filenames)
+
+    payloads = [json.loads(body.decode()) for encoding, body in CompressionHandler.bodies]
+    assert all(payload['token_auth'] == import_logs.config.options.matomo_token_auth for payload in payloads)
+    assert all(len(payload['requests']) <= 30 for payload in payloads)
+    requests = [request for payload in payloads for request in payload['requests']]
+    assert sorted(request['url'] for request in requests) == sorted(request['url'] for request in exported.values())
+    # The hits of a visitor are sent in order.
+    for ip in range(5):
+        visitor_urls = [request['url'] for request in requests if request['cip'] == '10.0.0.%d' % ip]
+        assert visitor_urls == ['https://example.org/page/%d?x=1' % i for i in range(ip, 100, 5)]
+    assert import_logs.stats.count_lines_recorded.value == 100
+
+def test_export_requests_interrupted(tmpdir):
+    """Test that the files of an interrupted export keep their .part suffix, and are not replayed."""
+
+    path = str(tmpdir.join('export'))
+    import_logs.config = Config()
+    import_logs.config.options.replay_tracking = False
+    exporter = import_logs.RequestExporter(path, 2)
+    hits = [make_hit(ip='10.0.0.%d' % i) for i in range(4)]
+    exporter.add(hits, [{'n': i} for i in range(4)])
+    assert not exporter.close(complete=False)
+    assert len(os.listdir(path)) == exporter.file_count
+    assert all(name.endswith('.ndjson.gz.part') for name in os.listdir(path))
+    assert import_logs.RequestExporter.get_files([path]) == []
+
+def test_tracker_endpoint_timeout():
+    """Test that a tracker which times out is left out, rather than the payload split."""
+
+    matomo = import_logs.MatomoHttpUrllib()
+    matomo.endpoints = import_logs.TrackerEndpoints(matomo, ['http://a', 'http://b'])
+    hung = matomo.endpoints.get(0)
+    urls = []
+
+    def send(url=None):
+        urls.append(url)
+        if url == hung.url:
+            raise import_logs.socket.timeout('timed out')
+        return 'ok'
+
+    try:
+        assert matomo._call_wrapper(send, None, None, raise_payload_errors=True, route=0, hit_count=2) == 'ok'
+        assert urls == [hung.url, matomo.endpoints.get(0).url]
+        assert hung.ejected_since is not None and urls[1] != hung.url
+    finally:
+        matomo.endpoints.close()
+
+def test_tracker_endpoints(recording):
+    """Test that tracking requests are spread over several trackers by visitor, leaving out unavailable ones."""
+
+    endpoints = import_logs.TrackerEndpoints(None, ['http://a', 'http://b', 'http://c'])
+    routes = dict((partition, endpoints.get(partition)) for partition in range(256))
+    assert set(routes.values()) == set(endpoints.endpoints)
+    ejected = routes[0]
+    ejected.ejected_since = 1
+    for partition, endpoint in routes.items():
+        if endpoint is ejected:
+            assert endpoints.get(partition) is not ejected
+        else:
+            assert endpoints.get(partition) is endpoint
+    for endpoint in endpoints.endpoints:
+        endpoint.ejected_since = endpoint.ejected_since or 2
+    assert endpoints.get(5) is ejected
+
+    handlers = [type('Handler%d' % i, (CompressionHandler,), {'bodies': []}) for i in range(2)]
+    import_logs.config.options.replay_tracking = False
+    import_logs.config.options.matomo_tracker_urls = [
+        recording.start_server(handler) for handler in handlers
+    ] + ['http://127.0.0.1:1']
+    import_logs.config.options.matomo_url = import_logs.config.options.matomo_tracker_urls[0]
+    import_logs.config.options.matomo_tracker_endpoint_path = '/ok'
+    import_logs.config.options.recorder_max_payload_size = 10
+    recorder = recording.launch(3)
+    hits = [make_hit(ip='10.0.0.%d' % (i % 20), path='/page/%d' % i) for i in range(200)]
+    recorder.add_hits(hits)
+    recorder.wait_empty()
+
+    visitors = []
+    for handler in handlers:
+        requests = [
+            request for encoding, body in handler.bodies for request in json.loads(body.decode())['requests']
+        ]
+        assert requests
+        visitors.append(set(request['cip'] for request in requests))
+    assert not visitors[0] & visitors[1]
+    assert len(visitors[0] | visitors[1]) == 20
+    assert import_logs.stats.count_lines_recorded.value == 200
+
+    dead = import_logs.matomo.endpoints.endpoints[2]
+    assert dead.ejected_since is not None and dead.count_hits == 0
+    assert sum(endpoint.count_hits for endpoint in import_logs.matomo.endpoints.endpoints) == 200
+
+class RouteHandler(http.server.BaseHTTPRequestHandler):
+    """Fake Matomo answering the API request of StaticResolver, and keeping the tracking requests."""
+    protocol_version = 'HTTP/1.1'
+    payloads = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        if 'SitesManager.getSiteFromId' in body:
+            content = json.dumps({'idsite': '7', 'main_url': 'https://shop.example.org'})
+        else:
+            self.payloads.append(json.loads(body))
+            content = json.dumps({'status': 'success', 'tracked': len(self.payloads[-1]['requests'])})
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content.encode())
+
+    def log_message(self, *args):
+        pass
+
+def test_routes(tmpdir, recording):
+    """Test that hits are sent to the Matomo of their route, with its token."""
+
+    handlers = [type('Handler%d' % i, (RouteHandler,), {'payloads': []}) for i in range(3)]
+    urls = [recording.start_server(handler) for handler in handlers]
+
+    path = str(tmpdir.join('routes.ini'))
+    with open(path, 'w') as file:
+        file.write(
+            '[shop]\nurl = %s\ntoken_auth = shop-token\nhosts = shop.example.org, *.shop.example.net\nidsite = 7\n\n'
+            '[site-2]\nurl = %s\ntoken_auth = site-token\nidsites = 2\nrecorders = 1\n' % (urls[1], urls[2])
+        )
+
+    import_logs.config.options.replay_tracking = False
+    import_logs.config.options.matomo_url = urls[0]
+    import_logs.config.options.matomo_tracker_endpoint_path = '/ok'
+    import_logs.config.options.routes = path
+    import_logs.config.routes = import_logs.Routes(path, 2)
+    import_logs.resolver.resolve = lambda hit: (2 if hit.host == 'site2.example.com' else 1, 'https://example.com')
+    recorder = recording.launch(2)
+    shop, site = import_logs.config.routes.routes
+    assert [len(route.recorder.recorders) for route in (shop, site)] == [2, 1]
+    hosts = ['shop.example.org', 'www.shop.example.net', 'site2.example.com', 'example.org']
+    hits = [make_hit(host=hosts[i % 4], path='/page/%d' % i) for i in range(40)]
+    # Hits are routed by site by the recorders, which find their site.
+    assert import_logs.config.routes.get(hits[2]) is None
+    assert import_logs.config.routes.get_by_site(hits[2]) is site
+    recorder.add_hits(hits)
+    recorder.wait_empty()
+
+    default, shop_payloads, site_payloads = [handler.payloads for handler in handlers]
+    assert set(payload['token_auth'] for payload in shop_payloads) == set(['shop-token'])
+    assert set(payload['token_auth'] for payload in site_payloads) == set(['site-token'])
+    def get_requests(payloads):
+        return [request for payload in payloads for request in payload['requests']]
+    assert sorted(request['url'] for request in get_requests(default)) == sorted(
+        'https://example.org/page/%d?x=1' % i for i in range(3, 40, 4)
+    )
+    assert len(get_requests(shop_payloads)) == 20
+    assert set(request['idsite'] for request in get_requests(shop_payloads)) == set(['7'])
+    assert set(request['idsite'] for request in get_requests(site_payloads)) == set([2])
+    assert len(get_requests(site_payloads)) == 10
+    assert (shop.count_lines_recorded.value, site.count_lines_recorded.value) == (20, 10)
+    assert import_logs.stats.count_lines_recorded.value == 40
+
+def test_mirrors(recording):
+    """Test that all the hits are also sent to the mirrors, with their own token and statistics."""
+
+    handlers = [type('Handler%d' % i, (RouteHandler,), {'payloads': []}) for i in range(2)]
+    urls = [recording.start_server(handler) for handler in handlers]
+
+    import_logs.config.options.replay_tracking = False
+    import_logs.config.options.enable_bots = True
+    import_logs.config.options.matomo_url = urls[0]
+    import_logs.config.options.matomo_tracker_endpoint_path = '/ok'
+    mirror = import_logs.Mirror('mirror-1', urls[1], 'mirror-token', 1)
+    import_logs.config.mirrors = [mirror]
+    recorder = recording.launch(2)
+    hits = [make_hit(path='/page/%d' % i, ip='10.0.0.%d' % i, is_robot=False) for i in range(20)]
+    recorder.add_hits(hits)
+    recorder.wait_empty()
+
+    primary, mirrored = [handler.payloads for handler in handlers]
+    assert set(payload['token_auth'] for payload in primary) == set(['token'])
+    assert set(payload['token_auth'] for payload in mirrored) == set(['mirror-token'])
+    def get_requests(payloads):
+        return sorted(
+            (request for payload in payloads for request in payload['requests']), key=lambda request: request['url']
+        )
+    # Hits are recorded once by each destination: custom variables are not added twice.
+    assert get_requests(primary) == get_requests(mirrored)
+    assert len(get_requests(primary)) == 20
+    assert all(len(json.loads(request['_cvar'])) == 1 for request in get_requests(primary))
+    assert import_logs.stats.count_lines_recorded.value == 20
+    assert mirror.count_lines_recorded.value == 20
+
+    # Without --spool, the hits a slow mirror cannot take are dropped rather
+    # than holding up parsing.
+    mirror.recorder._resize(0)
+    mirror.recorder.dispatcher.max_size = 1
+    recorder.add_hits(hits[:10])
+    recorder.add_hits(hits[10:])
+    recorder.dispatcher.join()
+    assert mirror.count_lines_dropped.value == 10
+    assert import_logs.stats.count_lines_recorded.value == 40
+
+def test_mirror_spool_path():
+    """Test that the spool directory of a mirror doesn't depend on the order of the mirrors."""
+
+    import_logs.config = Config()
+    import_logs.config.options.spool = 'spool'
+    first = import_logs.Mirror('mirror-1', 'http://new.example.com/', None, 1)
+    second = import_logs.Mirror('mirror-2', 'http://new.example.com', None, 1)
+    other = import_logs.Mirror('mirror-1', 'http://other.example.com', None, 1)
+    assert first.get_spool_path() == second.get_spool_path()
+    assert first.get_spool_path() != other.get_spool_path()
+    assert os.path.dirname(first.get_spool_path()) == 'spool'
+    import_logs.config = Config()